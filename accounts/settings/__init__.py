@@ -13,5 +13,8 @@ if environ == "local":
 elif environ == "dev":
     from .dev import *
 
+elif environ == "test":
+    from .test import *
+
 else:
     from .production import *
@@ -1,6 +1,10 @@
 import os
+import json
+import datetime
 from pathlib import Path
 
+from cryptography.hazmat.primitives import serialization
+
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
 
 SECRET_KEY = os.getenv('DJANGO_SECRET_KEY', 'secret_key')
@@ -8,6 +12,8 @@ SECRET_KEY = os.getenv('DJANGO_SECRET_KEY', 'secret_key')
 INSTALLED_APPS = [
     # my apps
     'apps.users',
+    'apps.otp',
+    'apps.fingerprint',
 
     # extras
     'drf_yasg',
@@ -16,6 +22,7 @@ INSTALLED_APPS = [
     'django_user_agents',
     'oauth2_provider',
     'rest_framework_simplejwt',
+    'rest_framework_simplejwt.token_blacklist',
 
     # default
     'django.contrib.auth',
@@ -59,6 +66,9 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'accounts.wsgi.application'
 
+# Async login, verification and registration views, accounts/asgi.py turns them on
+ASYNC_AUTH_VIEWS = os.getenv('ASYNC_AUTH_VIEWS', 'false').lower() == 'true'
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -77,6 +87,24 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Argon2id is preferred, hashes made by the other hashers are upgraded on the next successful login
+PASSWORD_HASHERS = [
+    'apps.users.hashers.TunedArgon2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+
+# Memory in KiB. One lane per hash, requests are already spread over the worker processes
+PASSWORD_ARGON2_TIME_COST = int(os.getenv('PASSWORD_ARGON2_TIME_COST', 2))
+PASSWORD_ARGON2_MEMORY_COST = int(os.getenv('PASSWORD_ARGON2_MEMORY_COST', 19456))
+PASSWORD_ARGON2_PARALLELISM = int(os.getenv('PASSWORD_ARGON2_PARALLELISM', 1))
+
+# Password hashing pool of every web process, 0 hashes inline in the request thread.
+# Past the backlog limit or the timeout requests get a 503
+PASSWORD_HASHING_WORKERS = int(os.getenv('PASSWORD_HASHING_WORKERS', 2))
+PASSWORD_HASHING_MAX_BACKLOG = int(os.getenv('PASSWORD_HASHING_MAX_BACKLOG', 16))
+PASSWORD_HASHING_TIMEOUT = 5
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -95,9 +123,168 @@ AUTHENTICATION_BACKENDS = [
     'apps.users.backends.auth.AuthBackend',
 ]
 
+# Cache
+# Both caches share one connection pool, OTP keys live under their own prefix
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/0')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': REDIS_URL,
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'CONNECTION_POOL_KWARGS': {'max_connections': int(os.getenv('REDIS_MAX_CONNECTIONS', 100))},
+        }
+    },
+    'otp': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'otp',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            'CONNECTION_POOL_KWARGS': {'max_connections': int(os.getenv('REDIS_MAX_CONNECTIONS', 100))},
+        }
+    },
+}
+
+OTP_CACHE = 'otp'
+
+# One time passwords
+OTP_RESEND_COOLDOWN = 60
+OTP_MAX_ATTEMPTS = 5
+OTP_BLOCK_TIMEOUT = 60 * 15
+OTP_RATE_LIMITS = {
+    # (requests, window in seconds)
+    'destination': (5, 60 * 60),
+    'ip': (20, 60 * 60),
+}
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework_simplejwt.authentication.JWTAuthentication',
         "oauth2_provider.contrib.rest_framework.OAuth2Authentication",
     ]
 }
+
+# SMS dispatch queue, see apps.users.utils.dispatch
+SMS_DISPATCH_CACHE = 'default'
+SMS_DISPATCH_BATCH_SIZE = 50
+SMS_DISPATCH_CONCURRENCY = 10
+SMS_DELIVERY_LOG_SIZE = 10000
+# Seconds an idle dispatcher waits before polling the lanes again
+SMS_DISPATCH_IDLE_INTERVAL = 0.05
+# A dispatcher missing three heartbeats is dead, its messages are requeued by the next one to start
+SMS_DISPATCH_HEARTBEAT = 10
+
+# Email delivery, see apps.users.utils.mail
+EMAIL_TIMEOUT = 10
+# Messages sent per SMTP session
+EMAIL_BATCH_SIZE = 100
+EMAIL_RETRY_DELAY = 30
+
+# Generated avatars, stored once per (letter, color) and shared by the users
+AVATAR_DEFAULTS_DIR = 'avatars/default/'
+
+# Seconds a file is left in media/tmp before the sweeper removes it
+AVATAR_TMP_MAX_AGE = 60 * 60
+# Uploads waiting for process_avatar, the task removes them and the tmp sweeper leaves them alone
+AVATAR_UPLOADS_DIR = 'tmp/uploads/'
+
+# Sizes avatars are stored in, a request gets the smallest one not smaller than it asked for
+AVATAR_VARIANT_SIZES = (32, 64, 128, 256)
+
+# 'token' keeps the registration state in the G-Token header, 'cache' keeps it server side
+REGISTRATION_STATE_STORE = os.getenv('REGISTRATION_STATE_STORE', 'token')
+
+# Seconds a user loaded by the auth backend is cached for
+AUTH_USER_CACHE_TIMEOUT = 60
+
+# Access tokens are signed with a private key (PEM) so other services can verify them locally
+# against the published JWKS, without a key they are signed with the secret key
+JWT_PRIVATE_KEY = os.getenv('JWT_PRIVATE_KEY', '')
+JWT_PUBLIC_KEY = os.getenv('JWT_PUBLIC_KEY', '')
+# Derived when only the private key is given, tokens must stay verifiable and the JWKS can't be empty
+if JWT_PRIVATE_KEY and not JWT_PUBLIC_KEY:
+    JWT_PUBLIC_KEY = serialization.load_pem_private_key(JWT_PRIVATE_KEY.encode(), password=None).public_key() \
+        .public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+# Public keys of retired private keys, published until the tokens signed with them expire
+JWT_PUBLIC_KEYS_INACTIVE = json.loads(os.getenv('JWT_PUBLIC_KEYS_INACTIVE', '[]'))
+JWKS_MAX_AGE = 60 * 60
+
+SIMPLE_JWT = {
+    "ACCESS_TOKEN_LIFETIME": datetime.timedelta(minutes=5),
+    "REFRESH_TOKEN_LIFETIME": datetime.timedelta(days=15),
+    "AUTH_HEADER_TYPES": ("Bearer", ),
+    "ALGORITHM": os.getenv('JWT_ALGORITHM', 'RS256') if JWT_PRIVATE_KEY else 'HS256',
+    "SIGNING_KEY": JWT_PRIVATE_KEY or SECRET_KEY,
+    "VERIFYING_KEY": JWT_PUBLIC_KEY,
+    "ISSUER": os.getenv('BASE_URL'),
+    "TOKEN_REFRESH_SERIALIZER": "apps.users.serializers.jwt.CustomTokenRefreshSerializer",
+    "AUTH_TOKEN_CLASSES": ("apps.users.utils.jwks.KeyIdAccessToken", ),
+}
+
+# Refresh token revocation, see apps.users.utils.revocation. A revocation made by another
+# process is seen here after at most REVOCATION_SYNC_INTERVAL seconds
+REVOCATION_CACHE = 'default'
+REVOCATION_SYNC_INTERVAL = 5
+REVOCATION_REBUILD_INTERVAL = 60 * 60
+REVOCATION_BLOOM_CAPACITY = 100000
+REVOCATION_BLOOM_ERROR_RATE = 0.001
+# Expired outstanding tokens are deleted in chunks of this size
+TOKEN_PURGE_BATCH_SIZE = 5000
+
+CELERY_BEAT_SCHEDULE = {
+    'cleanup-tmp-avatars': {
+        'task': 'apps.users.tasks.cleanup_tmp_avatars',
+        'schedule': 60 * 60,
+    },
+    'purge-expired-tokens': {
+        'task': 'apps.users.tasks.purge_expired_tokens',
+        'schedule': 60 * 60 * 6,
+    },
+    'flush-activity-log': {
+        'task': 'apps.users.tasks.flush_activity_log',
+        'schedule': 5,
+    },
+    'create-activity-partitions': {
+        'task': 'apps.users.tasks.create_activity_partitions',
+        'schedule': 60 * 60 * 24,
+    },
+}
+
+# Activity audit log, see apps.users.utils.activity
+ACTIVITY_CACHE = 'default'
+ACTIVITY_FLUSH_BATCH_SIZE = 1000
+# Buffered events that trigger a flush before the next scheduled one
+ACTIVITY_FLUSH_THRESHOLD = 5000
+# Seconds a flush holds its lock without finishing a batch, a dead flusher's batch is retried after that
+ACTIVITY_FLUSH_LOCK_TIMEOUT = 60
+# Failed writes of a batch before it is moved to the dead letters, at a flush every 5 seconds
+# that is about a minute of database errors
+ACTIVITY_FLUSH_MAX_ATTEMPTS = 12
+ACTIVITY_PARTITIONS_AHEAD = 2
+# Months of activity kept, None keeps everything
+ACTIVITY_RETENTION_MONTHS = None
+ACTIVITY_FEED_PAGE_SIZE = 20
+ACTIVITY_FEED_MAX_PAGE_SIZE = 100
+
+# Known devices, see apps.fingerprint.utils.service
+DEVICE_FINGERPRINT_HEADER = 'X-Device-Fingerprint'
+DEVICE_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Notification inbox, see apps.users.utils.notification
+NOTIFICATION_CACHE = 'default'
+NOTIFICATION_COUNTER_TIMEOUT = 60 * 60 * 24
+NOTIFICATION_PAGE_SIZE = 20
+NOTIFICATION_MAX_PAGE_SIZE = 100
+# Server-sent events stream, in seconds
+NOTIFICATION_STREAM_TIMEOUT = 60 * 5
+NOTIFICATION_STREAM_HEARTBEAT = 15
+NOTIFICATION_STREAM_RETRY = 3
+
+# Serialized user profiles, see apps.users.utils.profile
+USER_PROFILE_CACHE_TIMEOUT = 60 * 60 * 24
+USER_PROFILE_BATCH_SIZE = 100
+# Ids per call of the internal users/lookup endpoint
+USER_LOOKUP_MAX_IDS = 1000
@@ -1,5 +1,4 @@
 import json
-import datetime
 from .base import *
 
 
@@ -52,17 +51,12 @@ OAUTH2_PROVIDER = {
     # Token scopes
     'SCOPES': {
         'profile.read': 'Read profile scope',
+        'users.lookup': 'Resolve user ids to public profiles',
         'write': 'Write scope',
         'custom_scope': 'Custom scope description',
     }
 }
 
-SIMPLE_JWT = {
-    "ACCESS_TOKEN_LIFETIME": datetime.timedelta(minutes=5),
-    "REFRESH_TOKEN_LIFETIME": datetime.timedelta(days=15),
-    "AUTH_HEADER_TYPES": ("Bearer", ),
-}
-
 
 # Database
 DATABASES = {
@@ -72,16 +66,6 @@ DATABASES = {
     }
 }
 
-CACHE = {
-    'default': {
-        'BACKEND': 'django_redis.cache.RedisCache',
-        'LOCATION': 'redis://127.0.0.1:6379',  # Adjust this based on your Redis configuration
-        'OPTIONS': {
-            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
-        }
-    }
-}
-
 CORS_ALLOWED_HEADERS = [
 
 ]
@@ -0,0 +1,19 @@
+import fakeredis
+
+from .local import *
+
+# Test runs need no Redis server, every cache alias talks to one in-process fake
+FAKE_REDIS_SERVER = fakeredis.FakeServer()
+
+for _cache in CACHES.values():
+    _cache['OPTIONS']['CONNECTION_POOL_KWARGS'] = {
+        'connection_class': fakeredis.FakeConnection,
+        'server': FAKE_REDIS_SERVER,
+    }
+
+# Hashing in the test process with a fast hasher
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+PASSWORD_HASHING_WORKERS = 0
+
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+ALLOWED_HOSTS = ['testserver']
@@ -12,6 +12,14 @@ from rest_framework_simplejwt.views import (
 )
 from apps.users import generate_avatar
 from apps.users import CustomLogin, CustomTokenRevokeView, Verification
+from apps.users.views.asynchronous import AsyncLogin, AsyncVerification
+from apps.users.views.jwks import JWKSView
+
+# The ASGI deployment serves the async variants of the auth endpoints
+if settings.ASYNC_AUTH_VIEWS:
+    CustomLoginView, VerificationView = AsyncLogin, AsyncVerification
+else:
+    CustomLoginView, VerificationView = CustomLogin, Verification
 
 
 # OAuth2 provider endpoints
@@ -43,11 +51,13 @@ urlpatterns = [
     path('o/', include((oauth2_endpoint_views, 'oauth2_provider'), namespace="oauth2_provider")),
 
     # JWT Token Endpoints
-    path('auth/verify', Verification.as_view(), name='verification'),
+    path('auth/verify', VerificationView.as_view(), name='verification'),
+    path('auth/login', CustomLoginView.as_view(), name='login'),
 
     path('token/refresh/', TokenRefreshView.as_view(), name='token-refresh'),
     path('token/verify/', TokenVerifyView.as_view(), name='token-verify'),
     path('token/revoke/', CustomTokenRevokeView.as_view(), name='token-revoke'),
+    path('.well-known/jwks.json', JWKSView.as_view(), name='jwks'),
 
     # Admin urls
     # path('jet/', include('jet.urls', 'jet')),  # Django JET URLS
@@ -57,4 +67,7 @@ urlpatterns = [
     # Users urls
     path('users/', include('apps.users.urls')),
 
+    # OTP urls
+    path('otp/', include('apps.otp.urls')),
+
 ]
@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# Sent with `user`, `device` and `request` when a user logs in from a device not seen before
+new_device = Signal()
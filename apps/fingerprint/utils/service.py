@@ -0,0 +1,67 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from apps.fingerprint.signals import new_device
+from apps.users.models import Device
+
+
+def get_fingerprint_hash(fingerprint):
+    return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+
+def get_devices_key(user_id):
+    return f'fingerprint:devices:{user_id}'
+
+
+def get_fingerprint(request):
+    # Clients that don't send a fingerprint are told apart by their user agent
+    return request.headers.get(settings.DEVICE_FINGERPRINT_HEADER) or request.user_agent.ua_string
+
+
+def get_known_devices(user_id):
+    # {fingerprint hash: device id} of the user, a login from a known device needs no query
+    key = get_devices_key(user_id)
+    devices = cache.get(key)
+    if devices is None:
+        devices = dict(Device.objects.filter(user_id=user_id).values_list('fingerprint_hash', 'id'))
+        cache.set(key, devices, timeout=settings.DEVICE_CACHE_TIMEOUT)
+    return devices
+
+
+def invalidate_known_devices(user_id):
+    cache.delete(get_devices_key(user_id))
+
+
+def describe_device(request):
+    # Parsed once per user agent string and cached by django_user_agents
+    user_agent = request.user_agent
+    browser = user_agent.browser.family
+    os = user_agent.os.family
+    name = user_agent.device.family if user_agent.is_mobile or user_agent.is_tablet else f'{browser} on {os}'
+    return name[:100], browser[:20], os[:20]
+
+
+def register_device(request, user):
+    fingerprint = get_fingerprint(request)[:500]
+    fingerprint_hash = get_fingerprint_hash(fingerprint)
+
+    devices = get_known_devices(user.pk)
+    device_id = devices.get(fingerprint_hash)
+    if device_id is not None:
+        return device_id
+
+    name, browser, os = describe_device(request)
+    # Concurrent logins from the same new device both get here, the unique constraint lets only one
+    # of them insert the row and only that one reports the device as new
+    device, created = Device.objects.get_or_create(
+        user=user, fingerprint_hash=fingerprint_hash,
+        defaults={'name': name, 'browser': browser, 'os': os, 'fingerprint': fingerprint},
+    )
+
+    devices[fingerprint_hash] = device.pk
+    cache.set(get_devices_key(user.pk), devices, timeout=settings.DEVICE_CACHE_TIMEOUT)
+    if created:
+        new_device.send(sender=Device, user=user, device=device, request=request)
+    return device.pk
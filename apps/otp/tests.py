@@ -1,3 +1,76 @@
-from django.test import TestCase
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-# Create your tests here.
+from django.conf import settings
+from django.test import TestCase, override_settings
+
+from apps.otp.utils.cache import consume_code, get_otp_cache, set_code
+from apps.otp.utils.service import averify_code, get_code_key, send_code, verify_code
+
+DESTINATION = '+99361234567'
+
+
+class OTPTestCase(TestCase):
+    def setUp(self):
+        get_otp_cache().clear()
+        self.key = get_code_key('registration', DESTINATION)
+
+
+class ConsumeCodeTests(OTPTestCase):
+    def test_wrong_code_is_kept(self):
+        set_code(self.key, 12345, timeout=60)
+        self.assertFalse(consume_code(self.key, 54321))
+        self.assertEqual(get_otp_cache().get(self.key), 12345)
+
+    def test_code_is_consumed_once(self):
+        set_code(self.key, 12345, timeout=60)
+        self.assertTrue(consume_code(self.key, 12345))
+        self.assertFalse(consume_code(self.key, 12345))
+        self.assertIsNone(get_otp_cache().get(self.key))
+
+    def test_concurrent_consumers(self):
+        set_code(self.key, 12345, timeout=60)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda i: consume_code(self.key, 12345), range(8)))
+        self.assertEqual(results.count(True), 1)
+
+    def test_expired_code(self):
+        set_code(self.key, 12345, timeout=1)
+        time.sleep(1.1)
+        self.assertFalse(consume_code(self.key, 12345))
+
+    @override_settings(OTP_CACHE='otp-locmem', CACHES={
+        **settings.CACHES, 'otp-locmem': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    })
+    def test_fallback_without_redis(self):
+        set_code(self.key, 12345, timeout=60)
+        self.assertFalse(consume_code(self.key, 54321))
+        self.assertTrue(consume_code(self.key, 12345))
+        self.assertFalse(consume_code(self.key, 12345))
+
+
+class VerifyCodeTests(OTPTestCase):
+    def setUp(self):
+        super().setUp()
+        self.codes = []
+        self.assertTrue(send_code('registration', DESTINATION, lambda destination, code: self.codes.append(code)))
+
+    def test_code_is_verified_once(self):
+        code = self.codes[0]
+        self.assertFalse(verify_code('registration', DESTINATION, code + 1 if code < 99999 else code - 1))
+        self.assertTrue(verify_code('registration', DESTINATION, code))
+        self.assertFalse(verify_code('registration', DESTINATION, code))
+
+    async def test_async_code_is_verified_once(self):
+        code = self.codes[0]
+        self.assertTrue(await averify_code('registration', DESTINATION, code))
+        self.assertFalse(await averify_code('registration', DESTINATION, code))
+
+    def test_resend_is_deduplicated(self):
+        self.assertFalse(send_code('registration', DESTINATION, lambda destination, code: self.codes.append(code)))
+        self.assertEqual(len(self.codes), 1)
+
+    def test_code_expires(self):
+        get_otp_cache().expire(self.key, 1)
+        time.sleep(1.1)
+        self.assertFalse(verify_code('registration', DESTINATION, self.codes[0]))
@@ -0,0 +1,6 @@
+from django.urls import path
+from .views import OTPMetrics
+
+urlpatterns = [
+    path('metrics', OTPMetrics.as_view(), name='otp_metrics'),
+]
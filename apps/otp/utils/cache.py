@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.cache import caches
+
+# Deletes the code only if it matches, so a code can be used once even with concurrent requests
+CONSUME_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def get_otp_cache():
+    return caches[settings.OTP_CACHE]
+
+
+def _get_redis_client(cache):
+    # django_redis gives access to the raw client, other backends fall back to get/delete
+    client = getattr(cache, 'client', None)
+    if client is None or not hasattr(client, 'get_client'):
+        return None
+    return client
+
+
+def set_code(key, code, timeout):
+    get_otp_cache().set(key, int(code), timeout=timeout)
+
+
+def consume_code(key, code):
+    cache = get_otp_cache()
+    client = _get_redis_client(cache)
+    if client is not None:
+        return bool(client.get_client(write=True).eval(CONSUME_SCRIPT, 1, client.make_key(key), int(code)))
+
+    if cache.get(key) != int(code):
+        return False
+    cache.delete(key)
+    return True
@@ -0,0 +1,154 @@
+import time
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+from django.utils.translation import gettext as _
+
+from rest_framework.exceptions import Throttled
+
+from apps.users.utils.auth import generate_verification_code
+from apps.otp.utils.cache import get_otp_cache, set_code, consume_code
+
+logger = logging.getLogger(__name__)
+
+METRICS = ('sent', 'deduplicated', 'rate_limited', 'verified', 'failed', 'blocked')
+
+
+def get_code_key(purpose, destination):
+    return f'{purpose}_code:{destination}'
+
+
+def record_metric(event):
+    cache = get_otp_cache()
+    key = f'metrics:{event}'
+    cache.add(key, 0, timeout=None)
+    cache.incr(key)
+
+
+async def arecord_metric(event):
+    cache = get_otp_cache()
+    key = f'metrics:{event}'
+    await cache.aadd(key, 0, timeout=None)
+    await cache.aincr(key)
+
+
+def get_metrics():
+    values = get_otp_cache().get_many([f'metrics:{event}' for event in METRICS])
+    return {event: values.get(f'metrics:{event}', 0) for event in METRICS}
+
+
+def hit_rate_limit(name, identifier, limit, window):
+    # Sliding window approximated from the current and the previous fixed windows,
+    # counters are only touched with atomic add/incr
+    cache = get_otp_cache()
+    now = time.time()
+    current = int(now // window)
+
+    key = f'rate:{name}:{identifier}:{current}'
+    cache.add(key, 0, timeout=window * 2)
+    count = cache.incr(key)
+    previous = cache.get(f'rate:{name}:{identifier}:{current - 1}') or 0
+
+    weight = 1 - (now % window) / window
+    if previous * weight + count > limit:
+        raise Throttled(wait=window - now % window, detail=_('Too many verification codes requested'))
+
+
+def raise_if_blocked(blocked_until):
+    if blocked_until:
+        raise Throttled(wait=max(blocked_until - time.time(), 0), detail=_('Too many attempts'))
+
+
+def check_blocked(purpose, destination):
+    raise_if_blocked(get_otp_cache().get(f'blocked:{purpose}:{destination}'))
+
+
+def send_code(purpose, destination, sender, ip_address=None):
+    # Returns False when a code was sent recently and the request was deduplicated
+    check_blocked(purpose, destination)
+
+    try:
+        for name, identifier in (('destination', destination), ('ip', ip_address)):
+            if identifier:
+                limit, window = settings.OTP_RATE_LIMITS[name]
+                hit_rate_limit(name, identifier, limit, window)
+    except Throttled:
+        record_metric('rate_limited')
+        logger.info('OTP rate limit hit for %s (%s)', destination, ip_address)
+        raise
+
+    cache = get_otp_cache()
+    if not cache.add(f'cooldown:{purpose}:{destination}', 1, timeout=settings.OTP_RESEND_COOLDOWN):
+        record_metric('deduplicated')
+        return False
+
+    code = generate_verification_code()
+    set_code(get_code_key(purpose, destination), code, timeout=settings.REGISTRATION_CODE_TIMEOUT)
+    cache.delete(f'attempts:{purpose}:{destination}')
+    sender(destination, code)
+
+    record_metric('sent')
+    return True
+
+
+def verify_code(purpose, destination, code):
+    check_blocked(purpose, destination)
+
+    cache = get_otp_cache()
+    attempts_key = f'attempts:{purpose}:{destination}'
+    cache.add(attempts_key, 0, timeout=settings.REGISTRATION_CODE_TIMEOUT)
+    if cache.incr(attempts_key) > settings.OTP_MAX_ATTEMPTS:
+        # The code is burned, a new one can be requested once the block expires
+        cache.delete(get_code_key(purpose, destination))
+        cache.set(f'blocked:{purpose}:{destination}', time.time() + settings.OTP_BLOCK_TIMEOUT,
+                  timeout=settings.OTP_BLOCK_TIMEOUT)
+        record_metric('blocked')
+        logger.info('OTP verification blocked for %s', destination)
+        raise Throttled(wait=settings.OTP_BLOCK_TIMEOUT, detail=_('Too many attempts'))
+
+    key = get_code_key(purpose, destination)
+    stored_code = cache.get(key)
+    if stored_code is None or not constant_time_compare(str(stored_code), str(code)):
+        record_metric('failed')
+        return False
+
+    # The atomic delete makes sure a code is accepted only once
+    if not consume_code(key, code):
+        record_metric('failed')
+        return False
+
+    cache.delete_many([attempts_key, f'cooldown:{purpose}:{destination}'])
+    record_metric('verified')
+    return True
+
+
+async def averify_code(purpose, destination, code):
+    # Same checks as verify_code with the async cache API, only the atomic consume script goes through a thread
+    cache = get_otp_cache()
+    raise_if_blocked(await cache.aget(f'blocked:{purpose}:{destination}'))
+
+    attempts_key = f'attempts:{purpose}:{destination}'
+    await cache.aadd(attempts_key, 0, timeout=settings.REGISTRATION_CODE_TIMEOUT)
+    if await cache.aincr(attempts_key) > settings.OTP_MAX_ATTEMPTS:
+        await cache.adelete(get_code_key(purpose, destination))
+        await cache.aset(f'blocked:{purpose}:{destination}', time.time() + settings.OTP_BLOCK_TIMEOUT,
+                         timeout=settings.OTP_BLOCK_TIMEOUT)
+        await arecord_metric('blocked')
+        logger.info('OTP verification blocked for %s', destination)
+        raise Throttled(wait=settings.OTP_BLOCK_TIMEOUT, detail=_('Too many attempts'))
+
+    key = get_code_key(purpose, destination)
+    stored_code = await cache.aget(key)
+    if stored_code is None or not constant_time_compare(str(stored_code), str(code)):
+        await arecord_metric('failed')
+        return False
+
+    if not await sync_to_async(consume_code)(key, code):
+        await arecord_metric('failed')
+        return False
+
+    await cache.adelete_many([attempts_key, f'cooldown:{purpose}:{destination}'])
+    await arecord_metric('verified')
+    return True
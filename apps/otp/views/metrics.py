@@ -0,0 +1,13 @@
+from rest_framework import status
+from rest_framework.permissions import IsAdminUser
+from rest_framework.views import APIView
+
+from apps.otp.utils.service import get_metrics
+from apps.users.utils.functions import build_response
+
+
+class OTPMetrics(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return build_response('ok', 'OTP metrics', status.HTTP_200_OK, {'metrics': get_metrics()})
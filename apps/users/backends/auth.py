@@ -1,5 +1,19 @@
+from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth import get_user_model
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from apps.users.utils import hashing
+
+
+def get_user_cache_key(user_id):
+    return f'auth:user:{user_id}'
 
 
 class AuthBackend(ModelBackend):
@@ -24,13 +38,83 @@ class AuthBackend(ModelBackend):
         else:
             return None
 
-        if user.check_password(password):
-            return user
-        return None
+        # Hashing runs in the worker pool, an outdated hash (another hasher or older parameters)
+        # is replaced on a successful check
+        valid, must_update = hashing.check_password(password, user.password)
+        if not valid:
+            return None
+        if must_update:
+            user.password = hashing.make_password(password)
+            user.save(update_fields=['password'])
+        return user
+
+    async def aauthenticate(self, request, username=None, phone_number=None, email=None, password=None, **kwargs):
+        User = get_user_model()
+
+        if username:
+            lookup = {'email': username}
+        elif phone_number:
+            lookup = {'phone_number': phone_number}
+        elif email:
+            lookup = {'email': email}
+        else:
+            return None
+
+        try:
+            user = await User.objects.aget(**lookup)
+        except User.DoesNotExist:
+            return None
+
+        valid, must_update = await hashing.acheck_password(password, user.password)
+        if not valid:
+            return None
+        if must_update:
+            user.password = await hashing.amake_password(password)
+            await user.asave(update_fields=['password'])
+        return user
 
     def get_user(self, user_id):
+        # Runs on every session authenticated request, the user is cached for a short time
+        # and dropped from the cache whenever it is saved or deleted
+        key = get_user_cache_key(user_id)
+        user = cache.get(key)
+        if user is not None:
+            return user
+
+        User = get_user_model()
+        try:
+            user = User.objects.get(pk=user_id)
+        except User.DoesNotExist:
+            return None
+        cache.set(key, user, timeout=settings.AUTH_USER_CACHE_TIMEOUT)
+        return user
+
+    async def aget_user(self, user_id):
+        key = get_user_cache_key(user_id)
+        user = await cache.aget(key)
+        if user is not None:
+            return user
+
         User = get_user_model()
         try:
-            return User.objects.get(pk=user_id)
+            user = await User.objects.aget(pk=user_id)
         except User.DoesNotExist:
             return None
+        await cache.aset(key, user, timeout=settings.AUTH_USER_CACHE_TIMEOUT)
+        return user
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    # Loads the token's user through the auth backend cache instead of a query per request
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        user = AuthBackend().get_user(user_id)
+        if user is None:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return user
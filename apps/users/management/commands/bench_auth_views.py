@@ -0,0 +1,99 @@
+import time
+import asyncio
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import Client, AsyncClient
+from django.test.utils import override_settings
+from django.urls import path
+
+from apps.users.models import User
+from apps.users.utils.auth import generate_token
+from apps.users.utils.hashing import make_password
+from apps.users.views.asynchronous import AsyncLogin, AsyncRegistration
+from apps.users.views.register import CustomLogin, Registration
+
+BENCH_EMAIL = 'bench.auth.views@example.com'
+BENCH_PASSWORD = 'correct horse battery staple'
+
+# Both variants side by side, the command uses this module as the URLconf
+urlpatterns = [
+    path('sync/login', CustomLogin.as_view()),
+    path('sync/register', Registration.as_view()),
+    path('async/login', AsyncLogin.as_view()),
+    path('async/register', AsyncRegistration.as_view()),
+]
+
+
+class Command(BaseCommand):
+    help = 'Compare throughput of the sync views under WSGI with the async views under ASGI'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', default=200, type=int)
+        parser.add_argument('--concurrency', default=8, type=int, help='WSGI threads and concurrent ASGI requests')
+        parser.add_argument('--endpoint', default='login', choices=('login', 'register'))
+
+    def get_request(self, endpoint):
+        if endpoint == 'login':
+            return 'post', 'login', {'email': BENCH_EMAIL, 'password': BENCH_PASSWORD}, {}
+
+        token = generate_token({
+            'account_type': 'personal',
+            'email': BENCH_EMAIL,
+            'first_name': 'Bench',
+            'last_name': 'User',
+            'iat': datetime.utcnow(),
+            'exp': datetime.utcnow() + timedelta(seconds=settings.REGISTRATION_TOKEN_TIMEOUT),
+            'iss': 'registration_password',
+            'aud': ['registration'],
+        })
+        return 'get', 'register', {}, {settings.REGISTRATION_TOKEN_HEADER: token}
+
+    def run_wsgi(self, prefix, method, url, data, headers, options):
+        def request(_):
+            started = time.perf_counter()
+            response = getattr(Client(), method)(f'/{prefix}/{url}', data, headers=headers)
+            assert response.status_code < 300, response.status_code
+            return time.perf_counter() - started
+
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            return list(executor.map(request, range(options['requests'])))
+
+    def run_asgi(self, prefix, method, url, data, headers, options):
+        async def run():
+            semaphore = asyncio.Semaphore(options['concurrency'])
+
+            async def request():
+                async with semaphore:
+                    started = time.perf_counter()
+                    response = await getattr(AsyncClient(), method)(f'/{prefix}/{url}', data, headers=headers)
+                    assert response.status_code < 300, response.status_code
+                    return time.perf_counter() - started
+
+            return await asyncio.gather(*(request() for _ in range(options['requests'])))
+
+        return asyncio.run(run())
+
+    def handle(self, *args, **options):
+        User.objects.filter(email=BENCH_EMAIL).delete()
+        User.objects.create(email=BENCH_EMAIL, password=make_password(BENCH_PASSWORD), first_name='Bench',
+                            last_name='User', phone_number='+99360000000')
+        method, url, data, headers = self.get_request(options['endpoint'])
+
+        try:
+            with override_settings(ROOT_URLCONF=__name__):
+                for name, runner, prefix in (
+                    ('WSGI, sync views', self.run_wsgi, 'sync'),
+                    ('ASGI, sync views', self.run_asgi, 'sync'),
+                    ('ASGI, async views', self.run_asgi, 'async'),
+                ):
+                    started = time.perf_counter()
+                    timings = sorted(runner(prefix, method, url, data, headers, options))
+                    elapsed = time.perf_counter() - started
+                    self.stdout.write(f'{name}: {len(timings) / elapsed:.1f} req/s, '
+                                      f'p50 {timings[len(timings) // 2] * 1000:.1f} ms, '
+                                      f'p99 {timings[int((len(timings) - 1) * 0.99)] * 1000:.1f} ms')
+        finally:
+            User.objects.filter(email=BENCH_EMAIL).delete()
@@ -0,0 +1,36 @@
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from apps.users.utils.auth import generate_unique_email_suggestions
+
+
+class Command(BaseCommand):
+    help = 'Measure queries and latency of the registration email suggestions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--first-name', default='Aman')
+        parser.add_argument('--last-name', default='Amanov')
+        parser.add_argument('--birthday', default='2000-01-01', type=date.fromisoformat)
+        parser.add_argument('--iterations', default=200, type=int)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        timings = []
+
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(iterations):
+                started = time.perf_counter()
+                suggestions = generate_unique_email_suggestions(
+                    options['first_name'], options['last_name'], options['birthday']
+                )
+                timings.append(time.perf_counter() - started)
+
+        timings.sort()
+        self.stdout.write(f'suggestions: {", ".join(suggestions)}')
+        self.stdout.write(f'queries per call: {len(queries) / iterations:.2f}')
+        self.stdout.write(f'p50: {timings[len(timings) // 2] * 1000:.3f} ms')
+        self.stdout.write(f'p99: {timings[int((len(timings) - 1) * 0.99)] * 1000:.3f} ms')
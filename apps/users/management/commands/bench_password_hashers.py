@@ -0,0 +1,27 @@
+import time
+
+from django.contrib.auth.hashers import get_hashers
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Report hashes per second on one core for every configured password hasher'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', default=2, type=float, help='Time spent on each hasher')
+        parser.add_argument('--password', default='correct horse battery staple')
+
+    def handle(self, *args, **options):
+        for hasher in get_hashers():
+            encoded = hasher.encode(options['password'], hasher.salt())
+
+            # A login is one verify, so that is what gets measured
+            count = 0
+            started = time.perf_counter()
+            while time.perf_counter() - started < options['seconds']:
+                hasher.verify(options['password'], encoded)
+                count += 1
+            elapsed = time.perf_counter() - started
+
+            self.stdout.write(f'{hasher.algorithm}: {count / elapsed:.1f} hashes/s, '
+                              f'{elapsed / count * 1000:.1f} ms per hash')
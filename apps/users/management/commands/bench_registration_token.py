@@ -0,0 +1,55 @@
+import time
+from datetime import datetime, timedelta
+
+import jwt
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.users.utils.token import encode_registration_token, decode_registration_token
+
+
+def jwt_encode(payload):
+    return jwt.encode(payload, settings.SECRET_KEY, algorithm='HS256')
+
+
+def jwt_decode(token, issuer, audience):
+    return jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'], issuer=issuer, audience=audience)
+
+
+class Command(BaseCommand):
+    help = 'Compare size and CPU cost of the registration token against a plain JWT'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', default=2000, type=int)
+
+    def handle(self, *args, **options):
+        payload = {
+            'account_type': 'personal',
+            'phone_number': '+99365123456',
+            'verified': True,
+            'first_name': 'Merdan',
+            'last_name': 'Amanov',
+            'gender': 'M',
+            'birthday': '2000-02-03',
+            'email': 'merdan.amanov@example.com',
+            'password': 'correct horse battery',
+            'exp': datetime.utcnow() + timedelta(seconds=settings.REGISTRATION_TOKEN_TIMEOUT),
+            'iat': datetime.utcnow(),
+            'iss': 'registration_password',
+            'aud': 'registration',
+        }
+
+        iterations = options['iterations']
+        for name, encode, decode in (
+            ('jwt', jwt_encode, jwt_decode),
+            ('registration token', encode_registration_token, decode_registration_token),
+        ):
+            # Every step decodes a token it hasn't seen, so the verified-token cache never hits
+            tokens = [encode({**payload, 'exp': payload['exp'] + timedelta(seconds=i)}) for i in range(iterations)]
+            started = time.perf_counter()
+            for token in tokens:
+                # A step decodes the previous token and signs the next one
+                decode(token, issuer='registration_password', audience='registration')
+                encode(payload)
+            elapsed = (time.perf_counter() - started) / iterations
+            self.stdout.write(f'{name}: {len(tokens[0])} bytes, {elapsed * 1000000:.1f} us per step')
@@ -0,0 +1,74 @@
+import time
+import uuid
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from apps.users.utils.dispatch import (LANES, SMSDispatcher, enqueue_sms, get_delivery_log, get_delivery_log_key,
+                                       get_dispatch_client)
+
+
+class FakeGateway:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def send(self, dest, text, msg_id=None):
+        time.sleep(self.latency)
+        return {'status_code': 200, 'content': b''}
+
+
+class Command(BaseCommand):
+    help = 'Load test the SMS dispatcher against a fake gateway'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', default=2000, type=int)
+        parser.add_argument('--otp-share', default=0.2, type=float)
+        parser.add_argument('--concurrency', default=20, type=int)
+        parser.add_argument('--batch-size', default=50, type=int)
+        parser.add_argument('--latency', default=20, type=float, help='Fake gateway latency in ms')
+
+    def handle(self, *args, **options):
+        # Its own namespace, the live queue and delivery log are never touched
+        client = get_dispatch_client()
+        namespace = f'sms-bench:{uuid.uuid4().hex}'
+        try:
+            self.run(client, namespace, options)
+        finally:
+            keys = list(client.scan_iter(match=f'{namespace}:*'))
+            if keys:
+                client.delete(*keys)
+
+    def run(self, client, namespace, options):
+        total = options['messages']
+        otp_every = round(1 / options['otp_share']) if options['otp_share'] else 0
+        dispatcher = SMSDispatcher(gateway=FakeGateway(options['latency'] / 1000), client=client,
+                                   batch_size=options['batch_size'], concurrency=options['concurrency'],
+                                   namespace=namespace)
+
+        async def run():
+            stop = asyncio.Event()
+            task = asyncio.create_task(dispatcher.run(stop))
+
+            # Messages keep arriving while the queue drains
+            for i in range(total):
+                lane = 'otp' if otp_every and i % otp_every == 0 else 'notification'
+                await asyncio.to_thread(enqueue_sms, f'+9936500{i:04d}', f'Load test {i}', lane, client, namespace)
+
+            while client.llen(get_delivery_log_key(namespace)) < total:
+                await asyncio.sleep(0.05)
+            stop.set()
+            await task
+
+        started = time.perf_counter()
+        asyncio.run(run())
+        elapsed = time.perf_counter() - started
+
+        records = get_delivery_log(total, client, namespace)
+        self.stdout.write(f'{total / elapsed:.0f} messages/s')
+        for lane in LANES:
+            latencies = sorted(record['sent_at'] - record['enqueued_at'] for record in records
+                               if record['lane'] == lane)
+            if latencies:
+                self.stdout.write(f'{lane}: {len(latencies)} messages, '
+                                  f'p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, '
+                                  f'p99 {latencies[int((len(latencies) - 1) * 0.99)] * 1000:.1f} ms')
@@ -0,0 +1,69 @@
+import time
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.core.management.base import BaseCommand
+
+from apps.users.utils.sms import SMSGateway
+
+
+class StubGatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, Nagle would delay keep-alive responses
+    disable_nagle_algorithm = True
+    latency = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency)
+        body = b'{"status":"ok"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = 'Measure SMS gateway client throughput against a local stub server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', default=500, type=int)
+        parser.add_argument('--concurrency', default=10, type=int)
+        parser.add_argument('--latency', default=5, type=float, help='Stub response latency in ms')
+
+    def handle(self, *args, **options):
+        StubGatewayHandler.latency = options['latency'] / 1000
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubGatewayHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        api_url = f'http://127.0.0.1:{server.server_port}/'
+        secret = base64.b64encode(b'bench-secret').decode()
+        messages = [(f'+9936500{i:04d}', f'Benchmark message {i}') for i in range(options['messages'])]
+        gateway = SMSGateway(api_url=api_url, user='bench', secret=secret, pool_size=options['concurrency'])
+
+        # The previous client, a new connection for every message
+        def unpooled(message):
+            dest, text = message
+            return requests.post(api_url + 'bench/send', data={'dest': dest, 'text': text})
+
+        def run(name, func):
+            started = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f'{name}: {len(messages) / elapsed:.0f} messages/s')
+
+        try:
+            with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+                run('requests.post', lambda: list(executor.map(unpooled, messages)))
+            run('pooled gateway', lambda: gateway.send_batch(messages))
+        finally:
+            server.shutdown()
+            server.server_close()
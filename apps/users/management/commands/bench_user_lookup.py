@@ -0,0 +1,101 @@
+import time
+import uuid
+import datetime
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from oauth2_provider.models import AccessToken, Application
+
+from apps.users.models import User
+from apps.users.utils.profile import get_profile_key, get_public_profile_key
+
+BENCH_EMAIL_DOMAIN = 'bench-user-lookup.example.com'
+BENCH_APPLICATION = 'bench-user-lookup'
+
+
+class Command(BaseCommand):
+    help = 'Compare resolving user ids one request per user with the bulk users/lookup endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ids', default=1000, type=int, help='User ids resolved per call')
+        parser.add_argument('--rounds', default=5, type=int)
+
+    def create_users(self, count):
+        users = [
+            User(id=uuid.uuid4(), email=f'user{i}@{BENCH_EMAIL_DOMAIN}', phone_number=f'+9936{i:07d}',
+                 first_name=f'Bench{i}', last_name='User', password='!')
+            for i in range(count)
+        ]
+        User.objects.bulk_create(users, batch_size=500)
+        return [str(user.pk) for user in users]
+
+    def create_token(self):
+        application = Application.objects.create(
+            name=BENCH_APPLICATION,
+            client_type=Application.CLIENT_CONFIDENTIAL,
+            authorization_grant_type=Application.GRANT_CLIENT_CREDENTIALS,
+        )
+        token = AccessToken.objects.create(
+            token=uuid.uuid4().hex, application=application, scope='profile.read users.lookup',
+            expires=timezone.now() + datetime.timedelta(hours=1),
+        )
+        return token.token
+
+    def cleanup(self):
+        AccessToken.objects.filter(application__name=BENCH_APPLICATION).delete()
+        Application.objects.filter(name=BENCH_APPLICATION).delete()
+        User.objects.filter(email__endswith=f'@{BENCH_EMAIL_DOMAIN}').delete()
+
+    def clear_cache(self, user_ids):
+        cache.delete_many([get_profile_key(user_id) for user_id in user_ids] +
+                          [get_public_profile_key(user_id) for user_id in user_ids])
+
+    def run_single(self, client, user_ids, headers):
+        size = 0
+        for user_id in user_ids:
+            response = client.post('/users/profiles', {'ids': [user_id]}, content_type='application/json',
+                                   headers=headers)
+            assert response.status_code == 200, response.status_code
+            size += len(response.content)
+        return size
+
+    def run_bulk(self, client, user_ids, headers):
+        response = client.post('/users/lookup', {'ids': user_ids}, content_type='application/json', headers=headers)
+        assert response.status_code == 200, response.status_code
+        return len(b''.join(response.streaming_content))
+
+    def measure(self, name, runner, client, user_ids, headers, rounds, cold):
+        timings = []
+        for _ in range(rounds):
+            if cold:
+                self.clear_cache(user_ids)
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                size = runner(client, user_ids, headers)
+                timings.append(time.perf_counter() - started)
+        timings.sort()
+        self.stdout.write(f'{name}: median {timings[len(timings) // 2] * 1000:.1f} ms, '
+                          f'{len(queries.captured_queries)} queries, {size / 1024:.1f} KiB')
+
+    def handle(self, *args, **options):
+        self.cleanup()
+        user_ids = self.create_users(options['ids'])
+        headers = {'Authorization': f'Bearer {self.create_token()}'}
+        client = Client()
+
+        try:
+            self.measure('One request per user, cold cache', self.run_single, client, user_ids, headers,
+                         1, cold=True)
+            self.measure('One request per user, warm cache', self.run_single, client, user_ids, headers,
+                         1, cold=False)
+            self.measure('Bulk lookup, cold cache', self.run_bulk, client, user_ids, headers,
+                         options['rounds'], cold=True)
+            self.measure('Bulk lookup, warm cache', self.run_bulk, client, user_ids, headers,
+                         options['rounds'], cold=False)
+        finally:
+            self.clear_cache(user_ids)
+            self.cleanup()
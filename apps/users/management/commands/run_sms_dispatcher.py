@@ -0,0 +1,30 @@
+import signal
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from apps.users.utils.dispatch import SMSDispatcher
+
+
+class Command(BaseCommand):
+    help = 'Drain the SMS dispatch queue, OTP messages first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument('--concurrency', type=int)
+        parser.add_argument('--worker', help='Stable name, a restart then requeues the messages left in flight '
+                                             'right away. Defaults to host and pid')
+
+    def handle(self, *args, **options):
+        dispatcher = SMSDispatcher(batch_size=options['batch_size'], concurrency=options['concurrency'],
+                                   worker=options['worker'])
+
+        async def run():
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, stop.set)
+            await dispatcher.run(stop)
+
+        self.stdout.write(f'SMS dispatcher {dispatcher.worker} started, concurrency {dispatcher.concurrency}')
+        asyncio.run(run())
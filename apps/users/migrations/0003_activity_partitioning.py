@@ -0,0 +1,104 @@
+# Generated by Django 5.0.2 on 2026-10-18 12:00
+
+from datetime import date
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+# The activity table becomes a table partitioned by month of `date`. PostgreSQL requires the partition
+# key in the primary key, so it is (id, date) in the database while Django keeps using `id` alone.
+# Monthly partitions are created here and then ahead of time by the create_activity_partitions task,
+# the default partition only catches rows outside them
+PARTITION_ACTIVITY_SQL = """
+ALTER TABLE users_activity RENAME TO users_activity_unpartitioned;
+ALTER INDEX users_activity_user_date_idx RENAME TO users_activity_unpartitioned_user_date_idx;
+ALTER SEQUENCE IF EXISTS users_activity_id_seq RENAME TO users_activity_unpartitioned_id_seq;
+
+CREATE SEQUENCE users_activity_id_seq;
+CREATE TABLE users_activity (
+    id bigint NOT NULL DEFAULT nextval('users_activity_id_seq'),
+    action varchar(20) NOT NULL,
+    ip_address inet NOT NULL,
+    date timestamp with time zone NOT NULL,
+    device_id bigint NULL REFERENCES users_device (id) DEFERRABLE INITIALLY DEFERRED,
+    user_id uuid NOT NULL REFERENCES users_user (id) DEFERRABLE INITIALLY DEFERRED,
+    PRIMARY KEY (id, date)
+) PARTITION BY RANGE (date);
+ALTER SEQUENCE users_activity_id_seq OWNED BY users_activity.id;
+CREATE INDEX users_activity_user_date_idx ON users_activity (user_id, date DESC, id DESC);
+CREATE INDEX users_activity_device_id ON users_activity (device_id);
+CREATE TABLE users_activity_default PARTITION OF users_activity DEFAULT;
+"""
+
+# Runs after the monthly partitions exist, a month partition can't be attached while the default
+# partition holds rows of that month
+COPY_ACTIVITY_SQL = """
+INSERT INTO users_activity (id, action, ip_address, date, device_id, user_id)
+    SELECT id, action, ip_address, date, device_id, user_id FROM users_activity_unpartitioned;
+SELECT setval('users_activity_id_seq', COALESCE((SELECT MAX(id) FROM users_activity), 0) + 1, false);
+DROP TABLE users_activity_unpartitioned;
+"""
+
+
+# Months partitioned ahead of the current one, later months are left to the create_activity_partitions task
+PARTITIONS_AHEAD = 2
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def create_partitions(schema_editor):
+    # Every month with existing rows and the months ahead, the DDL is frozen here instead of
+    # going through the current model and helpers
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT DISTINCT date_trunc('month', date AT TIME ZONE 'UTC')::date "
+                       "FROM users_activity_unpartitioned")
+        months = {row[0] for row in cursor.fetchall()}
+
+    current = django.utils.timezone.now().date().replace(day=1)
+    months.update(add_months(current, offset) for offset in range(PARTITIONS_AHEAD + 1))
+    for month in sorted(months):
+        schema_editor.execute(
+            f"CREATE TABLE users_activity_y{month.year}m{month.month:02d} PARTITION OF users_activity "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+        )
+
+
+def partition_activity(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for statement in PARTITION_ACTIVITY_SQL.split(';')[:-1]:
+        schema_editor.execute(statement)
+
+    create_partitions(schema_editor)
+
+    for statement in COPY_ACTIVITY_SQL.split(';')[:-1]:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_user_avatar_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='activity',
+            name='device',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='users.device'),
+        ),
+        migrations.AlterField(
+            model_name='activity',
+            name='date',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['user', '-date', '-id'], name='users_activity_user_date_idx'),
+        ),
+        migrations.RunPython(partition_activity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.0.2 on 2026-10-18 12:00
+
+import hashlib
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def fill_fingerprint_hashes(apps, schema_editor):
+    Device = apps.get_model('users', 'Device')
+    seen = set()
+    duplicates = []
+    devices = []
+    for device in Device.objects.order_by('id').iterator():
+        device.fingerprint_hash = hashlib.sha256(device.fingerprint.encode()).hexdigest()
+        key = (device.user_id, device.fingerprint_hash)
+        if key in seen:
+            duplicates.append(device.pk)
+            continue
+        seen.add(key)
+        devices.append(device)
+
+    # The oldest row of a device stays, activity of the others loses its device (SET_NULL)
+    Device.objects.filter(pk__in=duplicates).delete()
+    Device.objects.bulk_update(devices, ['fingerprint_hash'], batch_size=1000)
+
+    # Deferred foreign key checks left by the deletes would block the ALTER TABLE of the constraint
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_activity_partitioning'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='fingerprint_hash',
+            field=models.CharField(default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(fill_fingerprint_hashes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='device',
+            constraint=models.UniqueConstraint(fields=('user', 'fingerprint_hash'), name='users_device_user_fingerprint_uniq'),
+        ),
+    ]
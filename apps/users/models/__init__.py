@@ -1,3 +1,4 @@
 from .user import User
 from .activity import Activity
 from .device import Device
+from .notification import Notification
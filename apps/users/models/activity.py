@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 
@@ -19,6 +20,13 @@ class Activity(models.Model):
     action = models.CharField(max_length=20, choices=Activities)
 
     ip_address = models.GenericIPAddressField()
-    device = models.ForeignKey('Device', on_delete=models.RESTRICT)
+    device = models.ForeignKey('Device', on_delete=models.SET_NULL, null=True, blank=True)
 
-    date = models.DateTimeField(auto_now_add=True)
+    # Set when the event happens, rows are written later in batches by apps.users.utils.activity
+    date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        # On PostgreSQL the table is partitioned by month of `date`, see migration 0003
+        indexes = [
+            models.Index(fields=['user', '-date', '-id'], name='users_activity_user_date_idx'),
+        ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 
 class Device(models.Model):
@@ -7,3 +8,11 @@ class Device(models.Model):
     browser = models.CharField(max_length=20)
     os = models.CharField(max_length=20)
     fingerprint = models.CharField(max_length=500)
+    # Fixed-width digest of `fingerprint`, devices are looked up by it, see apps.fingerprint.utils.service
+    fingerprint_hash = models.CharField(max_length=64)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'fingerprint_hash'], name='users_device_user_fingerprint_uniq'),
+        ]
@@ -5,5 +5,11 @@ class Notification(models.Model):
     user = models.ForeignKey('User', on_delete=models.CASCADE)
     notification_type = models.CharField(max_length=100)
     message = models.TextField()
+    # Read flag, unread notifications have status False
     status = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'status', '-created_at', '-id'], name='users_notif_user_status_idx'),
+        ]
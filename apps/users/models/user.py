@@ -1,14 +1,12 @@
 import uuid
 
 from django.db import models
-from django.conf import settings
-from django.core.mail import send_mail
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
 from phonenumber_field import modelfields
 
 from apps.users.validators.auth import validate_name
-from ..utils.sms import SMS
+from ..utils.dispatch import enqueue_sms
 
 
 class UserManager(BaseUserManager):
@@ -41,6 +39,11 @@ class User(AbstractBaseUser, PermissionsMixin):
         FEMALE = "F", _("Female")
         NONE = "N", _("Not specified")
 
+    class AvatarStatuses(models.TextChoices):
+        READY = "ready", _("Ready")
+        PROCESSING = "processing", _("Processing")
+        FAILED = "failed", _("Failed")
+
     class Languages(models.TextChoices):
         ENGLISH = "en", _("English")
         RUSSIAN = "ru", _("Russian")
@@ -60,6 +63,7 @@ class User(AbstractBaseUser, PermissionsMixin):
     first_name = models.CharField(max_length=100, validators=[validate_name], null=True, blank=True)
     last_name = models.CharField(max_length=100, validators=[validate_name], null=True, blank=True)
     avatar = models.ImageField(upload_to='avatars/%Y/%m/%d', null=True, blank=True)
+    avatar_status = models.CharField(max_length=20, choices=AvatarStatuses, default=AvatarStatuses.READY)
     birthday = models.DateField(null=True, blank=True)
     gender = models.CharField(max_length=20, choices=Genders, default=Genders.NONE)
 
@@ -82,22 +86,18 @@ class User(AbstractBaseUser, PermissionsMixin):
         super().save(*args, **kwargs)
 
     def send_email(self, subject, message):
+        # Kept local, the tasks module imports the models
+        from apps.users.tasks import send_email
+
         try:
-            send_mail(
-                subject,
-                message,
-                settings.NOTIFIER_EMAIL,
-                [self.email],
-                fail_silently=False,
-            )
+            send_email.delay(self.email, subject, message)
             return True
         except Exception as e:
             return False
 
     def send_message(self, message):
-        sms_api = SMS(message, self.phone_number)
         try:
-            sms_api.send()
+            enqueue_sms(self.phone_number.as_e164, message)
             return True
         except Exception as e:
             return False
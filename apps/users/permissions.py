@@ -0,0 +1,11 @@
+from oauth2_provider.models import AbstractApplication
+from rest_framework.permissions import BasePermission
+
+
+class IsClientCredentialsToken(BasePermission):
+    # Tokens a service got for itself with the client credentials grant, not tokens issued for a user
+    def has_permission(self, request, view):
+        token = request.auth
+        application = getattr(token, 'application', None)
+        return (application is not None
+                and application.authorization_grant_type == AbstractApplication.GRANT_CLIENT_CREDENTIALS)
@@ -1,7 +1,11 @@
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+
+from apps.users.utils.revocation import RevocableRefreshToken
 
 
 class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
+    token_class = RevocableRefreshToken
+
     @classmethod
     def get_token(cls, user):
         token = super().get_token(user)
@@ -10,3 +14,7 @@ class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
         # token['custom_claim'] = user.custom_claim
 
         return token
+
+
+class CustomTokenRefreshSerializer(TokenRefreshSerializer):
+    token_class = RevocableRefreshToken
@@ -1,7 +1,6 @@
 from ipware import get_client_ip
 
 from django.conf import settings
-from django.core.cache import cache
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.utils.translation import gettext_lazy as _
 
@@ -10,6 +9,7 @@ from phonenumber_field import serializerfields
 
 from apps.users import MAX_VALUE, MIN_VALUE
 from apps.users import validate_name
+from apps.otp.utils.service import verify_code
 
 
 class VerificationSerializer(serializers.Serializer):
@@ -23,8 +23,7 @@ class VerificationSerializer(serializers.Serializer):
         required=False
     )
 
-    def validate(self, attrs):
-        code = attrs.get('code')
+    def check_token_claims(self, attrs):
         email = attrs.get('email')
         phone_number = attrs.get('phone_number')
 
@@ -43,16 +42,12 @@ class VerificationSerializer(serializers.Serializer):
         elif token_payload.get('phone_number') != phone_number:
             raise serializers.ValidationError({'phone_number': _('Invalid phone number')})
 
-        key = f'registration_code:{phone_number or email}'
-        verification_code = cache.get(key)
-
-        if not verification_code:
-            raise serializers.ValidationError({'code': _('Verification code is invalid or expired')})
+    def validate(self, attrs):
+        code = attrs.get('code')
+        self.check_token_claims(attrs)
 
-        if int(verification_code) != int(code):
+        if not code or not verify_code('registration', attrs.get('phone_number') or attrs.get('email'), code):
             raise serializers.ValidationError({'code': _('Verification code is invalid or expired')})
-        else:
-            cache.delete(key)
 
         return super().validate(attrs)
 
@@ -133,7 +128,7 @@ class UserSerializer(serializers.Serializer):
     password_confirmation = serializers.CharField(write_only=True)
 
     # SECURITY
-    two_factor_auth = serializers.BooleanField(default=False)
+    two_factor_auth = serializers.BooleanField(source='two_factor', default=False)
     recovery_email = serializers.EmailField(required=False)
 
     # PROFILE INFO
@@ -146,3 +141,33 @@ class UserSerializer(serializers.Serializer):
     # USER SETTINGS
     theme = serializers.ChoiceField(choices=THEMES, default='light')
     language = serializers.ChoiceField(choices=LANGUAGES, default='tk')
+
+
+class ActivitySerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    action = serializers.CharField()
+    ip_address = serializers.IPAddressField()
+    device = serializers.CharField(source='device.name', default=None)
+    date = serializers.DateTimeField()
+
+
+class NotificationSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    notification_type = serializers.CharField()
+    message = serializers.CharField()
+    read = serializers.BooleanField(source='status')
+    created_at = serializers.DateTimeField()
+
+
+class NotificationReadSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=100)
+
+
+class UserIdsSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.UUIDField(), allow_empty=False,
+                                max_length=settings.USER_PROFILE_BATCH_SIZE)
+
+
+class UserLookupSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.UUIDField(), allow_empty=False,
+                                max_length=settings.USER_LOOKUP_MAX_IDS)
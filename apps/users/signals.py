@@ -0,0 +1,58 @@
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.translation import gettext as _
+
+from apps.fingerprint.signals import new_device
+from apps.fingerprint.utils.service import register_device, invalidate_known_devices
+from apps.users.backends.auth import get_user_cache_key
+from apps.users.models import Activity, Device, Notification, User
+from apps.users.utils.activity import record_activity
+from apps.users.utils.notification import change_unread_count, notify, publish_notification
+from apps.users.utils.profile import invalidate_profile
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    cache.delete(get_user_cache_key(instance.pk))
+    invalidate_profile(instance.pk)
+
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+def invalidate_known_devices_cache(sender, instance, **kwargs):
+    invalidate_known_devices(instance.user_id)
+
+
+@receiver(user_logged_in)
+def record_login(sender, request, user, **kwargs):
+    device_id = register_device(request, user) if request is not None else None
+    record_activity(user, Activity.Activities.LOGIN, request, device=device_id)
+
+
+@receiver(user_logged_out)
+def record_logout(sender, request, user, **kwargs):
+    if user is not None:
+        record_activity(user, Activity.Activities.LOGOUT, request)
+
+
+@receiver(post_save, sender=Notification)
+def count_notification(sender, instance, created, **kwargs):
+    if created:
+        change_unread_count(instance.user_id, 1)
+        publish_notification(instance)
+
+
+@receiver(post_delete, sender=Notification)
+def uncount_notification(sender, instance, **kwargs):
+    if not instance.status:
+        change_unread_count(instance.user_id, -1)
+
+
+@receiver(new_device)
+def notify_new_device(sender, user, device, request, **kwargs):
+    # The device a user registers from is not news to them
+    if Device.objects.filter(user=user).exclude(pk=device.pk).exists():
+        notify(user, 'new_device', _('New sign-in from %(device)s') % {'device': device.name})
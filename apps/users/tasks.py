@@ -1,23 +1,116 @@
+import os
+import uuid
 import logging
+import contextlib
 
 from celery import shared_task
-from apps.users import SMS
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken
+
+from apps.users.models import User
+from apps.users.utils import activity
+from apps.users.utils.dispatch import enqueue_sms
+from apps.users.utils.mail import EmailBatchError, build_message, build_template_messages, send_messages
+from apps.users.utils.revocation import purge_revocation_log
+from apps.users.utils.user import (remove_expired_tmp_avatars, get_avatars_usage, get_tmp_avatars_usage,
+                                   open_avatar_upload, build_avatar_variants, save_avatar_variants, image_to_png)
 
 logger = logging.getLogger('celery')
 
 
+@shared_task(bind=True, max_retries=5, ignore_result=True)
+def send_email(self, email, subject, message):
+    try:
+        send_messages([build_message(email, subject, message)])
+    except EmailBatchError as e:
+        logger.warning('Sending email to %s failed: %s', email, e)
+        raise self.retry(exc=e.error, countdown=settings.EMAIL_RETRY_DELAY * 2 ** self.request.retries)
+
+
+@shared_task(bind=True, max_retries=5, ignore_result=True)
+def send_template_email(self, template_name, recipients, context):
+    # Bulk path for notifications, recipients are (email, language) pairs
+    try:
+        send_messages(build_template_messages(template_name, recipients, context))
+    except EmailBatchError as e:
+        logger.warning('Sending %s emails failed after %s of %s: %s', template_name, e.sent, len(recipients), e)
+        # Only the recipients that didn't get the email are retried
+        raise self.retry(args=(template_name, recipients[e.sent:], context), exc=e.error,
+                         countdown=settings.EMAIL_RETRY_DELAY * 2 ** self.request.retries)
+
+
+@shared_task(ignore_result=True)
+def send_sms(phone_number, message, lane='notification'):
+    # Messages are handed over to the dispatcher, deliveries end up in its log
+    enqueue_sms(phone_number, message, lane)
+
+
+@shared_task
+def cleanup_tmp_avatars():
+    removed = remove_expired_tmp_avatars(settings.AVATAR_TMP_MAX_AGE)
+    data = {'removed': removed, 'tmp': get_tmp_avatars_usage(), 'avatars': get_avatars_usage()}
+    logger.info('Avatar storage: %s', data)
+    return data
+
+
 @shared_task
-def send_email(email, subject, message):
-    return {'email': email, 'subject': subject, 'message': message}
+def purge_expired_tokens():
+    # Blacklisted rows go with their outstanding token (on_delete=CASCADE)
+    now = timezone.now()
+    expired = OutstandingToken.objects.filter(expires_at__lte=now)
+    removed = 0
+    while ids := list(expired.values_list('pk', flat=True)[:settings.TOKEN_PURGE_BATCH_SIZE]):
+        OutstandingToken.objects.filter(pk__in=ids).delete()
+        removed += len(ids)
+
+    log_removed = purge_revocation_log(settings.SIMPLE_JWT['REFRESH_TOKEN_LIFETIME'].total_seconds())
+    data = {'tokens': removed, 'revocation_log': log_removed}
+    logger.info('Purged expired tokens: %s', data)
+    return data
+
+
+@shared_task(ignore_result=True)
+def flush_activity_log():
+    flushed = activity.flush_activity()
+    if flushed:
+        logger.info('Flushed %s activity events', flushed)
 
 
 @shared_task
-def send_sms(phone_number, message):
-    sms = SMS(
-        text=message,
-        dest=phone_number
-    )
-    response = sms.send()
-    data = {'status_code': response.get('status_code'), 'message': response.get('content'), 'text': sms.text,
-            'phone_number': phone_number}
+def create_activity_partitions():
+    data = activity.create_activity_partitions()
+    logger.info('Activity partitions: %s', data)
     return data
+
+
+@shared_task
+def process_avatar(user_id, path):
+    try:
+        user = User.objects.get(pk=user_id)
+    except User.DoesNotExist:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        return None
+
+    try:
+        variants = build_avatar_variants(open_avatar_upload(path))
+
+        name = User.avatar.field.generate_filename(user, uuid.uuid4().hex + '.png')
+        name = default_storage.save(name, ContentFile(image_to_png(variants[settings.AVATAR_SIZE])))
+        save_avatar_variants(name, variants)
+
+        user.avatar.name = name
+        user.avatar_status = User.AvatarStatuses.READY
+    except Exception:
+        logger.exception('Error processing avatar of user %s', user_id)
+        user.avatar_status = User.AvatarStatuses.FAILED
+    finally:
+        # A retried task finds the upload already removed
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+    user.save(update_fields=['avatar', 'avatar_status', 'updated_at'])
+    return {'user_id': str(user_id), 'avatar': user.avatar.name, 'status': user.avatar_status}
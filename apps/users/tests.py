@@ -1,3 +1,988 @@
-from django.test import TestCase
+import io
+import base64
+import os
+import json
+import time
+import asyncio
+import datetime
+import smtplib
+import threading
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
+from django.core import mail
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import path
+from django.utils import timezone
+from PIL import Image
+
+import fakeredis
+import fakeredis.aioredis
+import jwt
+import requests
+from oauth2_provider.models import AccessToken, Application
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken
+from rest_framework_simplejwt.views import TokenRefreshView
+
+from apps.users.hashers import TunedArgon2PasswordHasher
+from apps.users.models import Activity, Notification, User
+from apps.users.tasks import process_avatar, send_email, send_template_email
+from apps.users.utils import activity, dispatch, hashing, notification, revocation
+from apps.users.utils.auth import (RegistrationTokenError, generate_token, generate_unique_email_suggestions,
+                                   verify_token)
+from apps.users.utils.jwks import get_jwks, get_token_backend
+from apps.users.utils.mail import EmailBatchError, build_message, send_messages
+from apps.users.utils.registration import REGISTRATION_STEPS, VerificationCodeStep
+from apps.users.utils.token import decode_registration_token, encode_registration_token
+from apps.users.utils.user import (AVATAR_PALETTE, AVATAR_VARIANT_FORMATS, avatar_to_base64, avatar_variant_name,
+                                   generate_avatar, get_default_avatar, get_glyph, remove_expired_tmp_avatars,
+                                   render_avatar_image, save_tmp_upload)
+from apps.users.utils.verifier import JWTVerifier
+from apps.users.utils.sms import CircuitBreaker, CircuitOpenError, SMSGateway, SMSGatewayError
+from apps.users.views.asynchronous import AsyncLogin, AsyncRegistration, AsyncVerification
+from apps.users.views.register import CustomLogin, CustomTokenRevokeView
+from apps.users.serializers.jwt import CustomTokenObtainPairSerializer
+
+EMAIL = 'tests@example.com'
+PASSWORD = 'correct horse battery staple'
+
+# Sync and async variants side by side, whichever ASYNC_AUTH_VIEWS picks for the project URLconf
+urlpatterns = [
+    path('sync/login', CustomLogin.as_view()),
+    path('async/login', AsyncLogin.as_view()),
+    path('async/verify', AsyncVerification.as_view()),
+    path('async/register', AsyncRegistration.as_view()),
+    path('token/refresh', TokenRefreshView.as_view()),
+    path('token/revoke', CustomTokenRevokeView.as_view()),
+]
+
+
+class RedisTestCase(TestCase):
+    def setUp(self):
+        # The aliases share one fake server, clearing one clears them all
+        caches['default'].clear()
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class LoginTestCase(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        revocation.revocation_filter = revocation.RevocationFilter()
+        self.user = User.objects.create(email=EMAIL, password=make_password(PASSWORD), first_name='Test',
+                                        last_name='User', phone_number='+99361234567')
+
+    def assertLoggedIn(self, response):
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['email'], EMAIL)
+        self.assertTrue(OutstandingToken.objects.filter(user=self.user).exists())
+        return data
+
+
+class LoginTests(LoginTestCase):
+    def test_sync_login(self):
+        self.assertLoggedIn(self.client.post('/sync/login', {'email': EMAIL, 'password': PASSWORD}))
+
+    async def test_async_login(self):
+        response = await self.async_client.post('/async/login', {'email': EMAIL, 'password': PASSWORD})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['email'], EMAIL)
+        self.assertTrue(await OutstandingToken.objects.filter(user=self.user).aexists())
+
+    def test_wrong_password(self):
+        self.assertEqual(self.client.post('/sync/login', {'email': EMAIL, 'password': 'wrong'}).status_code, 401)
+
+    async def test_async_wrong_password(self):
+        response = await self.async_client.post('/async/login', {'email': EMAIL, 'password': 'wrong'})
+        self.assertEqual(response.status_code, 401)
+
+    def test_revoked_refresh_token(self):
+        data = self.assertLoggedIn(self.client.post('/sync/login', {'email': EMAIL, 'password': PASSWORD}))
+        refresh = data['refresh_token']
+        self.assertEqual(self.client.post('/token/refresh', {'refresh': refresh}).status_code, 200)
+
+        response = self.client.post('/token/revoke', {'refresh': refresh},
+                                    headers={'Authorization': f'Bearer {data["access_token"]}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.post('/token/refresh', {'refresh': refresh}).status_code, 401)
+
+    def test_revocation_seen_by_another_process(self):
+        data = self.assertLoggedIn(self.client.post('/sync/login', {'email': EMAIL, 'password': PASSWORD}))
+        refresh = data['refresh_token']
+        self.client.post('/token/revoke', {'refresh': refresh}, headers={'Authorization': f'Bearer {data["access_token"]}'})
+
+        # A fresh filter only learns about the revocation from the shared log
+        revocation.revocation_filter = revocation.RevocationFilter()
+        self.assertEqual(self.client.post('/token/refresh', {'refresh': refresh}).status_code, 401)
+
+
+class EmailSuggestionTests(TestCase):
+    def suggest(self):
+        return generate_unique_email_suggestions('Aman', 'Amanov', datetime.date(2000, 1, 1))
+
+    def test_candidates_checked_in_one_query(self):
+        with self.assertNumQueries(1):
+            suggestions = self.suggest()
+        self.assertEqual(suggestions, ['amanamanov', 'amanamanov2000', 'amanamanov00', 'aman2000'])
+
+    def test_taken_candidates_are_skipped(self):
+        for number, email in enumerate(('amanamanov', 'amanamanov2000')):
+            User.objects.create(email=email, first_name='Aman', last_name='Amanov', phone_number=f'+9936100000{number}')
+        with self.assertNumQueries(1):
+            suggestions = self.suggest()
+        self.assertEqual(suggestions, ['amanamanov00', 'aman2000', 'aman00', 'amanovaman2000'])
+        self.assertEqual(self.suggest(), suggestions)
+
+
+class AvatarRenderingTests(TestCase):
+    def test_letter_on_palette_circle(self):
+        image = render_avatar_image('A', 3, 128)
+        self.assertEqual((image.mode, image.size), ('RGBA', (128, 128)))
+        # Transparent outside the circle, the background color inside it and the letter in white
+        self.assertEqual(image.getpixel((0, 0))[3], 0)
+        self.assertEqual(image.getpixel((64, 4)), (*AVATAR_PALETTE[3], 255))
+        self.assertIn((255, 255, 255, 255), [color for _, color in image.getcolors(128 * 128)])
+
+    def test_generated_avatar_is_png(self):
+        avatar = generate_avatar('A', 0)
+        self.assertEqual(avatar, generate_avatar('A', 0))
+        with Image.open(io.BytesIO(avatar)) as image:
+            self.assertEqual((image.format, image.mode, image.size),
+                             ('PNG', 'RGBA', (settings.AVATAR_SIZE, settings.AVATAR_SIZE)))
+        self.assertTrue(avatar_to_base64(avatar).startswith('data:image/png;base64,'))
+
+    def test_glyphs_come_from_the_atlas(self):
+        self.assertIs(get_glyph('Ş', 64), get_glyph('Ş', 64))
+        # Letters missing from the atlas are rendered on demand
+        self.assertEqual(get_glyph('ß', 64).size, (64, 64))
+        self.assertNotEqual(generate_avatar('ß', 0), generate_avatar('A', 0))
+
+
+class AvatarStorageTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        get_default_avatar.cache_clear()
+        self.addCleanup(get_default_avatar.cache_clear)
+
+    def test_default_avatar_is_stored_once(self):
+        name, avatar = get_default_avatar('A', 2)
+        self.assertTrue(name.startswith(settings.AVATAR_DEFAULTS_DIR))
+        with open(os.path.join(settings.MEDIA_ROOT, name), 'rb') as f:
+            self.assertEqual(f.read(), avatar)
+        for size in settings.AVATAR_VARIANT_SIZES:
+            for image_format in AVATAR_VARIANT_FORMATS:
+                self.assertTrue(os.path.exists(os.path.join(settings.MEDIA_ROOT,
+                                                            avatar_variant_name(name, size, image_format))))
+
+        # Another process renders the same avatar and finds the file already there
+        get_default_avatar.cache_clear()
+        self.assertEqual(get_default_avatar('A', 2)[0], name)
+        self.assertEqual(len(os.listdir(os.path.dirname(os.path.join(settings.MEDIA_ROOT, name)))),
+                         1 + len(settings.AVATAR_VARIANT_SIZES) * len(AVATAR_VARIANT_FORMATS))
+        self.assertNotEqual(get_default_avatar('A', 3)[0], name)
+
+    def register(self, email, phone_number):
+        token = generate_token({
+            'iss': 'registration_password', 'aud': ['registration'], 'account_type': 'personal',
+            'email': email, 'phone_number': phone_number, 'first_name': 'Aman', 'last_name': 'Amanov',
+            'birthday': '2000-01-01', 'gender': 'male', 'password': make_password(PASSWORD),
+        })
+        with mock.patch('apps.users.views.register.random_avatar_color_index', return_value=2):
+            response = self.client.get('/users/register', headers={settings.REGISTRATION_TOKEN_HEADER: token})
+        self.assertEqual(response.status_code, 200)
+        token = response[settings.REGISTRATION_TOKEN_HEADER]
+        response = self.client.post('/users/register', headers={settings.REGISTRATION_TOKEN_HEADER: token})
+        self.assertEqual(response.status_code, 201)
+        return User.objects.get(email=email)
+
+    def test_registered_users_share_the_avatar(self):
+        first = self.register('first@example.com', '+99361000001')
+        second = self.register('second@example.com', '+99361000002')
+        self.assertEqual(first.avatar.name, get_default_avatar('A', 2)[0])
+        self.assertEqual(second.avatar.name, first.avatar.name)
+        self.assertFalse(os.path.exists(os.path.join(settings.MEDIA_ROOT, 'tmp')))
+
+
+class RegistrationTokenCodecTests(TestCase):
+    def setUp(self):
+        self.payload = {
+            'account_type': 'personal', 'phone_number': '+99361234567', 'verified': True, 'first_name': 'Aman',
+            'birthday': '2000-01-01', 'iss': 'registration_profile_metadata', 'aud': ['registration_email'],
+            'exp': int(time.time()) + 60, 'custom': 'kept',
+        }
+
+    def test_round_trip(self):
+        token = encode_registration_token(self.payload)
+        self.assertEqual(decode_registration_token(token, audience='registration_email',
+                                                   issuer={'registration_profile_metadata'}), self.payload)
+        # Claim keys and step names are packed short
+        self.assertNotIn(b'registration', base64.urlsafe_b64decode(token.split('.')[0] + '=='))
+
+    def test_tampered_token(self):
+        body, signature = encode_registration_token(self.payload).split('.')
+        forged = base64.urlsafe_b64encode(
+            base64.urlsafe_b64decode(body + '==').replace(b'"personal"', b'"business"')).rstrip(b'=').decode()
+        with self.assertRaises(jwt.InvalidSignatureError):
+            decode_registration_token(f'{forged}.{signature}', audience='registration_email')
+        with self.assertRaises(jwt.DecodeError):
+            decode_registration_token(body, audience='registration_email')
+
+    def test_expiry_checked_on_cached_token(self):
+        token = encode_registration_token({**self.payload, 'exp': int(time.time()) + 1})
+        decode_registration_token(token, audience='registration_email')
+        with mock.patch('apps.users.utils.token.time.time', return_value=time.time() + 2):
+            with self.assertRaises(jwt.ExpiredSignatureError):
+                decode_registration_token(token, audience='registration_email')
+
+    def test_issuer_and_audience(self):
+        token = encode_registration_token(self.payload)
+        with self.assertRaises(jwt.InvalidIssuerError):
+            decode_registration_token(token, audience='registration_email', issuer='registration_password')
+        with self.assertRaises(jwt.InvalidAudienceError):
+            decode_registration_token(token, audience='registration_password')
+
+
+@override_settings(PASSWORD_HASHERS=['apps.users.hashers.TunedArgon2PasswordHasher',
+                                     'django.contrib.auth.hashers.MD5PasswordHasher'])
+class PasswordRehashTests(LoginTestCase):
+    def login(self, password=PASSWORD):
+        return self.client.post('/sync/login', {'email': EMAIL, 'password': password})
+
+    def assertUpgraded(self):
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith('argon2$argon2id$'))
+        self.assertFalse(TunedArgon2PasswordHasher().must_update(self.user.password))
+        self.assertTrue(check_password(PASSWORD, self.user.password))
+
+    def test_other_hasher_is_upgraded_on_login(self):
+        User.objects.filter(pk=self.user.pk).update(password=make_password(PASSWORD, hasher='md5'))
+        self.assertLoggedIn(self.login())
+        self.assertUpgraded()
+
+    def test_older_parameters_are_upgraded_on_login(self):
+        with mock.patch.object(TunedArgon2PasswordHasher, 'time_cost', 1):
+            User.objects.filter(pk=self.user.pk).update(password=make_password(PASSWORD))
+        self.assertLoggedIn(self.login())
+        self.assertUpgraded()
+
+    async def test_async_login_upgrades(self):
+        await User.objects.filter(pk=self.user.pk).aupdate(password=make_password(PASSWORD, hasher='md5'))
+        response = await self.async_client.post('/async/login', {'email': EMAIL, 'password': PASSWORD})
+        self.assertEqual(response.status_code, 200)
+        await sync_to_async(self.assertUpgraded)()
+
+    def test_wrong_password_keeps_the_hash(self):
+        password = self.user.password
+        self.assertEqual(self.login('wrong').status_code, 401)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.password, password)
+
+
+@override_settings(PASSWORD_HASHING_WORKERS=1, PASSWORD_HASHING_MAX_BACKLOG=1, PASSWORD_HASHING_TIMEOUT=5)
+class PasswordHashingPoolTests(LoginTestCase):
+    def setUp(self):
+        super().setUp()
+        # Threads stand in for the worker processes, the backlog accounting is the same
+        pool = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(pool.shutdown)
+        patcher = mock.patch.object(hashing, 'get_pool', return_value=pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def hold_pool(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        future = hashing.submit(release.wait)
+        return release, future
+
+    def test_full_backlog_is_shed(self):
+        release, future = self.hold_pool()
+        with self.assertRaises(hashing.HashingOverloaded):
+            hashing.make_password(PASSWORD)
+
+        release.set()
+        future.result()
+        self.assertTrue(check_password(PASSWORD, hashing.make_password(PASSWORD)))
+        self.assertEqual(hashing._backlog, 0)
+
+    @override_settings(PASSWORD_HASHING_MAX_BACKLOG=2, PASSWORD_HASHING_TIMEOUT=0.05)
+    def test_slow_pool_times_out(self):
+        self.hold_pool()
+        with self.assertRaises(hashing.HashingOverloaded):
+            hashing.make_password(PASSWORD)
+
+    def test_login_is_shed_with_retry_after(self):
+        self.hold_pool()
+        response = self.client.post('/sync/login', {'email': EMAIL, 'password': PASSWORD})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+    async def test_async_login_is_shed_with_retry_after(self):
+        self.hold_pool()
+        response = await self.async_client.post('/async/login', {'email': EMAIL, 'password': PASSWORD})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+    def test_login_through_the_pool(self):
+        self.assertLoggedIn(self.client.post('/sync/login', {'email': EMAIL, 'password': PASSWORD}))
+        self.assertEqual(hashing._backlog, 0)
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncRegistrationTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        get_default_avatar.cache_clear()
+        self.addCleanup(get_default_avatar.cache_clear)
+
+    async def verify(self, code_valid, data):
+        token = generate_token({'iss': 'registration_phone_number', 'aud': ['verification'],
+                                'phone_number': '+99361234567', 'exp': int(time.time()) + 60})
+        with mock.patch('apps.users.views.asynchronous.averify_code', return_value=code_valid) as verify_code:
+            response = await self.async_client.post('/async/verify', data, content_type='application/json',
+                                                    headers={settings.REGISTRATION_TOKEN_HEADER: token})
+        return response, verify_code
+
+    async def test_verification(self):
+        response, verify_code = await self.verify(True, {'phone_number': '+99361234567', 'code': 12345})
+        self.assertEqual(response.status_code, 202)
+        verify_code.assert_called_once_with('registration', '+99361234567', 12345)
+        payload = verify_token(response[settings.REGISTRATION_TOKEN_HEADER], ['verification'],
+                               'registration_profile_name')
+        self.assertEqual((payload['phone_number'], payload['verified']), ('+99361234567', True))
+
+    async def test_verification_rejects_wrong_code(self):
+        response, verify_code = await self.verify(False, {'phone_number': '+99361234567', 'code': 12345})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('code', response.json())
+        self.assertNotIn(settings.REGISTRATION_TOKEN_HEADER, response)
+
+    async def test_verification_rejects_another_number(self):
+        response, verify_code = await self.verify(True, {'phone_number': '+99361999999', 'code': 12345})
+        self.assertEqual(response.status_code, 400)
+        verify_code.assert_not_called()
+
+    async def test_verification_without_token(self):
+        response = await self.async_client.post('/async/verify', {'code': 12345}, content_type='application/json')
+        self.assertEqual((response.status_code, response.json()['reason']), (400, 'missing'))
+
+    async def register(self, email=EMAIL):
+        token = await sync_to_async(generate_token)({
+            'iss': 'registration_password', 'aud': ['registration'], 'account_type': 'personal',
+            'email': email, 'phone_number': '+99361234567', 'first_name': 'Aman', 'last_name': 'Amanov',
+            'birthday': '2000-01-01', 'gender': 'male', 'password': make_password(PASSWORD),
+        })
+        response = await self.async_client.get('/async/register', headers={settings.REGISTRATION_TOKEN_HEADER: token})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['data']['avatar'].startswith('data:image/png;base64,'))
+        token = response[settings.REGISTRATION_TOKEN_HEADER]
+        return token, await self.async_client.post('/async/register',
+                                                   headers={settings.REGISTRATION_TOKEN_HEADER: token})
+
+    async def test_registration(self):
+        token, response = await self.register()
+        self.assertEqual(response.status_code, 201)
+        user = await User.objects.aget(email=EMAIL)
+        self.assertTrue(user.avatar.name.startswith(settings.AVATAR_DEFAULTS_DIR))
+        self.assertTrue(await sync_to_async(user.check_password)(PASSWORD))
+
+        # The session is gone with the registration, the token can't register again
+        response = await self.async_client.post('/async/register', headers={settings.REGISTRATION_TOKEN_HEADER: token})
+        self.assertEqual((response.status_code, response.json()['reason']), (400, 'session_expired'))
+
+    async def test_registered_email(self):
+        await User.objects.acreate(email=EMAIL, first_name='Test', last_name='User', phone_number='+99361000001')
+        token, response = await self.register()
+        self.assertEqual(response.status_code, 409)
+
+
+def generate_key_pair():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption()).decode()
+    public = key.public_key().public_bytes(serialization.Encoding.PEM,
+                                           serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+    return private, public
+
+
+class SignedLoginTests(LoginTests):
+    # The same flows with tokens signed by a private key and verified against the JWKS
+    def setUp(self):
+        private, public = generate_key_pair()
+        settings_override = override_settings(JWT_PUBLIC_KEY=public, SIMPLE_JWT={
+            **settings.SIMPLE_JWT, 'ALGORITHM': 'RS256', 'SIGNING_KEY': private, 'VERIFYING_KEY': public,
+        })
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        for cache in (get_token_backend, get_jwks):
+            cache.cache_clear()
+            self.addCleanup(cache.cache_clear)
+        super().setUp()
+
+    def test_access_token_names_published_key(self):
+        data = self.assertLoggedIn(self.client.post('/sync/login', {'email': EMAIL, 'password': PASSWORD}))
+        access = data['access_token']
+        jwks = json.loads(get_jwks()[0])
+        self.assertEqual(jwt.get_unverified_header(access)['kid'], jwks['keys'][0]['kid'])
+
+        verifier = JWTVerifier('https://accounts.example.com/.well-known/jwks.json', algorithms=['RS256'])
+        with mock.patch.object(verifier, 'fetch_jwks', return_value=jwks):
+            self.assertEqual(verifier.verify(access)['user_id'], str(self.user.pk))
+
+            # Signed with the same key, but not usable as an access token
+            with self.assertRaisesMessage(jwt.InvalidTokenError, 'Invalid token type'):
+                verifier.verify(data['refresh_token'])
+
+
+class FakeGateway:
+    def __init__(self, fail=(), broken=()):
+        self.fail = set(fail)
+        self.broken = set(broken)
+        self.sent = []
+
+    def send(self, dest, text, msg_id=None):
+        if dest in self.fail:
+            raise SMSGatewayError('Rejected')
+        if dest in self.broken:
+            raise TypeError('Secret not configured')
+        self.sent.append(dest)
+        return {'status_code': 200, 'content': b''}
+
+
+class SMSDispatchTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.redis = dispatch.get_dispatch_client()
+
+    def dispatch(self, gateway, total, worker='test'):
+        dispatcher = dispatch.SMSDispatcher(gateway=gateway, client=self.redis, worker=worker)
+
+        async def run():
+            stop = asyncio.Event()
+            task = asyncio.create_task(dispatcher.run(stop))
+            while self.redis.llen(dispatch.get_delivery_log_key()) < total:
+                await asyncio.sleep(0.01)
+            stop.set()
+            await task
+
+        asyncio.run(run())
+
+    def test_otp_overtakes_notifications(self):
+        dispatch.enqueue_sms('+99361000001', 'Notification', 'notification', self.redis)
+        dispatch.enqueue_sms('+99361000002', 'Code', 'otp', self.redis)
+        batch = dispatch.pop_batch(self.redis, 1, 'test')
+        self.assertEqual([entry['lane'] for raw, entry in batch], ['otp'])
+
+    def test_delivered_messages_are_acknowledged(self):
+        dispatch.enqueue_sms('+99361000001', 'Delivered', 'notification', self.redis)
+        dispatch.enqueue_sms('+99361000002', 'Rejected', 'notification', self.redis)
+        gateway = FakeGateway(fail=['+99361000002'])
+        self.dispatch(gateway, 2)
+
+        self.assertEqual(gateway.sent, ['+99361000001'])
+        errors = {record['phone_number']: record['error'] for record in dispatch.get_delivery_log(client=self.redis)}
+        self.assertEqual(errors, {'+99361000001': None, '+99361000002': 'Rejected'})
+        self.assertEqual(self.redis.llen(dispatch.get_processing_key('test')), 0)
+
+    def test_unexpected_errors_are_logged(self):
+        dispatch.enqueue_sms('+99361000001', 'Broken', 'notification', self.redis)
+        dispatch.enqueue_sms('+99361000002', 'Delivered', 'notification', self.redis)
+        gateway = FakeGateway(broken=['+99361000001'])
+        with self.assertLogs(dispatch.logger, 'ERROR'):
+            self.dispatch(gateway, 2)
+
+        self.assertEqual(gateway.sent, ['+99361000002'])
+        errors = {record['phone_number']: record['error'] for record in dispatch.get_delivery_log(client=self.redis)}
+        self.assertEqual(errors['+99361000001'], 'TypeError: Secret not configured')
+        self.assertEqual(self.redis.llen(dispatch.get_processing_key('test')), 0)
+
+    def test_messages_of_dead_worker_are_redelivered(self):
+        for i in range(3):
+            dispatch.enqueue_sms(f'+9936100000{i}', f'Message {i}', 'notification', self.redis)
+        # Taken by a worker that dies before delivering them
+        dispatch.pop_batch(self.redis, 3, 'dead')
+
+        gateway = FakeGateway()
+        self.dispatch(gateway, 3)
+        self.assertEqual(gateway.sent, ['+99361000000', '+99361000001', '+99361000002'])
+        self.assertEqual(self.redis.llen(dispatch.get_processing_key('dead')), 0)
+
+    def test_namespaces_are_separate(self):
+        dispatch.enqueue_sms('+99361000001', 'Live', 'otp', self.redis)
+        dispatch.enqueue_sms('+99361000002', 'Load test', 'otp', self.redis, 'sms-bench:test')
+        batch = dispatch.pop_batch(self.redis, 10, 'test', 'sms-bench:test')
+        self.assertEqual([entry['message'] for raw, entry in batch], ['Load test'])
+        self.assertEqual(self.redis.llen(dispatch.get_lane_key('otp')), 1)
+
+
+class SMSGatewayTests(TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+        self.gateway = SMSGateway(api_url='https://sms.example.com/', user='user', secret='c2VjcmV0',
+                                  max_retries=1, breaker=self.breaker)
+        self.gateway.get_backoff = lambda attempt: 0
+
+    def test_transient_errors_are_retried(self):
+        with mock.patch.object(self.gateway, 'post', side_effect=requests.ConnectionError('Refused')) as post:
+            with self.assertRaises(SMSGatewayError):
+                self.gateway.send('+99361234567', 'Text')
+        self.assertEqual(post.call_count, 2)
+        self.assertIsNotNone(self.breaker.opened_at)
+
+    def test_other_request_errors_end_the_trial(self):
+        self.breaker.opened_at = 0
+        with mock.patch.object(self.gateway, 'post', side_effect=requests.exceptions.InvalidURL('Bad URL')) as post:
+            with self.assertRaises(SMSGatewayError):
+                self.gateway.send('+99361234567', 'Text')
+        self.assertEqual(post.call_count, 1)
+        self.assertFalse(self.breaker.trial)
+
+        # The next request after the reset timeout is let through as a new trial
+        response = mock.Mock(status_code=200, content=b'')
+        with mock.patch.object(self.gateway, 'post', return_value=response):
+            self.assertEqual(self.gateway.send('+99361234567', 'Text')['status_code'], 200)
+        self.assertIsNone(self.breaker.opened_at)
+
+    def test_unexpected_errors_end_the_trial(self):
+        self.breaker.opened_at = 0
+        with mock.patch.object(self.gateway, 'post', side_effect=ValueError('Bad secret')):
+            with self.assertRaises(ValueError):
+                self.gateway.send('+99361234567', 'Text')
+        self.assertFalse(self.breaker.trial)
+
+    def test_batch_returns_failures(self):
+        self.breaker.failure_threshold = 10
+        with mock.patch.object(self.gateway, 'post', side_effect=requests.exceptions.InvalidURL('Bad URL')):
+            results = self.gateway.send_batch([('+99361234567', 'Text'), ('+99361234568', 'Text')])
+        self.assertEqual([result['status_code'] for result in results], [None, None])
+
+    def test_open_circuit_rejects(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_request()
+
+
+class RegistrationStepTests(RedisTestCase):
+    def run_step(self, name, data, token=None):
+        request = mock.Mock(META={'REMOTE_ADDR': '127.0.0.1'}, headers={})
+        return REGISTRATION_STEPS[name].run(request, data, token)
+
+    def test_previous_steps_issue_tokens_for_the_step(self):
+        for step in REGISTRATION_STEPS.values():
+            for name in step.previous:
+                self.assertIn(step.name, REGISTRATION_STEPS[name].next)
+        self.assertEqual(REGISTRATION_STEPS['email'].previous, ('profile_metadata',))
+
+    def test_verification_code_step_is_abstract(self):
+        with self.assertRaises(TypeError):
+            VerificationCodeStep('code')
+
+    def run_password_step(self):
+        token = generate_token({'iss': 'registration_email', 'aud': ['registration_password'], 'email': EMAIL})
+        return self.run_step('password', {'password': PASSWORD, 'password_confirmation': PASSWORD}, token)
+
+    def assertPasswordStored(self, token):
+        self.assertNotIn('password', decode_registration_token(token, audience='registration'))
+        payload = verify_token(token, ['registration_password'], 'registration')
+        self.assertEqual(payload['email'], EMAIL)
+        self.assertTrue(check_password(PASSWORD, payload['password']))
+
+    @override_settings(REGISTRATION_STATE_STORE='token')
+    def test_password_hash_not_in_token(self):
+        token = self.run_password_step()
+        self.assertEqual(decode_registration_token(token, audience='registration')['email'], EMAIL)
+        self.assertPasswordStored(token)
+
+    @override_settings(REGISTRATION_STATE_STORE='cache')
+    def test_password_hash_in_session(self):
+        token = self.run_password_step()
+        self.assertNotIn('email', decode_registration_token(token, audience='registration'))
+        self.assertPasswordStored(token)
+
+    @override_settings(REGISTRATION_STATE_STORE='token')
+    def test_expired_password_session(self):
+        token = self.run_password_step()
+        caches['default'].clear()
+        with self.assertRaises(RegistrationTokenError):
+            verify_token(token, ['registration_password'], 'registration')
+
+    @override_settings(REGISTRATION_STATE_STORE='cache')
+    def test_replayed_token_cant_change_verified_state(self):
+        account_type = self.run_step('account_type', {'account_type': 'personal'})
+        phone_number = self.run_step('phone_number', {'phone_number': '+99361234567'}, account_type)
+        with mock.patch('apps.users.serializers.user.verify_code', return_value=True):
+            verification = self.run_step('verification', {'phone_number': '+99361234567', 'code': 12345},
+                                         phone_number)
+
+        # The account type token is still valid for the phone number step
+        replayed = self.run_step('phone_number', {'phone_number': '+99361999999'}, account_type)
+        self.assertNotIn('verified', verify_token(replayed, ['registration_phone_number'], 'verification'))
+
+        token = self.run_step('profile_name', {'first_name': 'Aman'}, verification)
+        payload = verify_token(token, ['registration_profile_name'], 'registration_profile_metadata')
+        self.assertEqual((payload['phone_number'], payload['verified']), ('+99361234567', True))
+
+    def test_token_of_another_step_is_refused(self):
+        token = self.run_step('account_type', {'account_type': 'personal'})
+        self.run_step('phone_number', {'phone_number': '+99361234567'}, token)
+        with self.assertRaises(RegistrationTokenError):
+            self.run_step('email', {'email': EMAIL}, token)
+
+
+class FailingConnection:
+    # Wraps the locmem backend, the send call number `fail_on` raises
+    def __init__(self, fail_on=None):
+        self.connection = mail.get_connection()
+        self.fail_on = fail_on
+        self.calls = []
+        self.opened = 0
+
+    def __enter__(self):
+        self.opened += 1
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def send_messages(self, messages):
+        self.calls.append(len(messages))
+        if len(self.calls) == self.fail_on:
+            raise smtplib.SMTPServerDisconnected('Connection lost')
+        return self.connection.send_messages(messages)
+
+
+@override_settings(EMAIL_BATCH_SIZE=2, EMAIL_DEFAULT_NOTIFIER='noreply@example.com')
+class EmailTests(TestCase):
+    def build_messages(self, count):
+        return [build_message(f'user{i}@example.com', 'Subject', 'Text') for i in range(count)]
+
+    def test_messages_are_sent_in_batches(self):
+        connection = FailingConnection()
+        self.assertEqual(send_messages(self.build_messages(5), connection), 5)
+        self.assertEqual(connection.opened, 3)
+        self.assertEqual(connection.calls, [1] * 5)
+        self.assertEqual(len(mail.outbox), 5)
+
+    def test_partial_failure_reports_sent_messages(self):
+        # Fails in the middle of the second batch
+        connection = FailingConnection(fail_on=4)
+        with self.assertRaises(EmailBatchError) as context:
+            send_messages(self.build_messages(5), connection)
+        self.assertEqual(context.exception.sent, 3)
+        self.assertIsInstance(context.exception.error, smtplib.SMTPServerDisconnected)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_template_email_retries_remaining_recipients(self):
+        recipients = [(f'user{i}@example.com', 'en') for i in range(5)]
+        failure = EmailBatchError(2, smtplib.SMTPServerDisconnected('Connection lost'))
+        with mock.patch('apps.users.tasks.send_messages', side_effect=[failure, 3]) as send:
+            send_template_email.apply(args=('verification_code', recipients, {'code': 12345}))
+
+        self.assertEqual(send.call_count, 2)
+        retried = [message.to[0] for message in send.call_args_list[1].args[0]]
+        self.assertEqual(retried, [email for email, language in recipients[2:]])
+
+    def test_email_retries(self):
+        failure = EmailBatchError(0, smtplib.SMTPServerDisconnected('Connection lost'))
+        with mock.patch('apps.users.tasks.send_messages', side_effect=[failure, 1]) as send:
+            result = send_email.apply(args=('user@example.com', 'Subject', 'Text'))
+        self.assertTrue(result.successful())
+        self.assertEqual(send.call_count, 2)
+
+    def test_email_gives_up_after_max_retries(self):
+        failure = EmailBatchError(0, smtplib.SMTPServerDisconnected('Connection lost'))
+        with mock.patch('apps.users.tasks.send_messages', side_effect=failure) as send:
+            result = send_email.apply(args=('user@example.com', 'Subject', 'Text'))
+        self.assertTrue(result.failed())
+        self.assertEqual(send.call_count, send_email.max_retries + 1)
+
+
+class AvatarTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create(email=EMAIL, first_name='Test', last_name='User',
+                                        phone_number='+99361234567', avatar_status=User.AvatarStatuses.PROCESSING)
+
+    def upload(self):
+        image = io.BytesIO()
+        Image.new('RGB', (300, 200), (200, 30, 30)).save(image, format='PNG')
+        return save_tmp_upload(SimpleUploadedFile('avatar.png', image.getvalue(), content_type='image/png'))
+
+    def test_avatar_is_processed(self):
+        path = self.upload()
+        process_avatar(str(self.user.pk), path)
+
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.avatar_status, User.AvatarStatuses.READY)
+        self.assertFalse(os.path.exists(path))
+
+    def test_missing_upload_fails_the_avatar(self):
+        path = self.upload()
+        os.remove(path)
+        process_avatar(str(self.user.pk), path)
+
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.avatar_status, User.AvatarStatuses.FAILED)
+
+    def test_missing_upload_of_deleted_user(self):
+        path = self.upload()
+        os.remove(path)
+        self.assertIsNone(process_avatar('00000000-0000-0000-0000-000000000000', path))
+
+    def test_variant_removed_after_lookup(self):
+        process_avatar(str(self.user.pk), self.upload())
+        self.user.refresh_from_db()
+        self.user.avatar.storage.delete(avatar_variant_name(self.user.avatar.name, 64, 'png'))
+
+        with mock.patch('apps.users.utils.user.default_storage.exists', return_value=True):
+            response = self.client.get(f'/users/{self.user.pk}/avatar', {'size': 64})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.user.avatar.read())
+
+    def test_missing_avatar_file(self):
+        User.objects.filter(pk=self.user.pk).update(avatar='avatars/missing.png')
+        self.assertEqual(self.client.get(f'/users/{self.user.pk}/avatar').status_code, 404)
+
+    def test_sweeper_keeps_pending_uploads(self):
+        path = self.upload()
+        expired = time.time() - 2 * 60 * 60
+        os.utime(path, (expired, expired))
+        remove_expired_tmp_avatars(60 * 60)
+        self.assertTrue(os.path.exists(path))
+
+
+class ActivityFlushTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(email=EMAIL, first_name='Test', last_name='User', phone_number='+99361234567')
+        self.redis = activity.get_activity_client()
+
+    def record(self, count):
+        for _ in range(count):
+            activity.record_activity(self.user, Activity.Activities.LOGIN, ip_address='127.0.0.1')
+
+    def test_flush(self):
+        self.record(5)
+        self.assertEqual(activity.flush_activity(batch_size=2), 5)
+        self.assertEqual(Activity.objects.filter(user=self.user).count(), 5)
+        self.assertFalse(self.redis.exists(activity.ACTIVITY_BUFFER_KEY, activity.ACTIVITY_PROCESSING_KEY))
+
+    def test_failed_batch_is_retried(self):
+        self.record(3)
+        with mock.patch.object(Activity.objects, 'bulk_create', side_effect=RuntimeError('Database gone')):
+            with self.assertRaises(RuntimeError):
+                activity.flush_activity(batch_size=2)
+        self.assertEqual(self.redis.llen(activity.ACTIVITY_PROCESSING_KEY), 2)
+
+        self.record(1)
+        self.assertEqual(activity.flush_activity(batch_size=2), 4)
+        self.assertEqual(Activity.objects.filter(user=self.user).count(), 4)
+
+    @override_settings(ACTIVITY_FLUSH_MAX_ATTEMPTS=2)
+    def test_failing_batch_is_dead_lettered(self):
+        self.record(2)
+        with mock.patch.object(Activity.objects, 'bulk_create', side_effect=RuntimeError('Bad row')):
+            with self.assertRaises(RuntimeError):
+                activity.flush_activity(batch_size=2)
+            with self.assertLogs(activity.logger, 'ERROR'):
+                self.assertEqual(activity.flush_activity(batch_size=2), 0)
+        self.assertEqual(self.redis.llen(activity.ACTIVITY_DEAD_LETTER_KEY), 2)
+
+        # Later events are written again, the next batch starts with a fresh count
+        self.record(1)
+        self.assertEqual(activity.flush_activity(batch_size=2), 1)
+        self.assertFalse(self.redis.exists(activity.ACTIVITY_BUFFER_KEY, activity.ACTIVITY_PROCESSING_KEY,
+                                           activity.ACTIVITY_ATTEMPTS_KEY))
+
+    def test_one_flush_at_a_time(self):
+        self.record(1)
+        lock = self.redis.lock(activity.ACTIVITY_FLUSH_LOCK_KEY, timeout=60)
+        lock.acquire()
+        self.assertEqual(activity.flush_activity(), 0)
+        lock.release()
+        self.assertEqual(activity.flush_activity(), 1)
+
+
+class NotificationTests(LoginTestCase):
+    def login(self, fingerprint):
+        return self.client.post('/sync/login', {'email': EMAIL, 'password': PASSWORD},
+                                headers={'X-Device-Fingerprint': fingerprint})
+
+    def test_counter_follows_created_and_deleted_notifications(self):
+        self.assertEqual(notification.get_unread_count(self.user.pk), 0)
+        created = Notification.objects.create(user=self.user, notification_type='test', message='Created')
+        notification.notify(self.user, 'test', 'Notified')
+        self.assertEqual(notification.get_unread_count(self.user.pk), 2)
+
+        created.delete()
+        self.assertEqual(notification.get_unread_count(self.user.pk), 1)
+        notification.mark_all_read(self.user.pk)
+        self.assertEqual(notification.get_unread_count(self.user.pk), 0)
+
+    def test_new_device_is_notified(self):
+        self.assertLoggedIn(self.login('first-device'))
+        self.assertLoggedIn(self.login('first-device'))
+        self.assertFalse(Notification.objects.filter(user=self.user).exists())
+
+        self.assertLoggedIn(self.login('second-device'))
+        self.assertEqual(list(Notification.objects.filter(user=self.user).values_list('notification_type', flat=True)),
+                         ['new_device'])
+        self.assertEqual(notification.get_unread_count(self.user.pk), 1)
+
+    def test_concurrent_logins_from_new_device_notify_once(self):
+        self.assertLoggedIn(self.login('first-device'))
+        # Both logins read the known devices before either of them registered the new one
+        with mock.patch('apps.fingerprint.utils.service.get_known_devices', side_effect=lambda user_id: {}):
+            self.assertLoggedIn(self.login('second-device'))
+            self.assertLoggedIn(self.login('second-device'))
+        self.assertEqual(self.user.devices.count(), 2)
+        self.assertEqual(Notification.objects.filter(user=self.user, notification_type='new_device').count(), 1)
+
+    async def test_notification_is_published(self):
+        with mock.patch.dict(notification.ASYNC_CONNECTION_CLASSES,
+                             {fakeredis.FakeConnection: fakeredis.aioredis.FakeConnection}):
+            client = notification.get_async_client()
+        pubsub = client.pubsub()
+        await pubsub.subscribe(notification.get_channel(self.user.pk))
+        await pubsub.get_message(timeout=1)
+
+        created = await sync_to_async(notification.notify)(self.user, 'test', 'Published')
+        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+        self.assertEqual(json.loads(message['data'])['data']['id'], created.pk)
+        await pubsub.aclose()
+        await client.aclose()
+
+    def test_async_client_connects_to_primary(self):
+        cache = {**settings.CACHES['default'], 'LOCATION': ['redis://primary:6379/3', 'redis://replica:6379/3']}
+        with override_settings(CACHES={**settings.CACHES, 'notifications': cache}, NOTIFICATION_CACHE='notifications'):
+            with mock.patch.dict(notification.ASYNC_CONNECTION_CLASSES,
+                                 {fakeredis.FakeConnection: fakeredis.aioredis.FakeConnection}):
+                client = notification.get_async_client()
+        kwargs = client.connection_pool.connection_kwargs
+        self.assertEqual((kwargs['host'], kwargs['db']), ('primary', 3))
+
+
+class OAuth2TestCase(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(email=EMAIL, first_name='Test', last_name='User', phone_number='+99361234567',
+                                        recovery_email='recovery@example.com')
+
+    def get_token(self, scope, grant_type=Application.GRANT_CLIENT_CREDENTIALS):
+        application = Application.objects.create(name='Service', client_type=Application.CLIENT_CONFIDENTIAL,
+                                                 authorization_grant_type=grant_type, user=self.user)
+        token = AccessToken.objects.create(
+            user=None if grant_type == Application.GRANT_CLIENT_CREDENTIALS else self.user,
+            application=application, token=f'token-{application.pk}', scope=scope,
+            expires=timezone.now() + datetime.timedelta(hours=1),
+        )
+        return {'Authorization': f'Bearer {token.token}'}
+
+
+class UserProfilesTests(OAuth2TestCase):
+    def post(self, headers, ids):
+        return self.client.post('/users/profiles', {'ids': ids}, content_type='application/json', headers=headers)
+
+    def test_service_reads_profiles(self):
+        missing = '00000000-0000-0000-0000-000000000000'
+        response = self.post(self.get_token('profile.read'), [str(self.user.pk), missing])
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['data'][str(self.user.pk)]['email'], EMAIL)
+        self.assertEqual(data['missing'], [missing])
+
+    def test_token_granted_by_a_user_is_refused(self):
+        headers = self.get_token('profile.read', Application.GRANT_AUTHORIZATION_CODE)
+        self.assertEqual(self.post(headers, [str(self.user.pk)]).status_code, 403)
+
+    def test_scope_is_required(self):
+        self.assertEqual(self.post(self.get_token('write'), [str(self.user.pk)]).status_code, 403)
+
+    def test_cached_profiles_are_reused(self):
+        headers = self.get_token('profile.read')
+        first = self.post(headers, [str(self.user.pk)]).json()['data']
+        with mock.patch.object(User.objects, 'filter', side_effect=AssertionError('Not cached')):
+            self.assertEqual(self.post(headers, [str(self.user.pk)]).json()['data'], first)
+
+
+class UserProfileTests(RedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(email=EMAIL, first_name='Test', last_name='User', phone_number='+99361234567')
+        access = CustomTokenObtainPairSerializer.get_token(self.user).access_token
+        self.headers = {'Authorization': f'Bearer {access}'}
+
+    def get(self, **headers):
+        return self.client.get('/users/me', headers={**self.headers, **headers})
+
+    def test_profile_with_etag(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data']['email'], EMAIL)
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        self.assertIn('Authorization', response['Vary'])
+
+        # The user and the profile come from the cache
+        with self.assertNumQueries(0):
+            response = self.get(if_none_match=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_changed_profile_gets_new_etag(self):
+        etag = self.get()['ETag']
+        self.user.first_name = 'Changed'
+        self.user.save()
+
+        response = self.get(if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['data']['first_name'], 'Changed')
+
+
+class UserLookupTests(OAuth2TestCase):
+    def post(self, headers, ids):
+        return self.client.post('/users/lookup', {'ids': ids}, content_type='application/json', headers=headers)
+
+    def test_service_resolves_ids(self):
+        missing = '00000000-0000-0000-0000-000000000000'
+        response = self.post(self.get_token('users.lookup'), [str(self.user.pk), missing, str(self.user.pk)])
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(data['fields'], ['first_name', 'last_name', 'avatar'])
+        self.assertEqual(data['users'], {str(self.user.pk): ['Test', 'User', None]})
+        self.assertEqual(data['missing'], [missing])
+
+    def test_token_granted_by_a_user_is_refused(self):
+        for grant_type in (Application.GRANT_AUTHORIZATION_CODE, Application.GRANT_PASSWORD):
+            headers = self.get_token('users.lookup', grant_type)
+            self.assertEqual(self.post(headers, [str(self.user.pk)]).status_code, 403)
+
+    def test_scope_is_required(self):
+        self.assertEqual(self.post(self.get_token('profile.read'), [str(self.user.pk)]).status_code, 403)
+
+    def test_without_token(self):
+        self.assertEqual(self.post({}, [str(self.user.pk)]).status_code, 401)
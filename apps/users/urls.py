@@ -1,15 +1,36 @@
+from django.conf import settings
 from django.urls import path
 from .views.register import *
+from .views.user import *
+from .views.notification import *
+from .views.asynchronous import AsyncVerification, AsyncRegistration, NotificationStream
+
+if settings.ASYNC_AUTH_VIEWS:
+    VerificationView, RegistrationView = AsyncVerification, AsyncRegistration
+else:
+    VerificationView, RegistrationView = Verification, Registration
 
 urlpatterns = [
-    path('auth/verify', Verification.as_view(), name="verification"),
+    path('auth/verify', VerificationView.as_view(), name="verification"),
 
-    path('register/steps/account_type', RegistrationAccountType.as_view(), name='register_account_type'),
-    path('register/steps/phone_number', RegistrationPhoneNumber.as_view(), name='register_phone_number'),
-    path('register/steps/profile_name', RegistrationProfileName.as_view(), name='register_profile_name'),
-    path('register/steps/profile_metadata', RegistrationProfileMetadata.as_view(), name='register_profile_metadata'),
+    path('register/steps', RegistrationSteps.as_view(), name='register_steps'),
     path('register/steps/email', RegistrationEmail.as_view(), name='register_email'),
-    path('register/steps/parent_email', RegistrationParentEmail.as_view(), name='register_parent_email'),
-    path('register/steps/password', RegistrationPassword.as_view(), name='register_password'),
-    path('register', Registration.as_view(), name='register')
+    path('register/steps/<slug:step>', RegistrationStepView.as_view(), name='register_step'),
+    path('register', RegistrationView.as_view(), name='register'),
+
+    path('me', UserProfile.as_view(), name='user_profile'),
+    path('profiles', UserProfiles.as_view(), name='user_profiles'),
+    path('lookup', UserLookup.as_view(), name='user_lookup'),
+    path('avatar', UserAvatar.as_view(), name='user_avatar'),
+    path('<uuid:pk>/avatar', UserAvatarVariant.as_view(), name='user_avatar_variant'),
+    path('activity', ActivityFeed.as_view(), name='user_activity'),
+
+    path('notifications', NotificationList.as_view(), name='notifications'),
+    path('notifications/unread', NotificationUnreadCount.as_view(), name='notifications_unread'),
+    path('notifications/read', NotificationRead.as_view(), name='notifications_read'),
+    path('notifications/read-all', NotificationReadAll.as_view(), name='notifications_read_all'),
 ]
+
+# Open streams hold a worker thread each under WSGI, so the stream is served by the ASGI deployment only
+if settings.ASYNC_AUTH_VIEWS:
+    urlpatterns.append(path('notifications/stream', NotificationStream.as_view(), name='notifications_stream'))
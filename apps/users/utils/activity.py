@@ -0,0 +1,186 @@
+import json
+import time
+import logging
+from datetime import date, datetime, timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+from django_redis import get_redis_connection
+from ipware import get_client_ip
+
+from apps.users.models import Activity, Device, User
+
+logger = logging.getLogger(__name__)
+
+# Events waiting to be written, recording one is a single RPUSH on the request path
+ACTIVITY_BUFFER_KEY = 'activity:buffer'
+# The batch being written, removed once it is committed. A flush that dies leaves it for the next one
+ACTIVITY_PROCESSING_KEY = 'activity:processing'
+# Failed writes of the batch in the processing list
+ACTIVITY_ATTEMPTS_KEY = 'activity:processing:attempts'
+# Batches that failed ACTIVITY_FLUSH_MAX_ATTEMPTS times, kept for inspection instead of blocking the buffer
+ACTIVITY_DEAD_LETTER_KEY = 'activity:dead'
+ACTIVITY_FLUSH_LOCK_KEY = 'activity:flush'
+
+# Moves up to ARGV[1] events from the head of the buffer (KEYS[1]) to the processing list (KEYS[2])
+TAKE_BATCH_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    redis.call('RPUSH', KEYS[2], unpack(items))
+end
+return items
+"""
+
+# Appends the processing list (KEYS[1]) to the dead letters (KEYS[2]) and resets its attempts (KEYS[3])
+DEAD_LETTER_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+if #items > 0 then
+    redis.call('RPUSH', KEYS[2], unpack(items))
+end
+redis.call('DEL', KEYS[1], KEYS[3])
+return #items
+"""
+
+
+def get_activity_client():
+    return get_redis_connection(settings.ACTIVITY_CACHE)
+
+
+def record_activity(user, action, request=None, ip_address=None, device=None):
+    if ip_address is None and request is not None:
+        ip_address, is_routable = get_client_ip(request)
+
+    entry = {
+        'user': str(user.pk),
+        'action': action,
+        'ip_address': ip_address or '0.0.0.0',
+        'device': device.pk if isinstance(device, Device) else device,
+        'date': time.time(),
+    }
+    size = get_activity_client().rpush(ACTIVITY_BUFFER_KEY, json.dumps(entry))
+
+    # A burst fills the buffer faster than the beat flushes it, the event that crosses the threshold kicks a flush
+    if size == settings.ACTIVITY_FLUSH_THRESHOLD:
+        from apps.users.tasks import flush_activity_log
+        flush_activity_log.delay()
+
+
+def take_batch(client, size):
+    # A batch left behind by a flush that died goes first
+    return (client.lrange(ACTIVITY_PROCESSING_KEY, 0, -1) or
+            client.eval(TAKE_BATCH_SCRIPT, 2, ACTIVITY_BUFFER_KEY, ACTIVITY_PROCESSING_KEY, size))
+
+
+def move_to_dead_letter(client):
+    return client.eval(DEAD_LETTER_SCRIPT, 3, ACTIVITY_PROCESSING_KEY, ACTIVITY_DEAD_LETTER_KEY, ACTIVITY_ATTEMPTS_KEY)
+
+
+def write_activities(raw, batch_size):
+    entries = [json.loads(item) for item in raw]
+
+    # Users and devices deleted since the event would fail the whole insert on their foreign keys
+    users = {str(pk) for pk in User.objects.filter(pk__in={e['user'] for e in entries}).values_list('pk', flat=True)}
+    devices = set(Device.objects.filter(pk__in={e['device'] for e in entries if e['device']})
+                  .values_list('pk', flat=True))
+
+    activities = [
+        Activity(
+            user_id=entry['user'],
+            action=entry['action'],
+            ip_address=entry['ip_address'],
+            device_id=entry['device'] if entry['device'] in devices else None,
+            date=datetime.fromtimestamp(entry['date'], tz=timezone.utc),
+        )
+        for entry in entries if entry['user'] in users
+    ]
+    Activity.objects.bulk_create(activities, batch_size=batch_size)
+    return len(activities)
+
+
+def flush_activity(batch_size=None):
+    # Events are written at least once, a flush that dies between the insert and removing
+    # its batch has the batch written again by the next flush
+    batch_size = batch_size or settings.ACTIVITY_FLUSH_BATCH_SIZE
+    client = get_activity_client()
+    flushed = 0
+
+    # One flush at a time, the processing list belongs to the lock holder
+    lock = client.lock(ACTIVITY_FLUSH_LOCK_KEY, timeout=settings.ACTIVITY_FLUSH_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return flushed
+
+    try:
+        while raw := take_batch(client, batch_size):
+            try:
+                flushed += write_activities(raw, batch_size)
+            except Exception:
+                # A batch that keeps failing, a bad row for one, would otherwise be retried forever
+                # while the buffer grows behind it
+                if client.incr(ACTIVITY_ATTEMPTS_KEY) < settings.ACTIVITY_FLUSH_MAX_ATTEMPTS:
+                    raise
+                logger.exception('Moved %s activity events to %s after %s failed writes', len(raw),
+                                 ACTIVITY_DEAD_LETTER_KEY, settings.ACTIVITY_FLUSH_MAX_ATTEMPTS)
+                move_to_dead_letter(client)
+            else:
+                client.delete(ACTIVITY_PROCESSING_KEY, ACTIVITY_ATTEMPTS_KEY)
+            lock.reacquire()
+    finally:
+        lock.release()
+
+    return flushed
+
+
+def get_partition_name(month):
+    return f'{Activity._meta.db_table}_y{month.year}m{month.month:02d}'
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def create_activity_partitions(months_ahead=None, retention_months=None):
+    # PostgreSQL only, elsewhere the table is a plain table with the same index
+    if connection.vendor != 'postgresql':
+        return {'created': [], 'dropped': []}
+
+    months_ahead = settings.ACTIVITY_PARTITIONS_AHEAD if months_ahead is None else months_ahead
+    retention_months = settings.ACTIVITY_RETENTION_MONTHS if retention_months is None else retention_months
+    table = Activity._meta.db_table
+    current = date.today().replace(day=1)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+            "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+            "WHERE parent.relname = %s", [table]
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+
+        created = []
+        for offset in range(months_ahead + 1):
+            month = add_months(current, offset)
+            name = get_partition_name(month)
+            if name in existing:
+                continue
+            cursor.execute(
+                f'CREATE TABLE "{name}" PARTITION OF "{table}" FOR VALUES FROM (%s) TO (%s)',
+                [month.isoformat(), add_months(month, 1).isoformat()]
+            )
+            created.append(name)
+
+        # Old months are dropped whole instead of deleted row by row
+        dropped = []
+        if retention_months:
+            oldest = get_partition_name(add_months(current, -retention_months))
+            for name in sorted(existing):
+                if name.startswith(f'{table}_y') and name < oldest:
+                    with transaction.atomic():
+                        cursor.execute(f'ALTER TABLE "{table}" DETACH PARTITION "{name}"')
+                        cursor.execute(f'DROP TABLE "{name}"')
+                    dropped.append(name)
+
+    return {'created': created, 'dropped': dropped}
+
@@ -1,13 +1,22 @@
 import jwt
 import datetime
-from random import randint, choice
+from random import Random, randint
 from django.conf import settings
 from datetime import datetime, timedelta
 
 from unidecode import unidecode
+from rest_framework import status
+from rest_framework.exceptions import APIException
 
 from apps.users import User
 from apps.users import MIN_VALUE, MAX_VALUE
+from apps.users.utils.token import encode_registration_token, decode_registration_token
+from apps.users.utils.session import (uses_registration_session, has_registration_session, save_registration_session,
+                                      load_registration_session, asave_registration_session,
+                                      aload_registration_session)
+
+EMAIL_SUGGESTIONS_COUNT = 4
+EMAIL_SUGGESTIONS_RANDOM_CANDIDATES = 16
 
 
 def generate_verification_code():
@@ -16,37 +25,80 @@ def generate_verification_code():
 
 
 def generate_token(payload):
-    token = jwt.encode(payload, settings.SECRET_KEY, algorithm='HS256')
+    if uses_registration_session(payload):
+        payload = save_registration_session(payload)
+    token = encode_registration_token(payload)
     return token
 
 
-def decode_token(token, **kwargs):
+async def agenerate_token(payload):
+    if uses_registration_session(payload):
+        payload = await asave_registration_session(payload)
+    return encode_registration_token(payload)
+
+
+def _load_payload(payload):
+    if has_registration_session(payload):
+        return load_registration_session(payload)
+    return payload
+
+
+TOKEN_ERROR_REASONS = (
+    (jwt.ExpiredSignatureError, 'expired'),
+    (jwt.InvalidIssuerError, 'invalid_issuer'),
+    (jwt.InvalidAudienceError, 'invalid_audience'),
+    (jwt.InvalidSignatureError, 'invalid_signature'),
+    (jwt.InvalidTokenError, 'malformed'),
+)
+
+
+class RegistrationTokenError(APIException):
+    status_code = status.HTTP_400_BAD_REQUEST
+    default_code = 'invalid_token'
+
+    def __init__(self, reason, message='invalid token'):
+        self.reason = reason
+        super().__init__({'status': 'error', 'message': message, 'reason': reason})
+
+
+def _verify_claims(token, issuers, audience):
+    # Signature and expiry are verified once, then the issuer is checked against the whole set
     try:
-        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'], **kwargs)
-        return payload
-    except jwt.ExpiredSignatureError:
-        return None
-    except jwt.InvalidTokenError:
-        return None
+        return decode_registration_token(token, issuer=frozenset(issuers), audience=audience)
+    except jwt.InvalidTokenError as e:
+        reason = next(reason for error, reason in TOKEN_ERROR_REASONS if isinstance(e, error))
+        raise RegistrationTokenError(reason)
+
+
+def verify_token(token, issuers, audience=None):
+    payload = _load_payload(_verify_claims(token, issuers, audience))
+    if payload is None:
+        raise RegistrationTokenError('session_expired')
+    return payload
 
 
-def decode_token_with_issuer(token, issuers, **kwargs):
-    for issuer in issuers:
-        try:
-            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=['HS256'], issuer=issuer, **kwargs)
-            return payload
-        except jwt.ExpiredSignatureError:
-            return None
-        except jwt.InvalidIssuerError:
-            return None
-        except jwt.InvalidTokenError:
-            return None
+async def averify_token(token, issuers, audience=None):
+    payload = _verify_claims(token, issuers, audience)
+    if has_registration_session(payload):
+        payload = await aload_registration_session(payload)
+    if payload is None:
+        raise RegistrationTokenError('session_expired')
+    return payload
 
 
-def email_exists(email):
-    if User.objects.filter(email=email).exists():
-        return True
-    return False
+def _get_token_header(request):
+    token = request.headers.get(settings.REGISTRATION_TOKEN_HEADER)
+    if not token:
+        raise RegistrationTokenError('missing', 'token not given')
+    return token
+
+
+def get_registration_token(request, issuers, audience=None):
+    return verify_token(_get_token_header(request), issuers, audience)
+
+
+async def aget_registration_token(request, issuers, audience=None):
+    return await averify_token(_get_token_header(request), issuers, audience)
 
 
 def generate_unique_email_suggestions(first_name, last_name, birthday):
@@ -96,13 +148,21 @@ def generate_unique_email_suggestions(first_name, last_name, birthday):
     additional_suggestions = [f"{''.join(combination)}" for combination in additional_suggestions]
     random_suggestions = [f"{''.join(combination)}" for combination in random_suggestions]
 
-    unique_suggestions = [email for email in primary_suggestions + additional_suggestions if
-                          not email_exists(email)][:4]
-
-    while len(unique_suggestions) < 4:
-        random_suggestion_prefix = choice(random_suggestions)
-        random_suggestion = f'{random_suggestion_prefix}{randint(1, 99)}'
-        if not email_exists(random_suggestion):
-            unique_suggestions.append(random_suggestion)
+    # Random fallbacks are seeded from the input, so the same person always gets the same
+    # suggestions and every candidate can be checked up front in a single query.
+    rnd = Random(f'{first_name}:{last_name}:{birthday.isoformat()}')
+    random_candidates = [f'{rnd.choice(random_suggestions)}{rnd.randint(1, 99)}'
+                         for _ in range(EMAIL_SUGGESTIONS_RANDOM_CANDIDATES)]
+
+    candidates = list(dict.fromkeys(primary_suggestions + additional_suggestions + random_candidates))
+    taken = set(User.objects.filter(email__in=candidates).values_list('email', flat=True))
+
+    unique_suggestions = [email for email in dict.fromkeys(primary_suggestions + additional_suggestions)
+                          if email not in taken][:EMAIL_SUGGESTIONS_COUNT]
+    for email in random_candidates:
+        if len(unique_suggestions) >= EMAIL_SUGGESTIONS_COUNT:
+            break
+        if email not in taken and email not in unique_suggestions:
+            unique_suggestions.append(email)
 
     return unique_suggestions
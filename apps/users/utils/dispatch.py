@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from apps.users.utils.sms import SMSGatewayError, CircuitOpenError, get_gateway
+
+logger = logging.getLogger(__name__)
+
+# Lanes in priority order, a lane is drained only while the lanes before it are empty
+LANES = ('otp', 'notification')
+
+# Every key of the queue lives under a namespace, load tests run in their own
+NAMESPACE = 'sms'
+
+# Moves up to ARGV[1] messages, lanes (KEYS[2..]) in priority order, into the worker's processing list
+# (KEYS[1]) in one step. A message stays there until its delivery is logged, so a crashed worker's
+# messages can be put back
+POP_SCRIPT = """
+local batch = {}
+local size = tonumber(ARGV[1])
+for i = 2, #KEYS do
+    while #batch < size do
+        local item = redis.call('LMOVE', KEYS[i], KEYS[1], 'RIGHT', 'LEFT')
+        if not item then
+            break
+        end
+        batch[#batch + 1] = item
+    end
+end
+return batch
+"""
+
+# Puts a processing list back at the popping end of the lanes. Newest first, so the oldest message
+# ends up being popped first
+RECOVER_SCRIPT = """
+local count = 0
+while true do
+    local item = redis.call('LPOP', KEYS[1])
+    if not item then
+        return count
+    end
+    redis.call('RPUSH', ARGV[1] .. cjson.decode(item)['lane'], item)
+    count = count + 1
+end
+"""
+
+
+def get_lane_key(lane, namespace=NAMESPACE):
+    return f'{namespace}:queue:{lane}'
+
+
+def get_delivery_log_key(namespace=NAMESPACE):
+    return f'{namespace}:deliveries'
+
+
+def get_processing_key(worker, namespace=NAMESPACE):
+    return f'{namespace}:processing:{worker}'
+
+
+def get_heartbeat_key(worker, namespace=NAMESPACE):
+    return f'{namespace}:worker:{worker}'
+
+
+def get_dispatch_client():
+    return get_redis_connection(settings.SMS_DISPATCH_CACHE)
+
+
+def enqueue_sms(phone_number, message, lane='notification', client=None, namespace=NAMESPACE):
+    entry = {
+        'id': uuid.uuid4().hex,
+        'lane': lane,
+        'phone_number': phone_number,
+        'message': message,
+        'enqueued_at': time.time(),
+    }
+    (client or get_dispatch_client()).lpush(get_lane_key(lane, namespace), json.dumps(entry))
+    return entry['id']
+
+
+def pop_batch(client, size, worker, namespace=NAMESPACE):
+    # (raw message, entry) pairs, the raw message is what acknowledges it later
+    keys = [get_processing_key(worker, namespace)] + [get_lane_key(lane, namespace) for lane in LANES]
+    return [(raw, json.loads(raw)) for raw in client.eval(POP_SCRIPT, len(keys), *keys, size)]
+
+
+def requeue(client, raw, entry, worker, namespace=NAMESPACE):
+    # Pushed to the popping end, so the message goes out first once the gateway is back
+    pipe = client.pipeline(transaction=True)
+    pipe.rpush(get_lane_key(entry['lane'], namespace), raw)
+    pipe.lrem(get_processing_key(worker, namespace), 1, raw)
+    pipe.execute()
+
+
+def recover(client, worker, namespace=NAMESPACE):
+    return client.eval(RECOVER_SCRIPT, 1, get_processing_key(worker, namespace), get_lane_key('', namespace))
+
+
+def recover_dead_workers(client, namespace=NAMESPACE):
+    # Processing lists whose worker stopped sending heartbeats go back to the lanes
+    recovered = 0
+    prefix = get_processing_key('', namespace)
+    for key in client.scan_iter(match=f'{prefix}*'):
+        worker = key.decode()[len(prefix):]
+        if not client.exists(get_heartbeat_key(worker, namespace)):
+            recovered += recover(client, worker, namespace)
+    return recovered
+
+
+def write_delivery_log(client, records, raws=(), worker=None, namespace=NAMESPACE):
+    # A capped list instead of the Celery result backend, message texts are not kept. The logged
+    # messages are acknowledged in the same round trip
+    key = get_delivery_log_key(namespace)
+    pipe = client.pipeline(transaction=False)
+    pipe.lpush(key, *[json.dumps(record) for record in records])
+    pipe.ltrim(key, 0, settings.SMS_DELIVERY_LOG_SIZE - 1)
+    for raw in raws:
+        pipe.lrem(get_processing_key(worker, namespace), 1, raw)
+    pipe.execute()
+
+
+def get_delivery_log(limit=100, client=None, namespace=NAMESPACE):
+    client = client or get_dispatch_client()
+    return [json.loads(raw) for raw in client.lrange(get_delivery_log_key(namespace), 0, limit - 1)]
+
+
+class SMSDispatcher:
+    # Delivery is at least once: a message stays in the worker's processing list until its delivery
+    # is logged, a worker that dies after sending but before logging has it sent again
+    def __init__(self, gateway=None, client=None, batch_size=None, concurrency=None, worker=None,
+                 namespace=NAMESPACE):
+        self.gateway = gateway or get_gateway()
+        self.client = client or get_dispatch_client()
+        self.batch_size = batch_size or settings.SMS_DISPATCH_BATCH_SIZE
+        self.concurrency = concurrency or settings.SMS_DISPATCH_CONCURRENCY
+        self.worker = worker or f'{socket.gethostname()}-{os.getpid()}'
+        self.namespace = namespace
+        self.records = []
+        self.acks = []
+        self.heartbeat_at = 0
+
+    def heartbeat(self):
+        now = time.monotonic()
+        if now - self.heartbeat_at < settings.SMS_DISPATCH_HEARTBEAT:
+            return
+        self.client.set(get_heartbeat_key(self.worker, self.namespace), 1, ex=settings.SMS_DISPATCH_HEARTBEAT * 3)
+        self.heartbeat_at = now
+
+        # Workers that stopped sending heartbeats had their messages in flight, those go back to the lanes
+        recovered = recover_dead_workers(self.client, self.namespace)
+        if recovered:
+            logger.warning('Requeued %s undelivered SMS', recovered)
+
+    async def deliver(self, loop, executor, raw, entry):
+        record = {'id': entry['id'], 'lane': entry['lane'], 'phone_number': entry['phone_number'],
+                  'enqueued_at': entry['enqueued_at'], 'status_code': None, 'error': None}
+        try:
+            response = await loop.run_in_executor(
+                executor, self.gateway.send, entry['phone_number'], entry['message'], entry['id']
+            )
+            record['status_code'] = response.get('status_code')
+        except CircuitOpenError as e:
+            # Holding the slot while waiting slows the whole dispatcher down until the gateway recovers
+            await loop.run_in_executor(None, requeue, self.client, raw, entry, self.worker, self.namespace)
+            await asyncio.sleep(e.retry_after)
+            return
+        except SMSGatewayError as e:
+            logger.warning('SMS %s to %s failed: %s', entry['id'], entry['phone_number'], e)
+            record['error'] = str(e)
+        except Exception as e:
+            # A bug or a misconfigured gateway, requeueing would fail the same way. The message is logged
+            # as failed, otherwise it would sit in the processing list until the worker dies
+            logger.exception('SMS %s to %s failed', entry['id'], entry['phone_number'])
+            record['error'] = f'{type(e).__name__}: {e}'
+
+        record['sent_at'] = time.time()
+        self.records.append(record)
+        self.acks.append(raw)
+
+    async def flush(self, loop):
+        records, self.records = self.records, []
+        acks, self.acks = self.acks, []
+        if records:
+            await loop.run_in_executor(None, write_delivery_log, self.client, records, acks, self.worker,
+                                       self.namespace)
+
+    async def run(self, stop=None):
+        stop = stop or asyncio.Event()
+        loop = asyncio.get_running_loop()
+        pending = set()
+
+        # Messages left by an earlier run under the same worker name go back to the lanes
+        recovered = await loop.run_in_executor(None, recover, self.client, self.worker, self.namespace)
+        if recovered:
+            logger.warning('Requeued %s undelivered SMS', recovered)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while not stop.is_set():
+                pending = {task for task in pending if not task.done()}
+                if len(pending) >= self.concurrency:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                await self.flush(loop)
+                await loop.run_in_executor(None, self.heartbeat)
+
+                # Only as many messages as there are free slots are taken, the rest stay
+                # queued where a later OTP can still overtake them
+                size = min(self.batch_size, self.concurrency - len(pending))
+                batch = await loop.run_in_executor(None, pop_batch, self.client, size, self.worker, self.namespace)
+                for raw, entry in batch:
+                    pending.add(asyncio.create_task(self.deliver(loop, executor, raw, entry)))
+
+                # Lanes can't be waited on together without losing their priority, an idle
+                # dispatcher polls them instead
+                if not batch and not pending:
+                    await asyncio.sleep(settings.SMS_DISPATCH_IDLE_INTERVAL)
+                elif not batch:
+                    await asyncio.wait(pending, timeout=settings.SMS_DISPATCH_IDLE_INTERVAL,
+                                       return_when=asyncio.FIRST_COMPLETED)
+
+            if pending:
+                await asyncio.wait(pending)
+            await self.flush(loop)
+            await loop.run_in_executor(None, self.client.delete, get_heartbeat_key(self.worker, self.namespace))
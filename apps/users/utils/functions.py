@@ -1,3 +1,7 @@
+import base64
+from datetime import datetime
+
+from rest_framework import serializers
 from rest_framework.response import Response
 
 
@@ -17,3 +21,25 @@ def build_response(status, message, http_status, additional_data=None):
     data = {'status': status, 'message': message, **additional_data}
     return Response(status=http_status, data=data)
 
+
+
+def get_page_size(request, default, maximum):
+    try:
+        return max(min(int(request.GET.get('limit', default)), maximum), 1)
+    except ValueError:
+        return default
+
+
+# Keyset pagination cursors, the (timestamp, id) of the last row of a page
+def encode_cursor(moment, pk):
+    value = f'{moment.isoformat()}|{pk}'
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        moment, pk = value.split('|')
+        return datetime.fromisoformat(moment), int(pk)
+    except ValueError:
+        raise serializers.ValidationError({'status': 'error', 'message': 'Invalid cursor'})
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import django
+from django.conf import settings
+from django.contrib.auth import hashers
+
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+_pool = None
+_backlog = 0
+_lock = threading.Lock()
+
+
+class HashingOverloaded(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_code = 'hashing_overloaded'
+    # Sent as the Retry-After header by the DRF exception handler
+    wait = 1
+
+    def __init__(self):
+        super().__init__({'status': 'error', 'message': 'Server is busy, try again later'})
+
+
+def _check_password(password, encoded):
+    # Runs in the pool, returns whether the hash has to be upgraded along with the result
+    if not hashers.check_password(password, encoded):
+        return False, False
+    preferred = hashers.get_hasher('default')
+    hasher = hashers.identify_hasher(encoded)
+    return True, hasher.algorithm != preferred.algorithm or preferred.must_update(encoded)
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=settings.PASSWORD_HASHING_WORKERS, initializer=django.setup)
+    return _pool
+
+
+def _release(future):
+    global _backlog
+    with _lock:
+        _backlog -= 1
+
+
+def submit(func, *args):
+    # Hashes waiting or running in this process are limited, past the limit requests are
+    # rejected right away instead of holding a request thread until the pool catches up
+    global _backlog
+    with _lock:
+        if _backlog >= settings.PASSWORD_HASHING_MAX_BACKLOG:
+            raise HashingOverloaded()
+        _backlog += 1
+
+    try:
+        future = get_pool().submit(func, *args)
+    except Exception:
+        _release(None)
+        raise
+    future.add_done_callback(_release)
+    return future
+
+
+def run(func, *args):
+    if not settings.PASSWORD_HASHING_WORKERS:
+        return func(*args)
+
+    future = submit(func, *args)
+    try:
+        return future.result(timeout=settings.PASSWORD_HASHING_TIMEOUT)
+    except TimeoutError:
+        future.cancel()
+        raise HashingOverloaded()
+
+
+async def arun(func, *args):
+    # Under ASGI the event loop awaits the pool instead of blocking a thread on the result
+    loop = asyncio.get_running_loop()
+    if not settings.PASSWORD_HASHING_WORKERS:
+        return await loop.run_in_executor(None, func, *args)
+
+    future = submit(func, *args)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), settings.PASSWORD_HASHING_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HashingOverloaded()
+
+
+def check_password(password, encoded):
+    return run(_check_password, password, encoded)
+
+
+async def acheck_password(password, encoded):
+    return await arun(_check_password, password, encoded)
+
+
+def make_password(password):
+    return run(hashers.make_password, password)
+
+
+async def amake_password(password):
+    return await arun(hashers.make_password, password)
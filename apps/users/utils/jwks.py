@@ -0,0 +1,85 @@
+import json
+import base64
+import hashlib
+import functools
+
+import jwt
+from django.conf import settings
+from jwt.algorithms import get_default_algorithms
+from rest_framework_simplejwt.backends import TokenBackend
+from rest_framework_simplejwt import settings as simplejwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+# Members hashed for the RFC 7638 key thumbprint, used as the key id
+THUMBPRINT_MEMBERS = {
+    'RSA': ('e', 'kty', 'n'),
+    'EC': ('crv', 'kty', 'x', 'y'),
+    'OKP': ('crv', 'kty', 'x'),
+}
+
+
+def get_key_id(jwk):
+    members = {name: jwk[name] for name in THUMBPRINT_MEMBERS[jwk['kty']]}
+    digest = hashlib.sha256(json.dumps(members, separators=(',', ':'), sort_keys=True).encode()).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+def public_key_to_jwk(key, algorithm):
+    algorithm_obj = get_default_algorithms()[algorithm]
+    jwk = json.loads(algorithm_obj.to_jwk(algorithm_obj.prepare_key(key)))
+    jwk.update(kid=get_key_id(jwk), use='sig', alg=algorithm)
+    return jwk
+
+
+@functools.lru_cache(maxsize=None)
+def get_jwks():
+    # Keys only change with the settings, so the document and its ETag are built once per process
+    algorithm = settings.SIMPLE_JWT['ALGORITHM']
+    keys = [settings.JWT_PUBLIC_KEY, *settings.JWT_PUBLIC_KEYS_INACTIVE] if settings.JWT_PUBLIC_KEY else []
+    body = json.dumps({'keys': [public_key_to_jwk(key, algorithm) for key in keys]}).encode()
+    return body, '"%s"' % hashlib.sha1(body).hexdigest()
+
+
+class KeyIdTokenBackend(TokenBackend):
+    # Tokens carry the `kid` of the published key they are signed with, so verifiers pick the key
+    # from the JWKS directly. Symmetric tokens have no published key and no `kid`
+    @functools.cached_property
+    def key_id(self):
+        if self.algorithm.startswith('HS') or not settings.JWT_PUBLIC_KEY:
+            return None
+        return get_key_id(public_key_to_jwk(settings.JWT_PUBLIC_KEY, self.algorithm))
+
+    @functools.cached_property
+    def signing_key_object(self):
+        # Parsing a PEM key is far slower than signing with it, done once per process
+        return get_default_algorithms()[self.algorithm].prepare_key(self.signing_key)
+
+    def encode(self, payload):
+        jwt_payload = payload.copy()
+        if self.audience is not None:
+            jwt_payload['aud'] = self.audience
+        if self.issuer is not None:
+            jwt_payload['iss'] = self.issuer
+
+        headers = {'kid': self.key_id} if self.key_id else None
+        return jwt.encode(jwt_payload, self.signing_key_object, algorithm=self.algorithm, headers=headers,
+                          json_encoder=self.json_encoder)
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_backend():
+    # Looked up on the module, simplejwt replaces its api_settings when SIMPLE_JWT changes
+    api_settings = simplejwt_settings.api_settings
+    return KeyIdTokenBackend(api_settings.ALGORITHM, api_settings.SIGNING_KEY, api_settings.VERIFYING_KEY,
+                             api_settings.AUDIENCE, api_settings.ISSUER, api_settings.JWK_URL, api_settings.LEEWAY,
+                             api_settings.JSON_ENCODER)
+
+
+class KeyIdTokenMixin:
+    @property
+    def token_backend(self):
+        return get_token_backend()
+
+
+class KeyIdAccessToken(KeyIdTokenMixin, AccessToken):
+    pass
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template.loader import render_to_string
+from django.utils import translation
+
+
+class EmailBatchError(Exception):
+    def __init__(self, sent, error):
+        super().__init__(f'Sending failed after {sent} messages: {error}')
+        self.sent = sent
+        self.error = error
+
+
+def render_email(template_name, context, language=None):
+    with translation.override(language or settings.LANGUAGE_CODE):
+        subject = render_to_string(f'users/email/{template_name}_subject.txt', context)
+        text = render_to_string(f'users/email/{template_name}.txt', context)
+        html = render_to_string(f'users/email/{template_name}.html', context)
+    # Headers can't contain newlines
+    return ' '.join(subject.split()), text, html
+
+
+def build_message(email, subject, text, html=None):
+    message = EmailMultiAlternatives(subject, text, settings.EMAIL_DEFAULT_NOTIFIER, [email])
+    if html:
+        message.attach_alternative(html, 'text/html')
+    return message
+
+
+def build_template_messages(template_name, recipients, context):
+    # Recipients are (email, language) pairs, the template is rendered once per language
+    # and the messages keep the order of the recipients
+    rendered = {}
+    messages = []
+    for email, language in recipients:
+        language = language or settings.LANGUAGE_CODE
+        if language not in rendered:
+            rendered[language] = render_email(template_name, context, language)
+        messages.append(build_message(email, *rendered[language]))
+    return messages
+
+
+def send_messages(messages, connection=None):
+    # One SMTP session per EMAIL_BATCH_SIZE messages, servers cap the messages of a session. Messages are
+    # handed over one at a time, so a failure reports exactly how many already went out and a retry
+    # starts at the failed message
+    connection = connection or get_connection()
+    batch_size = settings.EMAIL_BATCH_SIZE
+    sent = 0
+    try:
+        for i in range(0, len(messages), batch_size):
+            with connection:
+                for message in messages[i:i + batch_size]:
+                    connection.send_messages([message])
+                    sent += 1
+    except Exception as e:
+        raise EmailBatchError(sent, e) from e
+    return sent
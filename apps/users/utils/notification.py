@@ -0,0 +1,104 @@
+import json
+
+import redis
+import redis.asyncio
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django_redis import get_redis_connection
+
+from apps.users.models import Notification
+
+# Unread counters live in the cache and are only ever moved by the number of rows an UPDATE changed,
+# a missing counter is recounted from the (user, status) index on the next read. Counters expire after
+# NOTIFICATION_COUNTER_TIMEOUT, which bounds any drift from changes racing a recount
+
+
+def get_unread_key(user_id):
+    return f'notifications:unread:{user_id}'
+
+
+def get_channel(user_id):
+    return f'notifications:{user_id}'
+
+
+# Async counterparts of the connection classes django-redis can connect with
+ASYNC_CONNECTION_CLASSES = {
+    redis.Connection: redis.asyncio.Connection,
+    redis.SSLConnection: redis.asyncio.SSLConnection,
+    redis.UnixDomainSocketConnection: redis.asyncio.UnixDomainSocketConnection,
+}
+
+
+def get_async_client():
+    # Connects where the cache alias writes to, django-redis has already picked the primary out of
+    # LOCATION and merged the OPTIONS into the kwargs of its pool
+    pool = get_redis_connection(settings.NOTIFICATION_CACHE).connection_pool
+    connection_class = ASYNC_CONNECTION_CLASSES.get(pool.connection_class)
+    if connection_class is None:
+        raise ImproperlyConfigured(f'No async connection class for {pool.connection_class!r}')
+
+    # The sync parser is left out, async connections pick their own
+    kwargs = {key: value for key, value in pool.connection_kwargs.items() if key != 'parser_class'}
+    return redis.asyncio.Redis.from_pool(redis.asyncio.ConnectionPool(connection_class=connection_class, **kwargs))
+
+
+def get_notification_cache():
+    return caches[settings.NOTIFICATION_CACHE]
+
+
+def get_unread_count(user_id):
+    cache = get_notification_cache()
+    key = get_unread_key(user_id)
+    count = cache.get(key)
+    if count is None:
+        count = Notification.objects.filter(user_id=user_id, status=False).count()
+        # A concurrent recount may have stored its result already
+        if not cache.add(key, count, timeout=settings.NOTIFICATION_COUNTER_TIMEOUT):
+            count = cache.get(key, count)
+    return max(count, 0)
+
+
+def change_unread_count(user_id, delta):
+    if not delta:
+        return
+    try:
+        get_notification_cache().incr(get_unread_key(user_id), delta)
+    except ValueError:
+        # Not cached, the next read counts
+        pass
+
+
+def publish(user_id, event, data):
+    message = json.dumps({'event': event, 'data': data})
+    get_redis_connection(settings.NOTIFICATION_CACHE).publish(get_channel(user_id), message)
+
+
+def publish_notification(notification):
+    publish(notification.user_id, 'notification', {
+        'id': notification.pk,
+        'notification_type': notification.notification_type,
+        'message': notification.message,
+        'created_at': notification.created_at.isoformat(),
+    })
+
+
+def notify(user, notification_type, message):
+    # Counted and published by the post_save receiver, like notifications created anywhere else
+    return Notification.objects.create(user=user, notification_type=notification_type, message=message)
+
+
+def mark_read(user_id, ids):
+    updated = Notification.objects.filter(user_id=user_id, pk__in=ids, status=False).update(status=True)
+    if updated:
+        change_unread_count(user_id, -updated)
+        publish(user_id, 'unread', {'unread': get_unread_count(user_id)})
+    return updated
+
+
+def mark_all_read(user_id):
+    updated = Notification.objects.filter(user_id=user_id, status=False).update(status=True)
+    if updated:
+        change_unread_count(user_id, -updated)
+        publish(user_id, 'unread', {'unread': get_unread_count(user_id)})
+    return updated
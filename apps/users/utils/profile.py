@@ -0,0 +1,92 @@
+import json
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.utils.encoders import JSONEncoder
+
+from apps.users.models import User
+from apps.users.serializers.user import UserSerializer
+
+# Serialized profiles are cached per user with the ETag of their JSON, an entry belongs to the
+# `updated_at` it was built from and is dropped whenever the user is saved
+
+# Public profiles for other services are lists in this order, the field names are sent once per response
+PUBLIC_PROFILE_FIELDS = ('first_name', 'last_name', 'avatar')
+
+
+def get_profile_key(user_id):
+    return f'users:profile:{user_id}'
+
+
+def get_public_profile_key(user_id):
+    return f'users:public:{user_id}'
+
+
+def build_profile(user):
+    data = dict(UserSerializer(user).data)
+    body = json.dumps(data, cls=JSONEncoder, sort_keys=True, separators=(',', ':'))
+    return {
+        'version': user.updated_at.isoformat(),
+        'etag': '"%s"' % hashlib.sha1(body.encode()).hexdigest(),
+        'data': data,
+    }
+
+
+def get_profile(user):
+    key = get_profile_key(user.pk)
+    entry = cache.get(key)
+    if entry is None or entry['version'] != user.updated_at.isoformat():
+        entry = build_profile(user)
+        cache.set(key, entry, timeout=settings.USER_PROFILE_CACHE_TIMEOUT)
+    return entry
+
+
+def get_profiles(user_ids):
+    # {user id: profile entry}, cache misses are loaded with a single query
+    keys = {get_profile_key(user_id): str(user_id) for user_id in user_ids}
+    entries = {keys[key]: entry for key, entry in cache.get_many(keys).items()}
+
+    missing = [user_id for user_id in keys.values() if user_id not in entries]
+    if missing:
+        built = {str(user.pk): build_profile(user) for user in User.objects.filter(pk__in=missing)}
+        cache.set_many({get_profile_key(user_id): entry for user_id, entry in built.items()},
+                       timeout=settings.USER_PROFILE_CACHE_TIMEOUT)
+        entries.update(built)
+    return entries
+
+
+def build_public_profile(user):
+    return [user.first_name, user.last_name, user.avatar.url if user.avatar else None]
+
+
+def get_public_profiles(user_ids):
+    # {user id: public profile}, misses are loaded with one query that reads only the public fields
+    keys = {get_public_profile_key(user_id): str(user_id) for user_id in user_ids}
+    profiles = {keys[key]: profile for key, profile in cache.get_many(keys).items()}
+
+    missing = [user_id for user_id in keys.values() if user_id not in profiles]
+    if missing:
+        users = User.objects.filter(pk__in=missing).only('id', *PUBLIC_PROFILE_FIELDS)
+        built = {str(user.pk): build_public_profile(user) for user in users}
+        cache.set_many({get_public_profile_key(user_id): profile for user_id, profile in built.items()},
+                       timeout=settings.USER_PROFILE_CACHE_TIMEOUT)
+        profiles.update(built)
+    return profiles
+
+
+def stream_public_profiles(user_ids, profiles, chunk_size=200):
+    # Compact JSON written in chunks, {"fields": [...], "users": {id: [values]}, "missing": [ids]}
+    def dump(value):
+        return json.dumps(value, separators=(',', ':'))
+
+    yield '{"status":"ok","fields":%s,"users":{' % dump(PUBLIC_PROFILE_FIELDS)
+    found = [user_id for user_id in user_ids if user_id in profiles]
+    for start in range(0, len(found), chunk_size):
+        chunk = ','.join(f'"{user_id}":{dump(profiles[user_id])}' for user_id in found[start:start + chunk_size])
+        yield chunk if start == 0 else ',' + chunk
+    yield '},"missing":%s}' % dump([user_id for user_id in user_ids if user_id not in profiles])
+
+
+def invalidate_profile(user_id):
+    cache.delete_many([get_profile_key(user_id), get_public_profile_key(user_id)])
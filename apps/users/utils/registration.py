@@ -0,0 +1,264 @@
+import abc
+import functools
+from datetime import datetime, timedelta
+from ipware import get_client_ip
+
+from django.conf import settings
+from django.utils import translation
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from apps.otp.utils.service import send_code
+from apps.users.models import User
+from apps.users.serializers.user import (VerificationSerializer, ProfileNameSerializer,
+                                         AccountTypeSerializer, EmailSerializer,
+                                         ParentEmailSerializer, PasswordSerializer,
+                                         ProfileMetadataSerializer, PhoneNumberSerializer)
+from apps.users.tasks import send_template_email
+from apps.users.utils.auth import generate_token, verify_token, RegistrationTokenError
+from apps.users.utils.dispatch import enqueue_sms
+from apps.users.utils.hashing import make_password
+
+
+class RegistrationStepError(APIException):
+    status_code = status.HTTP_400_BAD_REQUEST
+
+    def __init__(self, message, status_code=None):
+        if status_code:
+            self.status_code = status_code
+        super().__init__({'status': 'error', 'message': message})
+
+
+# A step validates the request with `serializer_class`, sets `claims` from the validated data and issues
+# a token for the `next` steps. It accepts the tokens of the steps that name it in `next`, see `previous`
+class RegistrationStep:
+    serializer_class = None
+    previous = ()
+    next = ()
+    claims = ()
+    timeout = None
+    message = ''
+    http_status = status.HTTP_202_ACCEPTED
+
+    def __init__(self, name, **kwargs):
+        self.name = name
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    @property
+    def issuer(self):
+        return f'registration_{self.name}'
+
+    def get_serializer(self, request, data, payload):
+        return self.serializer_class(data=data, context={'request': request, 'token_payload': payload})
+
+    def get_claims(self, validated_data):
+        return {claim: validated_data.get(claim) for claim in self.claims}
+
+    def perform(self, request, payload, validated_data):
+        pass
+
+    def run(self, request, data, token=None):
+        payload = {'iat': datetime.utcnow()}
+        if self.previous:
+            if not token:
+                raise RegistrationTokenError('missing', 'token not given')
+            payload = verify_token(token, issuers=self.previous_issuers, audience=self.issuer)
+
+        serializer = self.get_serializer(request, data, payload)
+        serializer.is_valid(raise_exception=True)
+
+        payload.update(self.get_claims(serializer.validated_data))
+        self.perform(request, payload, serializer.validated_data)
+        return generate_token(self.get_token_payload(payload))
+
+    def get_token_payload(self, payload):
+        if self.timeout:
+            payload['exp'] = datetime.utcnow() + timedelta(seconds=self.timeout)
+        payload['iss'] = self.issuer
+        payload['aud'] = [REGISTRATION_STEPS[name].issuer for name in self.next]
+        return payload
+
+    @property
+    def previous_issuers(self):
+        return [REGISTRATION_STEPS[name].issuer for name in self.previous]
+
+    @functools.cached_property
+    def metadata(self):
+        fields = self.serializer_class().fields
+        return {
+            'name': self.name,
+            'previous': list(self.previous),
+            'next': list(self.next),
+            'fields': {
+                name: {'type': type(field).__name__, 'required': field.required}
+                for name, field in fields.items() if not field.read_only
+            },
+        }
+
+
+class VerificationCodeStep(RegistrationStep, abc.ABC):
+    http_status = status.HTTP_200_OK
+    message = 'Verification code sent'
+
+    @abc.abstractmethod
+    def get_destination(self, validated_data):
+        pass
+
+    @abc.abstractmethod
+    def send_code(self, destination, code):
+        pass
+
+    def perform(self, request, payload, validated_data):
+        # A new destination has to be verified again
+        payload.pop('verified', None)
+        ip_address, is_routable = get_client_ip(request)
+        send_code('registration', self.get_destination(validated_data), self.send_code, ip_address)
+
+
+class ParentEmailStep(VerificationCodeStep):
+    email_template = 'verification_code'
+
+    def get_claims(self, validated_data):
+        return {'email': validated_data.get('email')}
+
+    def get_destination(self, validated_data):
+        return validated_data.get('email')
+
+    def send_code(self, destination, code):
+        send_template_email.delay(
+            self.email_template,
+            [(destination, translation.get_language())],
+            {'project_name': settings.PROJECT_NAME, 'code': code}
+        )
+
+
+class PhoneNumberStep(VerificationCodeStep):
+    verification_text = _("{project_name} verification code for registration: ")
+
+    def get_claims(self, validated_data):
+        return {'phone_number': validated_data.get('phone_number').as_e164}
+
+    def get_destination(self, validated_data):
+        return validated_data.get('phone_number').as_e164
+
+    def send_code(self, destination, code):
+        # Queued straight into the OTP lane, ahead of notifications
+        enqueue_sms(
+            destination,
+            self.verification_text.format(project_name=settings.PROJECT_NAME) + str(code),
+            lane='otp'
+        )
+
+
+class VerificationStep(RegistrationStep):
+    message = 'Verification completed'
+
+    @property
+    def issuer(self):
+        return 'verification'
+
+    def get_claims(self, validated_data):
+        phone_number = validated_data.get('phone_number')
+        email = validated_data.get('email')
+
+        claims = {'verified': True}
+        if phone_number:
+            claims['phone_number'] = phone_number.as_e164
+        elif email:
+            claims['email'] = email
+        return claims
+
+
+class ProfileMetadataStep(RegistrationStep):
+    def get_claims(self, validated_data):
+        return {
+            'gender': validated_data.get('gender'),
+            'birthday': validated_data.get('birthday').strftime("%Y-%m-%d"),
+        }
+
+
+class EmailStep(RegistrationStep):
+    def perform(self, request, payload, validated_data):
+        if User.objects.filter(email=validated_data.get('email')).exists():
+            raise RegistrationStepError('Email already registered', status.HTTP_409_CONFLICT)
+
+
+class PasswordStep(RegistrationStep):
+    def get_claims(self, validated_data):
+        # Only the hash is kept, so the password is hashed once and never stored in clear. Being a
+        # secret claim it stays in the registration session, never in the token
+        return {'password': make_password(validated_data.get('password'))}
+
+
+class FinalStep(RegistrationStep):
+    # Registration itself, only used as the audience of the password step
+    @property
+    def issuer(self):
+        return 'registration'
+
+
+REGISTRATION_STEPS = {step.name: step for step in (
+    RegistrationStep(
+        'account_type',
+        serializer_class=AccountTypeSerializer,
+        next=('phone_number', 'parent_email'),
+        claims=('account_type',),
+        timeout=settings.REGISTRATION_TOKEN_TIMEOUT,
+        message='Account type accepted',
+    ),
+    ParentEmailStep(
+        'parent_email',
+        serializer_class=ParentEmailSerializer,
+        next=('verification',),
+        timeout=settings.REGISTRATION_CODE_TIMEOUT,
+    ),
+    PhoneNumberStep(
+        'phone_number',
+        serializer_class=PhoneNumberSerializer,
+        next=('verification',),
+        timeout=settings.REGISTRATION_CODE_TIMEOUT,
+    ),
+    VerificationStep(
+        'verification',
+        serializer_class=VerificationSerializer,
+        next=('profile_name',),
+        timeout=settings.REGISTRATION_TOKEN_TIMEOUT,
+    ),
+    RegistrationStep(
+        'profile_name',
+        serializer_class=ProfileNameSerializer,
+        next=('profile_metadata',),
+        claims=('first_name', 'last_name'),
+        message='First name and last name accepted',
+    ),
+    ProfileMetadataStep(
+        'profile_metadata',
+        serializer_class=ProfileMetadataSerializer,
+        next=('email',),
+        message='Gender and Birthday accepted',
+    ),
+    EmailStep(
+        'email',
+        serializer_class=EmailSerializer,
+        next=('password',),
+        claims=('email',),
+        message='Email accepted',
+    ),
+    PasswordStep(
+        'password',
+        serializer_class=PasswordSerializer,
+        next=('registration',),
+        message='Password accepted',
+    ),
+    FinalStep('registration'),
+)}
+
+# Derived from the `next` edges, a step only accepts tokens that can actually name it as their audience
+for step in REGISTRATION_STEPS.values():
+    step.previous = tuple(name for name, other in REGISTRATION_STEPS.items() if step.name in other.next)
+
+# Steps that can be submitted, registration itself has its own view
+REGISTRATION_ROUTES = {name: step for name, step in REGISTRATION_STEPS.items() if step.serializer_class}
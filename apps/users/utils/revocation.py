@@ -0,0 +1,140 @@
+import math
+import time
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.translation import gettext as _
+from django_redis import get_redis_connection
+
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from apps.users.utils.jwks import KeyIdAccessToken, KeyIdTokenMixin
+
+# Revoked JTIs by revocation time, lets every process pull the revocations it hasn't seen yet
+REVOCATION_LOG_KEY = 'revocation:log'
+
+
+def get_revoked_key(jti):
+    return f'revoked:{jti}'
+
+
+def get_revocation_cache():
+    return caches[settings.REVOCATION_CACHE]
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def get_positions(self, value):
+        # Double hashing, two 64 bit halves of one digest give all the positions
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self.get_positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.get_positions(value))
+
+
+class RevocationFilter:
+    # Per-process front of the revocation store. A JTI missing from the filter was not revoked
+    # as of the last sync, so the common case needs no I/O. Other processes' revocations are
+    # pulled every REVOCATION_SYNC_INTERVAL seconds, the filter is rebuilt from scratch every
+    # REVOCATION_REBUILD_INTERVAL seconds so purged JTIs don't fill it up
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.filter = None
+        self.synced_at = 0
+        self.synced_until = 0
+        self.built_at = 0
+
+    def sync(self):
+        now = time.time()
+        if now - self.synced_at < settings.REVOCATION_SYNC_INTERVAL:
+            return
+
+        with self.lock:
+            if now - self.synced_at < settings.REVOCATION_SYNC_INTERVAL:
+                return
+
+            rebuild = self.filter is None or now - self.built_at >= settings.REVOCATION_REBUILD_INTERVAL
+            if rebuild:
+                bloom = BloomFilter(settings.REVOCATION_BLOOM_CAPACITY, settings.REVOCATION_BLOOM_ERROR_RATE)
+                since = '-inf'
+            else:
+                bloom = self.filter
+                # Overlaps the previous sync a little, revocations logged in the same second aren't missed
+                since = self.synced_until - 1
+
+            client = get_redis_connection(settings.REVOCATION_CACHE)
+            for jti in client.zrangebyscore(REVOCATION_LOG_KEY, since, now):
+                bloom.add(jti.decode())
+
+            self.filter = bloom
+            self.synced_until = now
+            self.synced_at = now
+            if rebuild:
+                self.built_at = now
+
+    def add(self, jti):
+        if self.filter is not None:
+            self.filter.add(jti)
+
+    def __contains__(self, jti):
+        self.sync()
+        return jti in self.filter
+
+
+revocation_filter = RevocationFilter()
+
+
+def revoke(jti, exp):
+    # Cached until the token would expire anyway, the table keeps it for good
+    timeout = int(exp - time.time())
+    if timeout <= 0:
+        return
+
+    get_revocation_cache().set(get_revoked_key(jti), True, timeout=timeout)
+    get_redis_connection(settings.REVOCATION_CACHE).zadd(REVOCATION_LOG_KEY, {jti: time.time()})
+    revocation_filter.add(jti)
+
+
+def is_revoked(jti):
+    if jti not in revocation_filter:
+        return False
+
+    # The filter can give false positives, the cache and then the table decide
+    revoked = get_revocation_cache().get(get_revoked_key(jti))
+    if revoked is not None:
+        return revoked
+    return BlacklistedToken.objects.filter(token__jti=jti).exists()
+
+
+def purge_revocation_log(max_age):
+    client = get_redis_connection(settings.REVOCATION_CACHE)
+    return client.zremrangebyscore(REVOCATION_LOG_KEY, '-inf', time.time() - max_age)
+
+
+class RevocableRefreshToken(KeyIdTokenMixin, RefreshToken):
+    # Refresh token checked against the revocation store instead of a table lookup on every use
+    access_token_class = KeyIdAccessToken
+
+    def check_blacklist(self):
+        if is_revoked(self.payload[api_settings.JTI_CLAIM]):
+            raise TokenError(_('Token is blacklisted'))
+
+    def blacklist(self):
+        blacklisted = super().blacklist()
+        revoke(self.payload[api_settings.JTI_CLAIM], self.payload['exp'])
+        return blacklisted
@@ -0,0 +1,88 @@
+import secrets
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Claims kept in the token itself, everything else lives in the cache
+SESSION_CLAIMS = ('sid', 'exp', 'iat', 'iss', 'aud')
+# Never put in the token, with REGISTRATION_STATE_STORE = 'token' these are the only claims in the cache
+SECRET_CLAIMS = ('password',)
+
+
+def get_session_key(sid):
+    return f'registration_session:{sid}'
+
+
+def is_session_store_enabled():
+    return settings.REGISTRATION_STATE_STORE == 'cache'
+
+
+def is_stored_claim(key):
+    if is_session_store_enabled():
+        return key not in SESSION_CLAIMS
+    return key in SECRET_CLAIMS
+
+
+def uses_registration_session(payload):
+    # Tokens of the token store get a session once they carry a secret claim
+    return is_session_store_enabled() or any(key in payload for key in SECRET_CLAIMS)
+
+
+def has_registration_session(claims):
+    return is_session_store_enabled() or 'sid' in claims
+
+
+def split_registration_session(payload):
+    # Every token gets its own session, never the one of the token it was issued from. Sessions are
+    # only written once, so an older token replayed at a step can't change the state of a later one
+    sid = secrets.token_urlsafe(16)
+    state = {key: value for key, value in payload.items() if is_stored_claim(key)}
+    claims = {key: value for key, value in payload.items() if not is_stored_claim(key)}
+    claims['sid'] = sid
+    return sid, state, claims
+
+
+def save_registration_session(payload):
+    sid, state, claims = split_registration_session(payload)
+    cache.set(get_session_key(sid), state, timeout=settings.REGISTRATION_TOKEN_TIMEOUT)
+    return claims
+
+
+async def asave_registration_session(payload):
+    sid, state, claims = split_registration_session(payload)
+    await cache.aset(get_session_key(sid), state, timeout=settings.REGISTRATION_TOKEN_TIMEOUT)
+    return claims
+
+
+def load_registration_session(claims):
+    sid = claims.get('sid')
+    if not sid:
+        return None
+
+    state = cache.get(get_session_key(sid))
+    if state is None:
+        return None
+    return {**state, **claims}
+
+
+async def aload_registration_session(claims):
+    sid = claims.get('sid')
+    if not sid:
+        return None
+
+    state = await cache.aget(get_session_key(sid))
+    if state is None:
+        return None
+    return {**state, **claims}
+
+
+def delete_registration_session(payload):
+    sid = payload.get('sid')
+    if sid:
+        cache.delete(get_session_key(sid))
+
+
+async def adelete_registration_session(payload):
+    sid = payload.get('sid')
+    if sid:
+        await cache.adelete(get_session_key(sid))
@@ -3,14 +3,33 @@ import hmac
 import time
 import uuid
 import base64
+import random
 import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
 
+logger = logging.getLogger(__name__)
 
 API_URL = os.getenv('SMS_API_URL')
 USER = os.getenv('SMS_USER')
 SECRET = os.getenv('SMS_SECRET')
 
+# Connect and read timeouts in seconds, a stuck gateway must not hang a worker
+CONNECT_TIMEOUT = float(os.getenv('SMS_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.getenv('SMS_READ_TIMEOUT', 10))
+POOL_SIZE = int(os.getenv('SMS_POOL_SIZE', 10))
+MAX_RETRIES = int(os.getenv('SMS_MAX_RETRIES', 3))
+BACKOFF_BASE = float(os.getenv('SMS_BACKOFF_BASE', 0.5))
+BACKOFF_MAX = float(os.getenv('SMS_BACKOFF_MAX', 8))
+FAILURE_THRESHOLD = int(os.getenv('SMS_FAILURE_THRESHOLD', 5))
+RESET_TIMEOUT = float(os.getenv('SMS_RESET_TIMEOUT', 30))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
 MIN_VALUE = 10000
 MAX_VALUE = 99999
 
@@ -27,25 +46,139 @@ def generate_hmac(key, message):
     return base64.b64encode(h)
 
 
-class SMS:
-    def __init__(self, text, dest):
-        self.text = text
-        self.dest = dest
+class SMSGatewayError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(SMSGatewayError):
+    pass
+
+
+class CircuitBreaker:
+    # Opens after `failure_threshold` consecutive failures, after `reset_timeout`
+    # a single trial request is let through and closes it again on success
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0 or self.trial:
+                raise CircuitOpenError('SMS gateway circuit is open', retry_after=max(remaining, 1))
+            self.trial = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning('SMS gateway circuit opened after %s failures', self.failures)
+                self.opened_at = time.monotonic()
+
+
+class SMSGateway:
+    def __init__(self, api_url=API_URL, user=USER, secret=SECRET, pool_size=POOL_SIZE,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), max_retries=MAX_RETRIES, breaker=None):
+        self.api_url = api_url
+        self.user = user
+        self.secret = secret
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.breaker = breaker or CircuitBreaker()
 
-    @staticmethod
-    def _send_message(user, msg_id, dest, text, secret):
+        # Keep-alive connections are reused between messages instead of a new TCP+TLS handshake each time
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_backoff(self, attempt):
+        # Full jitter, so retries of concurrent workers don't hit the gateway at once
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    def post(self, msg_id, dest, text):
         ts = int(time.time())
-        msg = f'{user}:{msg_id}:{dest}:{text}:{ts}'
-        req_hmac = generate_hmac(secret, msg)
-        return requests.post(API_URL + user + '/send', data={
+        msg = f'{self.user}:{msg_id}:{dest}:{text}:{ts}'
+        return self.session.post(self.api_url + self.user + '/send', data={
             'msg-id': msg_id,
             'dest': dest,
             'text': text,
             'ts': ts,
-            'hmac': req_hmac
-        })
+            'hmac': generate_hmac(self.secret, msg)
+        }, timeout=self.timeout)
+
+    def send(self, dest, text, msg_id=None):
+        # The message id is kept between retries, so the gateway can drop duplicates
+        msg_id = msg_id or uuid.uuid4()
+        dest = get_cleaned_phone_number(dest)
+
+        for attempt in range(self.max_retries + 1):
+            self.breaker.before_request()
+            try:
+                response = self.post(msg_id, dest, text)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = SMSGatewayError(f'SMS gateway request failed: {e}')
+            except requests.RequestException as e:
+                # Not transient, retrying won't help
+                self.breaker.record_failure()
+                raise SMSGatewayError(f'SMS gateway request failed: {e}') from e
+            except Exception:
+                # Anything else still ends a half-open trial, or the circuit would stay open for good
+                self.breaker.record_failure()
+                raise
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    self.breaker.record_success()
+                    return {'status_code': response.status_code, 'content': response.content}
+                error = SMSGatewayError(f'SMS gateway responded with {response.status_code}')
+
+            self.breaker.record_failure()
+            if attempt < self.max_retries:
+                time.sleep(self.get_backoff(attempt))
+
+        raise error
+
+    def send_batch(self, messages):
+        # The gateway API has no batch endpoint, messages are sent concurrently over the pooled connections.
+        # Failed messages are returned with the error instead of failing the whole batch
+        def send(message):
+            dest, text = message
+            try:
+                return self.send(dest, text)
+            except SMSGatewayError as e:
+                return {'status_code': None, 'content': str(e)}
+
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            return list(executor.map(send, messages))
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway():
+    # One client per process, created lazily so forked workers don't share sockets
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = SMSGateway()
+    return _gateway
 
-    def send(self):
-        dest = get_cleaned_phone_number(self.dest)
-        rv = self._send_message(user=USER, msg_id=uuid.uuid4(), dest=dest, text=self.text, secret=SECRET)
-        return {"status_code": rv.status_code, "content": rv.content}
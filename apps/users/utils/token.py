@@ -0,0 +1,133 @@
+import json
+import time
+import base64
+import calendar
+import functools
+from datetime import datetime
+
+from django.utils.crypto import salted_hmac, constant_time_compare
+from jwt.exceptions import (DecodeError, InvalidSignatureError, ExpiredSignatureError,
+                            InvalidIssuerError, InvalidAudienceError)
+
+KEY_SALT = 'apps.users.registration_token'
+
+# Registration state is carried between steps by the client, so claims and step names get short keys
+CLAIMS = {
+    'account_type': 'a',
+    'phone_number': 'p',
+    'email': 'e',
+    'parent_email': 'pe',
+    'first_name': 'f',
+    'last_name': 'l',
+    'birthday': 'b',
+    'gender': 'g',
+    'password': 'pw',
+    'avatar': 'av',
+    'verified': 'v',
+    'exp': 'x',
+    'iat': 'ia',
+    'iss': 'i',
+    'aud': 'u',
+    'sid': 's',
+}
+STEPS = {
+    'registration_account_type': 'at',
+    'registration_parent_email': 'pe',
+    'registration_phone_number': 'pn',
+    'verification': 'vf',
+    'registration_profile_name': 'nm',
+    'registration_profile_metadata': 'md',
+    'registration_email': 'em',
+    'registration_password': 'pw',
+    'registration': 'rg',
+}
+CLAIMS_REVERSED = {value: key for key, value in CLAIMS.items()}
+STEPS_REVERSED = {value: key for key, value in STEPS.items()}
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def _sign(value):
+    return _b64encode(salted_hmac(KEY_SALT, value, algorithm='sha256').digest())
+
+
+def _pack_value(key, value):
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    if key in ('iss', 'aud'):
+        if isinstance(value, (list, tuple)):
+            return [STEPS.get(step, step) for step in value]
+        return STEPS.get(value, value)
+    return value
+
+
+def _unpack_value(key, value):
+    if key in ('iss', 'aud'):
+        if isinstance(value, list):
+            return [STEPS_REVERSED.get(step, step) for step in value]
+        return STEPS_REVERSED.get(value, value)
+    return value
+
+
+def encode_registration_token(payload):
+    packed = {CLAIMS.get(key, key): _pack_value(key, value) for key, value in payload.items()}
+    body = _b64encode(json.dumps(packed, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+    return f'{body}.{_sign(body)}'
+
+
+@functools.lru_cache(maxsize=1024)
+def _verify(token):
+    try:
+        body, signature = token.split('.')
+    except ValueError:
+        raise DecodeError('Not enough segments')
+
+    if not constant_time_compare(signature, _sign(body)):
+        raise InvalidSignatureError('Signature verification failed')
+
+    try:
+        packed = json.loads(_b64decode(body))
+    except ValueError:
+        raise DecodeError('Invalid payload')
+    if not isinstance(packed, dict):
+        raise DecodeError('Invalid payload')
+
+    key_names = {key: CLAIMS_REVERSED.get(key, key) for key in packed}
+    return {key_names[key]: _unpack_value(key_names[key], value) for key, value in packed.items()}
+
+
+def decode_registration_token(token, audience=None, issuer=None):
+    if not isinstance(token, str):
+        raise DecodeError('Invalid token type')
+
+    # Verified tokens are cached, expiry is still checked on every call
+    payload = dict(_verify(token))
+
+    exp = payload.get('exp')
+    if exp is not None and exp <= time.time():
+        raise ExpiredSignatureError('Signature has expired')
+
+    # A step can accept several predecessors, so the issuer can also be a collection
+    if issuer is not None:
+        issuers = {issuer} if isinstance(issuer, str) else issuer
+        if payload.get('iss') not in issuers:
+            raise InvalidIssuerError('Invalid issuer')
+
+    aud = payload.get('aud')
+    if audience is None:
+        if aud is not None:
+            raise InvalidAudienceError('Invalid audience')
+    else:
+        audiences = {audience} if isinstance(audience, str) else set(audience)
+        token_audiences = {aud} if isinstance(aud, str) else set(aud or [])
+        if not audiences & token_audiences:
+            raise InvalidAudienceError('Audience doesn\'t match')
+
+    return payload
+
@@ -1,67 +1,253 @@
 import base64
+import functools
+import hashlib
+import io
 import os
 import random
+import string
 import pathlib
+import time
 import uuid
 from django.conf import settings
-from PIL import Image, ImageDraw, ImageFont
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageOps
 
+# Letters pre-rendered into the glyph atlas (latin, turkmen and cyrillic capitals)
+AVATAR_ATLAS_LETTERS = string.ascii_uppercase + 'ÄÇŇÖŞÜÝŽ' + 'АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЭЮЯ'
 
-def preprocess_avatar(path):
-    size = settings.AVATAR_SIZE
-    try:
-        with Image.open(path) as img:
-            img = img.resize((size, size))
+# Background colors of generated avatars, a generated avatar is a pure function of (letter, palette index)
+AVATAR_PALETTE = [
+    (198, 40, 40),
+    (173, 20, 87),
+    (106, 27, 154),
+    (69, 39, 160),
+    (40, 53, 147),
+    (21, 101, 192),
+    (2, 119, 189),
+    (0, 131, 143),
+    (0, 105, 92),
+    (46, 125, 50),
+    (85, 139, 47),
+    (158, 105, 0),
+    (191, 54, 12),
+    (78, 52, 46),
+    (66, 66, 66),
+    (55, 71, 79),
+]
 
-            mask = Image.new("L", img.size, 0)
-            draw = ImageDraw.Draw(mask)
-            draw.ellipse((0, 0, size - 1, size - 1), fill=255, outline=0)
+AVATAR_VARIANT_FORMATS = ('png', 'webp')
 
-            img_with_alpha = Image.new("RGBA", img.size, (255, 255, 255, 0))
-            img_with_alpha.paste(img, (0, 0), mask)
 
-            img_with_alpha.save(path, format="PNG")
-    except Exception as e:
-        print(f"Error processing image: {str(e)}")
-        return None
+@functools.lru_cache(maxsize=None)
+def get_avatar_font(size):
+    return ImageFont.truetype(settings.AVATAR_FONT, int(size * 0.5))
 
 
-def avatar_to_base64(avatar_path):
-    with open(avatar_path, "rb") as f:
-        base64_encoded = base64.b64encode(f.read()).decode("utf-8")
-        mime_type = "image/png"
-        data_uri = f"data:{mime_type};base64,{base64_encoded}"
-        return data_uri
+@functools.lru_cache(maxsize=None)
+def get_avatar_mask(size):
+    mask = Image.new("L", (size, size), 0)
+    draw = ImageDraw.Draw(mask)
+    draw.ellipse((0, 0, size - 1, size - 1), fill=255, outline=0)
+    return mask
 
 
-def generate_avatar(letter):
-    folder_path = pathlib.Path(os.path.join(settings.MEDIA_ROOT, 'tmp/'))
-    os.makedirs(folder_path, exist_ok=True)
-    size = settings.AVATAR_SIZE
-
-    # Generate a random color
-    color = (
-        random.randint(0, 200),
-        random.randint(0, 200),
-        random.randint(0, 200)
-    )
-
-    # Create a blank image with the specified size and background color
-    image = Image.new('RGB', (size, size), color)
-
-    # Get a font and calculate text size
-    font_size = int(size * 0.5)
-    font = ImageFont.truetype(settings.AVATAR_FONT, font_size)
+@functools.lru_cache(maxsize=256)
+def render_glyph(letter, size):
+    font = get_avatar_font(size)
     (width, height), (offset_x, offset_y) = font.font.getsize(letter)
 
     # Calculate text position to center it in the image
     text_position = ((size - width) // 2, (size - height) // 2 - offset_y)
 
-    # Draw text on the image
-    draw = ImageDraw.Draw(image)
-    draw.text(text_position, letter, font=font, fill=(255, 255, 255))
+    glyph = Image.new("L", (size, size), 0)
+    draw = ImageDraw.Draw(glyph)
+    draw.text(text_position, letter, font=font, fill=255)
+
+    # Clip the glyph to the circle, so it can be pasted as is
+    return ImageChops.darker(glyph, get_avatar_mask(size))
+
+
+@functools.lru_cache(maxsize=None)
+def get_glyph_atlas(size):
+    return {letter: render_glyph(letter, size) for letter in AVATAR_ATLAS_LETTERS}
+
+
+def get_glyph(letter, size):
+    glyph = get_glyph_atlas(size).get(letter)
+    if glyph is None:
+        glyph = render_glyph(letter, size)
+    return glyph
+
+
+def preprocess_avatar_image(img, size=None):
+    size = size or settings.AVATAR_SIZE
+    img = img.convert("RGB").resize((size, size))
+
+    img_with_alpha = Image.new("RGBA", img.size, (255, 255, 255, 0))
+    img_with_alpha.paste(img, (0, 0), get_avatar_mask(size))
+    return img_with_alpha
+
+
+def open_avatar_upload(path):
+    size = max(settings.AVATAR_VARIANT_SIZES)
+    with Image.open(path) as img:
+        # Let the JPEG decoder downscale by a power of two while decoding
+        if img.format == 'JPEG':
+            img.draft('RGB', (size, size))
+        img = ImageOps.exif_transpose(img)
+
+        # Crop the center square
+        side = min(img.size)
+        left = (img.width - side) // 2
+        top = (img.height - side) // 2
+        return img.crop((left, top, left + side, top + side))
+
+
+def build_avatar_variants(img):
+    img = img.convert("RGB")
+    variants = {}
+
+    # Every size is downscaled from the previous one, largest first
+    for size in sorted(settings.AVATAR_VARIANT_SIZES, reverse=True):
+        factor = img.width // size
+        if factor > 1:
+            img = img.reduce(factor)
+        img = img.resize((size, size), Image.LANCZOS)
+        variants[size] = preprocess_avatar_image(img, size)
+    return variants
+
+
+def avatar_variant_name(name, size, image_format='png'):
+    root, ext = os.path.splitext(name)
+    return f'{root}_{size}.{image_format}'
+
+
+def image_to_bytes(img, image_format="PNG"):
+    buffer = io.BytesIO()
+    if image_format == "WEBP":
+        img.save(buffer, format=image_format, quality=90, method=4)
+    else:
+        img.save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def image_to_png(img):
+    return image_to_bytes(img, "PNG")
+
+
+def save_avatar_variants(name, variants):
+    for size, variant in variants.items():
+        for image_format in AVATAR_VARIANT_FORMATS:
+            variant_name = avatar_variant_name(name, size, image_format)
+            if not default_storage.exists(variant_name):
+                default_storage.save(variant_name, ContentFile(image_to_bytes(variant, image_format.upper())))
+
+
+def get_avatar_variant(name, size, image_format):
+    # The smallest variant not smaller than the requested size, avatars stored
+    # without variants fall back to the original file
+    sizes = sorted(settings.AVATAR_VARIANT_SIZES)
+    size = next((variant_size for variant_size in sizes if variant_size >= size), sizes[-1])
 
-    # Save or return the image
-    save_path = folder_path / (uuid.uuid4().hex + '.png')
-    image.save(save_path)
+    variant_name = avatar_variant_name(name, size, image_format)
+    if default_storage.exists(variant_name):
+        return variant_name
+    return name
+
+
+def save_tmp_upload(upload):
+    folder_path = pathlib.Path(os.path.join(settings.MEDIA_ROOT, settings.AVATAR_UPLOADS_DIR))
+    os.makedirs(folder_path, exist_ok=True)
+
+    save_path = folder_path / uuid.uuid4().hex
+    with open(save_path, 'wb') as f:
+        for chunk in upload.chunks():
+            f.write(chunk)
     return str(save_path)
+
+
+def avatar_to_base64(avatar):
+    base64_encoded = base64.b64encode(avatar).decode("utf-8")
+    mime_type = "image/png"
+    data_uri = f"data:{mime_type};base64,{base64_encoded}"
+    return data_uri
+
+
+def avatar_storage_name(avatar):
+    digest = hashlib.sha256(avatar).hexdigest()
+    return f'{settings.AVATAR_DEFAULTS_DIR}{digest[:2]}/{digest}.png'
+
+
+def store_avatar(avatar):
+    name = avatar_storage_name(avatar)
+    if not default_storage.exists(name):
+        default_storage.save(name, ContentFile(avatar))
+    return name
+
+
+@functools.lru_cache(maxsize=None)
+def get_default_avatar(letter, color_index):
+    avatar = generate_avatar(letter, color_index)
+    name = store_avatar(avatar)
+    save_avatar_variants(name, {
+        size: render_avatar_image(letter, color_index, size) for size in settings.AVATAR_VARIANT_SIZES
+    })
+    return name, avatar
+
+
+def render_avatar_image(letter, color_index, size):
+    color = AVATAR_PALETTE[color_index]
+
+    # Fill the circle with the background color and draw the letter from the atlas on top
+    image = Image.new("RGBA", (size, size), (255, 255, 255, 0))
+    image.paste((*color, 255), (0, 0, size, size), get_avatar_mask(size))
+    image.paste((255, 255, 255, 255), (0, 0, size, size), get_glyph(letter, size))
+    return image
+
+
+def generate_avatar(letter, color_index):
+    return image_to_png(render_avatar_image(letter, color_index, settings.AVATAR_SIZE))
+
+
+def random_avatar_color_index():
+    return random.randrange(len(AVATAR_PALETTE))
+
+
+def get_tmp_avatars_usage():
+    return _get_folder_usage(os.path.join(settings.MEDIA_ROOT, 'tmp/'))
+
+
+def get_avatars_usage():
+    return _get_folder_usage(os.path.join(settings.MEDIA_ROOT, 'avatars/'))
+
+
+def _get_folder_usage(path):
+    files = 0
+    size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+            files += 1
+    return {'files': files, 'bytes': size}
+
+
+def remove_expired_tmp_avatars(max_age):
+    folder_path = pathlib.Path(os.path.join(settings.MEDIA_ROOT, 'tmp/'))
+    if not folder_path.exists():
+        return 0
+
+    removed = 0
+    expired_at = time.time() - max_age
+    # Only files directly in tmp/, pending uploads live in a subdirectory
+    for path in folder_path.iterdir():
+        try:
+            if path.is_file() and path.stat().st_mtime < expired_at:
+                path.unlink()
+                removed += 1
+        except OSError:
+            continue
+    return removed
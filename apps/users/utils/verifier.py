@@ -0,0 +1,113 @@
+import time
+import threading
+from collections import OrderedDict
+
+import jwt
+import requests
+
+# Local access token verification for resource servers, only needs the JWKS url of this service.
+#
+#     verifier = JWTVerifier('https://accounts.example.com/.well-known/jwks.json')
+#     claims = verifier.verify(token)
+#
+# Keys are fetched once and kept for `jwks_ttl`, an unknown key id triggers a refetch at most
+# every `min_refresh_interval`. Decoded claims are cached per token until the token expires,
+# so a token used for several calls is verified once. Refresh tokens are signed with the same keys,
+# so the `token_type` claim has to match `token_type`, access tokens by default
+
+
+class JWTVerifier:
+    def __init__(self, jwks_url, audience=None, issuer=None, algorithms=('RS256', 'EdDSA'), jwks_ttl=3600,
+                 min_refresh_interval=30, cache_size=10000, leeway=0, timeout=(3.05, 5), token_type='access'):
+        self.jwks_url = jwks_url
+        self.audience = audience
+        self.issuer = issuer
+        self.algorithms = list(algorithms)
+        self.jwks_ttl = jwks_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.cache_size = cache_size
+        self.leeway = leeway
+        self.timeout = timeout
+        self.token_type = token_type
+
+        self.session = requests.Session()
+        self.keys = {}
+        self.keys_fetched_at = 0
+        self.claims = OrderedDict()
+        self.keys_lock = threading.Lock()
+        self.claims_lock = threading.Lock()
+
+    def fetch_jwks(self):
+        response = self.session.get(self.jwks_url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def refresh_keys(self, force=False):
+        with self.keys_lock:
+            age = time.monotonic() - self.keys_fetched_at
+            if self.keys and (age < self.min_refresh_interval or (not force and age < self.jwks_ttl)):
+                return
+            try:
+                jwks = self.fetch_jwks()
+            except requests.RequestException:
+                # Keep verifying with the known keys while the accounts service is unreachable
+                if self.keys:
+                    return
+                raise
+            self.keys = {key.key_id: key for key in jwt.PyJWKSet.from_dict(jwks).keys}
+            self.keys_fetched_at = time.monotonic()
+
+    def get_keys(self, token):
+        kid = jwt.get_unverified_header(token).get('kid')
+        self.refresh_keys()
+
+        # Tokens without a key id are checked against every published key, there are only a few
+        if kid is None:
+            return list(self.keys.values())
+
+        if kid not in self.keys:
+            self.refresh_keys(force=True)
+        try:
+            return [self.keys[kid]]
+        except KeyError:
+            raise jwt.InvalidTokenError('Unknown key id')
+
+    def get_cached_claims(self, token):
+        with self.claims_lock:
+            entry = self.claims.get(token)
+            if entry is None:
+                return None
+            claims, expires_at = entry
+            if expires_at <= time.time():
+                del self.claims[token]
+                return None
+            self.claims.move_to_end(token)
+            return claims
+
+    def cache_claims(self, token, claims):
+        expires_at = claims.get('exp')
+        if expires_at is None:
+            return
+        with self.claims_lock:
+            self.claims[token] = (claims, expires_at)
+            if len(self.claims) > self.cache_size:
+                self.claims.popitem(last=False)
+
+    def verify(self, token):
+        claims = self.get_cached_claims(token)
+        if claims is not None:
+            return claims
+
+        error = jwt.InvalidTokenError('No verification key')
+        for key in self.get_keys(token):
+            try:
+                claims = jwt.decode(token, key.key, algorithms=self.algorithms, audience=self.audience,
+                                    issuer=self.issuer, leeway=self.leeway, options={'require': ['exp']})
+            except jwt.InvalidSignatureError as e:
+                error = e
+                continue
+            if claims.get('token_type') != self.token_type:
+                raise jwt.InvalidTokenError('Invalid token type')
+            self.cache_claims(token, claims)
+            return claims
+        raise error
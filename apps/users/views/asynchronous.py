@@ -0,0 +1,202 @@
+import json
+import asyncio
+from datetime import date
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import alogin
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.utils.translation import gettext_lazy as _
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+
+from rest_framework import serializers, status
+from rest_framework.exceptions import APIException, NotAuthenticated
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+
+from apps.otp.utils.service import averify_code
+from apps.users.backends.auth import AuthBackend
+from apps.users.models import User
+from apps.users.serializers.jwt import CustomTokenObtainPairSerializer
+from apps.users.serializers.user import VerificationSerializer
+from apps.users.utils.auth import agenerate_token, aget_registration_token
+from apps.users.utils.notification import get_async_client, get_channel, get_unread_count
+from apps.users.utils.registration import REGISTRATION_STEPS
+from apps.users.utils.session import adelete_registration_session
+from apps.users.utils.user import get_default_avatar, random_avatar_color_index, avatar_to_base64
+
+AUTH_BACKEND = 'apps.users.backends.auth.AuthBackend'
+
+
+class TokenClaimsVerificationSerializer(VerificationSerializer):
+    # The code itself is checked by the view with the async OTP service
+    def validate(self, attrs):
+        self.check_token_claims(attrs)
+        return attrs
+
+
+def build_json_response(status, message, http_status, additional_data=None):
+    if additional_data is None:
+        additional_data = {}
+    return JsonResponse({'status': status, 'message': message, **additional_data}, status=http_status)
+
+
+def get_request_data(request):
+    if request.content_type == 'application/json':
+        try:
+            return json.loads(request.body or b'{}')
+        except ValueError:
+            raise serializers.ValidationError({'status': 'error', 'message': 'Invalid JSON'})
+    return request.POST
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAPIView(View):
+    # Plain Django view, DRF dispatch is sync only. API exceptions are rendered the way DRF does
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            return await super().dispatch(request, *args, **kwargs)
+        except APIException as e:
+            response = JsonResponse(e.detail, status=e.status_code, safe=False)
+            if getattr(e, 'wait', None):
+                response['Retry-After'] = '%d' % e.wait
+            return response
+
+
+class AsyncLogin(AsyncAPIView):
+    async def post(self, request, *args, **kwargs):
+        data = get_request_data(request)
+        user = await AuthBackend().aauthenticate(
+            request, email=data.get('email'), phone_number=data.get('phone_number'), password=data.get('password')
+        )
+        if user is None:
+            return JsonResponse({'error': 'Invalid credentials'}, status=status.HTTP_401_UNAUTHORIZED)
+
+        await alogin(request, user, backend=AUTH_BACKEND)
+        # Minting records the outstanding refresh token, a database write
+        refresh = await sync_to_async(CustomTokenObtainPairSerializer.get_token)(user)
+
+        return JsonResponse({
+            'access_token': str(refresh.access_token),
+            'refresh_token': str(refresh),
+            'user_id': user.id,
+            'email': user.email,
+            'phone_number': str(user.phone_number) if user.phone_number else None,
+        }, status=status.HTTP_200_OK)
+
+
+class AsyncVerification(AsyncAPIView):
+    step = REGISTRATION_STEPS['verification']
+
+    async def post(self, request, *args, **kwargs):
+        step = self.step
+        payload = await aget_registration_token(request, issuers=step.previous_issuers, audience=step.issuer)
+
+        serializer = TokenClaimsVerificationSerializer(
+            data=get_request_data(request), context={'request': request, 'token_payload': payload}
+        )
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        code = data.get('code')
+        if not code or not await averify_code('registration', data.get('phone_number') or data.get('email'), code):
+            raise serializers.ValidationError({'code': [_('Verification code is invalid or expired')]})
+
+        payload.update(step.get_claims(data))
+        token = await agenerate_token(step.get_token_payload(payload))
+
+        response = build_json_response('ok', step.message, step.http_status)
+        response[settings.REGISTRATION_TOKEN_HEADER] = token
+        return response
+
+
+class AsyncRegistration(AsyncAPIView):
+    async def get(self, request, *args, **kwargs):
+        payload = await aget_registration_token(request, audience=['registration'], issuers=['registration_password'])
+
+        # Rendering and storing the avatar is Pillow and file work, it runs outside the event loop
+        avatar_name, avatar = await sync_to_async(get_default_avatar, thread_sensitive=False)(
+            payload['first_name'][0], random_avatar_color_index()
+        )
+        payload['avatar'] = avatar_name
+        token = await agenerate_token(payload)
+
+        response = build_json_response('ok', 'Confirm account registration', status.HTTP_200_OK, {
+            'data': {
+                'email': payload['email'],
+                'first_name': payload['first_name'],
+                'last_name': payload['last_name'],
+                'avatar': avatar_to_base64(avatar),
+            }
+        })
+        response[settings.REGISTRATION_TOKEN_HEADER] = token
+        return response
+
+    async def post(self, request, *args, **kwargs):
+        payload = await aget_registration_token(request, audience=['registration'], issuers=['registration_password'])
+
+        if await User.objects.filter(email=payload['email']).aexists():
+            return build_json_response('error', 'Email already registered', status.HTTP_409_CONFLICT)
+
+        await User.objects.acreate(
+            account_type=payload['account_type'],
+            email=payload['email'],
+            phone_number=payload['phone_number'],
+            first_name=payload['first_name'],
+            last_name=payload['last_name'],
+            birthday=date.fromisoformat(payload['birthday']),
+            gender=payload['gender'],
+            parent_email=payload.get('parent_email'),
+            password=payload['password'],
+            avatar=payload['avatar'],
+        )
+        await adelete_registration_session(payload)
+
+        return build_json_response('ok', 'Account registered', status.HTTP_201_CREATED)
+
+
+def format_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+class NotificationStream(AsyncAPIView):
+    # Server-sent events: the unread count on connect, then every notification and count change.
+    # The stream ends after NOTIFICATION_STREAM_TIMEOUT and EventSource reconnects on its own
+    async def get(self, request, *args, **kwargs):
+        authentication = JWTAuthentication()
+        header = authentication.get_header(request)
+        # EventSource can't send headers, browsers pass the access token in the query string
+        raw_token = authentication.get_raw_token(header) if header else request.GET.get('access_token')
+        if not raw_token:
+            raise NotAuthenticated({'status': 'error', 'message': 'Authentication credentials were not provided'})
+        user_id = authentication.get_validated_token(raw_token)[api_settings.USER_ID_CLAIM]
+
+        client = get_async_client()
+        pubsub = client.pubsub()
+        await pubsub.subscribe(get_channel(user_id))
+
+        async def events():
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + settings.NOTIFICATION_STREAM_TIMEOUT
+            try:
+                yield f'retry: {settings.NOTIFICATION_STREAM_RETRY * 1000}\n\n'
+                yield format_event('unread', {'unread': await sync_to_async(get_unread_count)(user_id)})
+                while loop.time() < deadline:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True,
+                                                       timeout=settings.NOTIFICATION_STREAM_HEARTBEAT)
+                    if message is None:
+                        # Keeps proxies from closing an idle connection
+                        yield ': keep-alive\n\n'
+                        continue
+                    payload = json.loads(message['data'])
+                    yield format_event(payload['event'], payload['data'])
+            finally:
+                await pubsub.aclose()
+                await client.aclose()
+
+        response = StreamingHttpResponse(events(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.views import View
+
+from apps.users.utils.jwks import get_jwks
+
+
+class JWKSView(View):
+    def get(self, request, *args, **kwargs):
+        body, etag = get_jwks()
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = HttpResponse(body, content_type='application/json')
+
+        # Verifiers keep the keys for max-age and can use them while refetching
+        response['ETag'] = etag
+        response['Cache-Control'] = (f'public, max-age={settings.JWKS_MAX_AGE}, '
+                                     f'stale-while-revalidate={settings.JWKS_MAX_AGE}')
+        return response
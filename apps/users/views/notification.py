@@ -0,0 +1,66 @@
+from django.conf import settings
+from django.db.models import Q
+
+from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.views import APIView
+
+from apps.users.models import Notification
+from apps.users.serializers.user import NotificationSerializer, NotificationReadSerializer
+from apps.users.utils.functions import build_response, get_page_size, encode_cursor, decode_cursor
+from apps.users.utils.notification import get_unread_count, mark_read, mark_all_read
+
+
+class NotificationList(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        limit = get_page_size(request, settings.NOTIFICATION_PAGE_SIZE, settings.NOTIFICATION_MAX_PAGE_SIZE)
+
+        # Keyset pagination over the (user, status, created_at, id) index
+        notifications = Notification.objects.filter(user=request.user).order_by('-created_at', '-id')
+        if request.GET.get('unread') in ('1', 'true'):
+            notifications = notifications.filter(status=False)
+        cursor = request.GET.get('cursor')
+        if cursor:
+            created_at, pk = decode_cursor(cursor)
+            notifications = notifications.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+
+        page = list(notifications[:limit + 1])
+        next_cursor = encode_cursor(page[limit - 1].created_at, page[limit - 1].pk) if len(page) > limit else None
+
+        return build_response('ok', 'Notifications', status.HTTP_200_OK, {
+            'data': NotificationSerializer(page[:limit], many=True).data,
+            'next': next_cursor,
+            'unread': get_unread_count(request.user.pk),
+        })
+
+
+class NotificationUnreadCount(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        return build_response('ok', 'Unread notifications', status.HTTP_200_OK,
+                              {'unread': get_unread_count(request.user.pk)})
+
+
+class NotificationRead(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        serializer = NotificationReadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        updated = mark_read(request.user.pk, serializer.validated_data['ids'])
+
+        return build_response('ok', 'Notifications marked as read', status.HTTP_200_OK,
+                              {'updated': updated, 'unread': get_unread_count(request.user.pk)})
+
+
+class NotificationReadAll(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        updated = mark_all_read(request.user.pk)
+
+        return build_response('ok', 'Notifications marked as read', status.HTTP_200_OK,
+                              {'updated': updated, 'unread': get_unread_count(request.user.pk)})
@@ -1,268 +1,86 @@
-import os
-import uuid
-from datetime import timedelta, date, datetime
+from datetime import date
 
 from django.conf import settings
 from django.contrib.auth import authenticate, login
-from django.core.files import File
-from django.utils.translation import gettext_lazy as _
-from django.core.cache import cache
 
 from rest_framework import status
+from rest_framework.exceptions import APIException
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from apps.users import User
 from apps.users import CustomTokenObtainPairSerializer
-from apps.users import (VerificationSerializer, ProfileNameSerializer,
-                        AccountTypeSerializer, EmailSerializer,
-                        ParentEmailSerializer, PasswordSerializer,
-                        ProfileMetadataSerializer,
-                        PhoneNumberSerializer)
-from apps.users import (generate_token, generate_verification_code,
-                        generate_unique_email_suggestions, decode_token, decode_token_with_issuer)
+from apps.users import generate_token, generate_unique_email_suggestions, get_registration_token
 from apps.users import build_response
-from apps.users import send_sms, send_email
+from apps.users import delete_registration_session
+from apps.users.models import Activity
+from apps.users.utils.activity import record_activity
+from apps.users.utils.registration import REGISTRATION_STEPS, REGISTRATION_ROUTES
+from apps.users.utils.revocation import RevocableRefreshToken
 
-from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework.permissions import IsAuthenticated
 
-from apps.users import generate_avatar, avatar_to_base64, preprocess_avatar
+from apps.users import get_default_avatar, random_avatar_color_index, avatar_to_base64
 
 
-class Verification(APIView):
-    def get_serializer_class(self, *args, **kwargs):
-        return VerificationSerializer(*args, **kwargs)
-
-    def post(self, request):
-        token_header = request.headers.get(settings.REGISTRATION_TOKEN_HEADER)
-        if not token_header:
-            return build_response('error', 'token not given', status.HTTP_400_BAD_REQUEST)
-
-        previous_token = decode_token_with_issuer(
-            token_header,
-            issuers=['registration_phone_number',
-                     'registration_parent_email'],
-            audience='verification',
-        )
-
-        serializer = VerificationSerializer(data=request.data, context={'token_payload': previous_token})
-        if serializer.is_valid(raise_exception=True):
-            phone_number = serializer.validated_data.get('phone_number').as_e164
-            email = serializer.validated_data.get('email')
-
-            payload = previous_token
-            payload['verified'] = True
-            if phone_number:
-                payload['phone_number'] = phone_number
-            elif email:
-                payload['email'] = email
-            payload['exp'] = datetime.utcnow() + timedelta(seconds=settings.REGISTRATION_TOKEN_TIMEOUT)
-            payload['iss'] = 'verification'
-            del payload['aud']
-            token = generate_token(payload)
-
-            response = build_response('ok',
-                                      'Verification completed',
-                                      status.HTTP_202_ACCEPTED, )
-            response[settings.REGISTRATION_TOKEN_HEADER] = token
-
-            return response
-
-
-class RegistrationAccountType(APIView):
-    def post(self, request, *args, **kwargs):
-        serializer = AccountTypeSerializer(data=request.data)
-        if serializer.is_valid(raise_exception=True):
-            payload = {
-                'account_type': serializer.validated_data['account_type'],
-                'exp': datetime.utcnow() + timedelta(seconds=settings.REGISTRATION_TOKEN_TIMEOUT),
-                'iat': datetime.utcnow(),
-                'iss': 'registration_account_type',
-                'aud': ['registration_phone_number', 'registration_parent_email']
-            }
-            token = generate_token(payload)
-
-            response = build_response('ok',
-                                      'Account type accepted',
-                                      status.HTTP_202_ACCEPTED, )
-            response[settings.REGISTRATION_TOKEN_HEADER] = token
-
-            return response
-
-
-class RegistrationParentEmail(APIView):
-    email_subject = _('{project_name} registration')
-    email_text = _('Your verification code: ')
+class RegistrationStepView(APIView):
+    step = None
 
     def post(self, request, *args, **kwargs):
-        token_header = request.headers.get(settings.REGISTRATION_TOKEN_HEADER)
-        if not token_header:
-            return build_response('error', 'token not given', status.HTTP_400_BAD_REQUEST)
-
-        previous_token = decode_token_with_issuer(
-            token_header,
-            audience=['registration_parent_email'],
-            issuers=['registration_account_type', 'registration_phone_number']
-        )
-        if not previous_token:
-            return build_response('error', 'invalid token', status.HTTP_400_BAD_REQUEST)
-
-        serializer = ParentEmailSerializer(data=request.data)
-        if serializer.is_valid(raise_exception=True):
-            email = serializer.validated_data.get("email")
-
-            key = f'registration_code:{email}'
-            code = generate_verification_code()
-            cache.set(
-                key,
-                code,
-                timeout=settings.REGISTRATION_CODE_TIMEOUT
-            )
-
-            send_email.delay(
-                email,
-                self.email_subject.format(project_name=settings.PROJECT_NAME),
-                self.email_text + str(code)
-            )
-
-            payload = {
-                'exp': datetime.utcnow() + timedelta(seconds=settings.REGISTRATION_CODE_TIMEOUT),
-                'email': email,
-                'iss': 'registration_parent_email',
-                'aud': 'verification'
-            }
-            token = generate_token(payload)
-
-            response = build_response('ok', 'Verification code sent', status.HTTP_200_OK)
-            response[settings.REGISTRATION_TOKEN_HEADER] = token
-            return response
+        step = self.step or REGISTRATION_ROUTES.get(kwargs.get('step'))
+        if step is None:
+            return build_response('error', 'Step not found', status.HTTP_404_NOT_FOUND)
 
+        token = step.run(request, request.data, request.headers.get(settings.REGISTRATION_TOKEN_HEADER))
 
-class RegistrationPhoneNumber(APIView):
-    verification_text = _("{project_name} verification code for registration: ")
-
-    def post(self, request, *args, **kwargs):
-        token_header = request.headers.get(settings.REGISTRATION_TOKEN_HEADER)
-        if not token_header:
-            return build_response('error', 'token not given', status.HTTP_400_BAD_REQUEST)
-
-        previous_token = decode_token_with_issuer(
-            token_header,
-            audience='registration_phone_number',
-            issuers=['registration_account_type', 'registration_parent_email', 'registration_profile_name']
-        )
-        if not previous_token:
-            return build_response('error', 'invalid token', status.HTTP_400_BAD_REQUEST)
-
-        serializer = PhoneNumberSerializer(data=request.data)
-        if serializer.is_valid(raise_exception=True):
-            phone_number = serializer.validated_data.get("phone_number").as_e164
-
-            key = f'registration_code:{phone_number}'
-            code = generate_verification_code()
-            cache.set(
-                key,
-                code,
-                timeout=settings.REGISTRATION_CODE_TIMEOUT
-            )
-
-            send_sms.delay(
-                phone_number,
-                self.verification_text.format(project_name=settings.PROJECT_NAME) + str(code)
-            )
-            payload = previous_token
-            payload['exp'] = datetime.utcnow() + timedelta(seconds=settings.REGISTRATION_CODE_TIMEOUT)
-            payload['phone_number'] = phone_number
-            payload['iss'] = 'registration_phone_number'
-            payload['aud'] = 'verification'
-            token = generate_token(payload)
-
-            response = build_response('ok', 'Verification code sent', status.HTTP_200_OK)
-            response[settings.REGISTRATION_TOKEN_HEADER] = token
-            return response
-
-
-class RegistrationProfileName(APIView):
-    def post(self, request, *args, **kwargs):
-        token_header = request.headers.get(settings.REGISTRATION_TOKEN_HEADER)
-        if not token_header:
-            return build_response('error', 'token not given', status.HTTP_400_BAD_REQUEST)
-
-        previous_token = decode_token_with_issuer(
-            token_header,
-            issuers=['verification', 'registration_profile_metadata']
-        )
-        if not previous_token:
-            return build_response('error', 'invalid token', status.HTTP_400_BAD_REQUEST)
-
-        serializer = ProfileNameSerializer(data=request.data)
-        if serializer.is_valid(raise_exception=True):
-            first_name = serializer.validated_data.get("first_name")
-            last_name = serializer.validated_data.get("last_name")
+        response = build_response('ok', step.message, step.http_status)
+        response[settings.REGISTRATION_TOKEN_HEADER] = token
+        return response
 
-            payload = previous_token
-            payload['first_name'] = first_name
-            payload['last_name'] = last_name
-            payload['iss'] = 'registration_profile_name'
-            payload['aud'] = 'registration_profile_metadata'
-            token = generate_token(payload)
 
-            response = build_response('ok',
-                                      'First name and last name accepted',
-                                      status.HTTP_202_ACCEPTED, )
-            response[settings.REGISTRATION_TOKEN_HEADER] = token
+class Verification(RegistrationStepView):
+    step = REGISTRATION_STEPS['verification']
 
-            return response
 
+class RegistrationSteps(APIView):
+    def get(self, request, *args, **kwargs):
+        return build_response('ok', 'Registration steps', status.HTTP_200_OK,
+                              {'steps': [step.metadata for step in REGISTRATION_ROUTES.values()]})
 
-class RegistrationProfileMetadata(APIView):
     def post(self, request, *args, **kwargs):
-        token_header = request.headers.get(settings.REGISTRATION_TOKEN_HEADER)
-        if not token_header:
-            return build_response('error', 'token not given', status.HTTP_400_BAD_REQUEST)
-
-        previous_token = decode_token_with_issuer(
-            token_header,
-            audience=['registration_profile_metadata'],
-            issuers=['registration_profile_name', 'registration_profile_email']
-        )
-        if not previous_token:
-            return build_response('error', 'invalid token', status.HTTP_400_BAD_REQUEST)
-
-        serializer = ProfileMetadataSerializer(data=request.data)
-        if serializer.is_valid(raise_exception=True):
-            gender = serializer.validated_data.get("gender")
-            birthday = serializer.validated_data.get("birthday")
-
-            payload = previous_token
-            payload['gender'] = gender
-            payload['birthday'] = birthday.strftime("%Y-%m-%d")
-            payload['iss'] = 'registration_profile_metadata'
-            payload['aud'] = 'registration_email'
-            token = generate_token(payload)
-
-            response = build_response('ok',
-                                      'Gender and Birthday accepted',
-                                      status.HTTP_202_ACCEPTED, )
-            response[settings.REGISTRATION_TOKEN_HEADER] = token
+        # Several steps in one request, each step gets the token issued by the previous one
+        steps = request.data.get('steps')
+        if not isinstance(steps, list) or not steps or len(steps) > len(REGISTRATION_ROUTES):
+            return build_response('error', 'Invalid steps', status.HTTP_400_BAD_REQUEST)
+
+        token = request.headers.get(settings.REGISTRATION_TOKEN_HEADER)
+        completed = []
+        for item in steps:
+            step = REGISTRATION_ROUTES.get(item.get('step')) if isinstance(item, dict) else None
+            if step is None:
+                return build_response('error', 'Step not found', status.HTTP_404_NOT_FOUND, {'completed': completed})
+
+            try:
+                token = step.run(request, item.get('data') or {}, token)
+            except APIException as e:
+                response = build_response('error', 'Step failed', e.status_code,
+                                          {'step': step.name, 'errors': e.detail, 'completed': completed})
+                if token:
+                    response[settings.REGISTRATION_TOKEN_HEADER] = token
+                return response
+            completed.append({'step': step.name, 'message': step.message})
+
+        response = build_response('ok', 'Steps accepted', status.HTTP_202_ACCEPTED, {'completed': completed})
+        response[settings.REGISTRATION_TOKEN_HEADER] = token
+        return response
 
-            return response
 
+class RegistrationEmail(RegistrationStepView):
+    step = REGISTRATION_STEPS['email']
 
-class RegistrationEmail(APIView):
     def get(self, request, *args, **kwargs):
-        token_header = request.headers.get(settings.REGISTRATION_TOKEN_HEADER)
-        if not token_header:
-            return build_response('error', 'token not given', status.HTTP_400_BAD_REQUEST)
-
-        previous_token = decode_token_with_issuer(
-            token_header,
-            audience=['registration_email'],
-            issuers=['registration_profile_metadata', 'registration_password'],
-        )
-        if not previous_token:
-            return build_response('error', 'invalid token', status.HTTP_400_BAD_REQUEST)
+        previous_token = get_registration_token(request, audience=[self.step.issuer],
+                                                issuers=self.step.previous_issuers)
 
         first_name = previous_token.get('first_name')
         last_name = previous_token.get('last_name')
@@ -273,150 +91,19 @@ class RegistrationEmail(APIView):
         return build_response('ok', 'Email suggestions', status.HTTP_200_OK,
                               {'email_suggestions': email_suggestions})
 
-    def post(self, request, *args, **kwargs):
-        token_header = request.headers.get(settings.REGISTRATION_TOKEN_HEADER)
-        if not token_header:
-            return build_response('error', 'token not given', status.HTTP_400_BAD_REQUEST)
-
-        previous_token = decode_token_with_issuer(
-            token_header,
-            audience=['registration_email'],
-            issuers=['registration_profile_metadata', 'registration_password'],
-        )
-        if not previous_token:
-            return build_response('error', 'invalid token', status.HTTP_400_BAD_REQUEST)
-
-        serializer = EmailSerializer(data=request.data)
-        if serializer.is_valid(raise_exception=True):
-            email = serializer.validated_data.get("email")
-            if User.objects.filter(email=email).exists():
-                return build_response('error', 'Email already registered', status.HTTP_409_CONFLICT)
-
-            payload = previous_token
-            payload['email'] = email
-            payload['iss'] = 'registration_email'
-            payload['aud'] = 'registration_password'
-            token = generate_token(payload)
-
-            response = build_response('ok',
-                                      'Email accepted',
-                                      status.HTTP_202_ACCEPTED, )
-            response[settings.REGISTRATION_TOKEN_HEADER] = token
-
-            return response
-
-
-# class RegistrationAvatar(APIView):
-#     def get(self, request, *args, **kwargs):
-#         token_header = request.headers.get(settings.REGISTRATION_TOKEN_HEADER)
-#         if not token_header:
-#             return build_response('error', 'token not given', status.HTTP_400_BAD_REQUEST)
-#
-#         previous_token = parse_token(token_header)
-#         if not previous_token:
-#             return build_response('error', 'invalid token', status.HTTP_400_BAD_REQUEST)
-#
-#         avatar_tmp_path = generate_avatar(previous_token['first_name'][0])
-#         preprocess_avatar(avatar_tmp_path)
-#         avatar_base64 = avatar_to_base64(avatar_tmp_path)
-#
-#         payload = previous_token
-#         payload['avatar'] = avatar_tmp_path
-#         token = generate_token(payload)
-#
-#         response = build_response('ok',
-#                                   'Generated avatar',
-#                                   status.HTTP_200_OK,
-#                                   {'avatar': avatar_base64}
-#                                   )
-#         response[settings.REGISTRATION_TOKEN_HEADER] = token
-#
-#         return response
-#
-#     def post(self, request, *args, **kwargs):
-#         token_header = request.headers.get(settings.REGISTRATION_TOKEN_HEADER)
-#         if not token_header:
-#             return build_response('error', 'token not given', status.HTTP_400_BAD_REQUEST)
-#
-#         previous_token = parse_token(token_header)
-#         if not previous_token:
-#             return build_response('error', 'invalid token', status.HTTP_400_BAD_REQUEST)
-#
-#         serializer = AvatarSerializer(data=request.data)
-#         if serializer.is_valid():
-#             avatar = serializer.validated_data.get("avatar")
-#
-#             payload = previous_token
-#             avatar_tmp_path = avatar.temporary_file_path()
-#             payload['avatar'] = avatar_tmp_path
-#             preprocess_avatar(avatar_tmp_path)
-#             token = generate_token(payload)
-#
-#             response = build_response('ok',
-#                                       'Avatar accepted',
-#                                       status.HTTP_202_ACCEPTED)
-#             response[settings.REGISTRATION_TOKEN_HEADER] = token
-#
-#             return response
-#
-#         response = build_response('ok',
-#                                   'Avatar skipped',
-#                                   status.HTTP_200_OK)
-#         response[settings.REGISTRATION_TOKEN_HEADER] = token_header
-#         return response
-
-
-class RegistrationPassword(APIView):
-    def post(self, request, *args, **kwargs):
-        token_header = request.headers.get(settings.REGISTRATION_TOKEN_HEADER)
-        if not token_header:
-            return build_response('error', 'token not given', status.HTTP_400_BAD_REQUEST)
-
-        previous_token = decode_token_with_issuer(
-            token_header,
-            audience=['registration_password'],
-            issuers=['registration_email', 'registration'],
-        )
-        if not previous_token:
-            return build_response('error', 'invalid token', status.HTTP_400_BAD_REQUEST)
-
-        serializer = PasswordSerializer(data=request.data)
-        if serializer.is_valid(raise_exception=True):
-            password = serializer.validated_data.get("password")
-
-            payload = previous_token
-            payload['password'] = password
-            payload['iss'] = 'registration_password'
-            payload['aud'] = 'registration'
-            token = generate_token(payload)
-
-            response = build_response('ok',
-                                      'Password accepted',
-                                      status.HTTP_202_ACCEPTED, )
-            response[settings.REGISTRATION_TOKEN_HEADER] = token
-
-            return response
-
 
 class Registration(APIView):
     def get(self, request, *args, **kwargs):
-        token_header = request.headers.get(settings.REGISTRATION_TOKEN_HEADER)
-        if not token_header:
-            return build_response('error', 'token not given', status.HTTP_400_BAD_REQUEST)
-
-        previous_token = decode_token_with_issuer(
-            token_header,
+        previous_token = get_registration_token(
+            request,
             audience=['registration'],
             issuers=['registration_password'],
         )
-        if not previous_token:
-            return build_response('error', 'invalid token', status.HTTP_400_BAD_REQUEST)
 
-        avatar_tmp_path = generate_avatar(previous_token['first_name'][0])
-        preprocess_avatar(avatar_tmp_path)
-        avatar_base64 = avatar_to_base64(avatar_tmp_path)
+        avatar_name, avatar = get_default_avatar(previous_token['first_name'][0], random_avatar_color_index())
+        avatar_base64 = avatar_to_base64(avatar)
         payload = previous_token
-        payload['avatar'] = avatar_tmp_path
+        payload['avatar'] = avatar_name
         token = generate_token(payload)
 
         response = build_response('ok',
@@ -435,17 +122,11 @@ class Registration(APIView):
         return response
 
     def post(self, request, *args, **kwargs):
-        token_header = request.headers.get(settings.REGISTRATION_TOKEN_HEADER)
-        if not token_header:
-            return build_response('error', 'token not given', status.HTTP_400_BAD_REQUEST)
-
-        previous_token = decode_token_with_issuer(
-            token_header,
+        previous_token = get_registration_token(
+            request,
             audience=['registration'],
             issuers=['registration_password'],
         )
-        if not previous_token:
-            return build_response('error', 'invalid token', status.HTTP_400_BAD_REQUEST)
 
         user = User(
             account_type=previous_token['account_type'],
@@ -457,14 +138,12 @@ class Registration(APIView):
             gender=previous_token['gender'],
             parent_email=previous_token.get('parent_email')
         )
-        user.set_password(previous_token['password'])
-
-        avatar_tmp_path = previous_token['avatar']
-        with open(avatar_tmp_path, 'rb') as avatar_file:
-            user.avatar.save((uuid.uuid4().hex + '.png'), File(avatar_file))
-        os.remove(avatar_tmp_path)
+        user.password = previous_token['password']
 
+        # Generated avatars are shared content-addressed files, so the user only references it
+        user.avatar.name = previous_token['avatar']
         user.save()
+        delete_registration_session(previous_token)
 
         return build_response('ok',
                               'Account registered',
@@ -483,19 +162,15 @@ class CustomLogin(APIView):
             # User authentication okful, proceed with login
             login(request, user)
 
-            # Generate JWT tokens using the custom serializer
-            serializer = CustomTokenObtainPairSerializer(
-                data={'email': email, 'phone_number': phone_number, 'password': password}
-            )
-            serializer.is_valid(raise_exception=True)
-            tokens = serializer.validated_data
+            # Tokens are minted from the authenticated user, so the password is checked only once
+            refresh = CustomTokenObtainPairSerializer.get_token(user)
 
             response_data = {
-                'access_token': str(tokens.access_token),
-                'refresh_token': str(tokens.refresh_token),
+                'access_token': str(refresh.access_token),
+                'refresh_token': str(refresh),
                 'user_id': user.id,
                 'email': user.email,
-                'phone_number': user.phone_number,
+                'phone_number': str(user.phone_number) if user.phone_number else None,
             }
 
             return Response(response_data, status=status.HTTP_200_OK)
@@ -509,8 +184,9 @@ class CustomTokenRevokeView(APIView):
     def post(self, request, *args, **kwargs):
         try:
             refresh_token = request.data.get('refresh')
-            token = RefreshToken(refresh_token)
+            token = RevocableRefreshToken(refresh_token)
             token.blacklist()
+            record_activity(request.user, Activity.Activities.LOGOUT, request)
             return Response({'detail': 'Token okfully revoked.'}, status=status.HTTP_200_OK)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
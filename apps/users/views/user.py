@@ -0,0 +1,173 @@
+import hashlib
+import mimetypes
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from django.http import FileResponse, Http404, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.views import View
+
+from rest_framework import status
+from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.views import APIView
+from oauth2_provider.contrib.rest_framework import OAuth2Authentication, TokenHasScope
+
+from apps.users.backends.auth import CachedJWTAuthentication
+from apps.users.permissions import IsClientCredentialsToken
+from apps.users.models import Activity, User
+from apps.users.serializers.user import ActivitySerializer, AvatarSerializer, UserIdsSerializer, UserLookupSerializer
+from apps.users.tasks import process_avatar
+from apps.users.utils.activity import record_activity
+from apps.users.utils.functions import build_response, get_page_size, encode_cursor, decode_cursor
+from apps.users.utils.profile import get_profile, get_profiles, get_public_profiles, stream_public_profiles
+from apps.users.utils.user import save_tmp_upload, get_avatar_variant
+
+
+def get_avatar_data(request, user):
+    return {
+        'avatar': request.build_absolute_uri(user.avatar.url) if user.avatar else None,
+        'avatar_status': user.avatar_status,
+    }
+
+
+class UserAvatar(APIView):
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser, FormParser]
+
+    def get(self, request, *args, **kwargs):
+        return build_response('ok', 'Avatar', status.HTTP_200_OK, get_avatar_data(request, request.user))
+
+    def post(self, request, *args, **kwargs):
+        serializer = AvatarSerializer(data=request.data)
+        if serializer.is_valid(raise_exception=True):
+            avatar_tmp_path = save_tmp_upload(serializer.validated_data.get('avatar'))
+
+            # The current avatar stays as a placeholder until the task replaces it
+            user = request.user
+            user.avatar_status = User.AvatarStatuses.PROCESSING
+            user.save(update_fields=['avatar_status', 'updated_at'])
+            process_avatar.delay(str(user.pk), avatar_tmp_path)
+            record_activity(user, Activity.Activities.AVATAR_CHANGED, request)
+
+            return build_response('ok',
+                                  'Avatar accepted',
+                                  status.HTTP_202_ACCEPTED,
+                                  get_avatar_data(request, user))
+
+
+class UserAvatarVariant(View):
+    def get(self, request, pk, *args, **kwargs):
+        try:
+            size = int(request.GET.get('size', settings.AVATAR_SIZE))
+        except ValueError:
+            size = settings.AVATAR_SIZE
+        image_format = 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'png'
+
+        avatar = User.objects.filter(pk=pk).values_list('avatar', flat=True).first()
+        if not avatar:
+            raise Http404
+
+        # The variant can be gone by the time it is opened, the original is served instead
+        for name in dict.fromkeys((get_avatar_variant(avatar, size, image_format), avatar)):
+            # Avatar files are never overwritten, so the file name is a strong validator
+            etag = '"%s"' % hashlib.sha1(name.encode()).hexdigest()
+            response = get_conditional_response(request, etag=etag)
+            if response is not None:
+                break
+            try:
+                file = default_storage.open(name)
+            except OSError:
+                continue
+            content_type, _ = mimetypes.guess_type(name)
+            response = FileResponse(file, content_type=content_type)
+            break
+        else:
+            raise Http404
+
+        response['ETag'] = etag
+        response['Vary'] = 'Accept'
+        if request.GET.get('v') == etag.strip('"'):
+            response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            response['Cache-Control'] = 'public, max-age=60, must-revalidate'
+        return response
+
+
+class ActivityFeed(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        limit = get_page_size(request, settings.ACTIVITY_FEED_PAGE_SIZE, settings.ACTIVITY_FEED_MAX_PAGE_SIZE)
+
+        # Keyset pagination over the (user, date, id) index, a page costs the same however deep it is
+        activities = (Activity.objects.filter(user=request.user)
+                      .select_related('device')
+                      .only('id', 'action', 'ip_address', 'date', 'device__name')
+                      .order_by('-date', '-id'))
+        cursor = request.GET.get('cursor')
+        if cursor:
+            date, pk = decode_cursor(cursor)
+            activities = activities.filter(Q(date__lt=date) | Q(date=date, id__lt=pk))
+
+        page = list(activities[:limit + 1])
+        next_cursor = encode_cursor(page[limit - 1].date, page[limit - 1].pk) if len(page) > limit else None
+
+        return build_response('ok', 'Activity', status.HTTP_200_OK, {
+            'data': ActivitySerializer(page[:limit], many=True).data,
+            'next': next_cursor,
+        })
+
+
+class UserProfile(APIView):
+    # The user comes from the auth backend cache and the profile from its own cache, a repeated
+    # read runs no query and a matching If-None-Match gets a 304
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        profile = get_profile(request.user)
+
+        response = get_conditional_response(request, etag=profile['etag'])
+        if response is None:
+            response = build_response('ok', 'Profile', status.HTTP_200_OK, {'data': profile['data']})
+
+        response['ETag'] = profile['etag']
+        response['Cache-Control'] = 'private, no-cache'
+        response['Vary'] = 'Authorization'
+        return response
+
+
+class UserProfiles(APIView):
+    # Internal: full profiles of many users for other services. Only tokens a service got for itself,
+    # a profile.read token a user granted to an app must not read other users' profiles
+    authentication_classes = [OAuth2Authentication]
+    permission_classes = [IsClientCredentialsToken, TokenHasScope]
+    required_scopes = ['profile.read']
+
+    def post(self, request, *args, **kwargs):
+        serializer = UserIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user_ids = [str(user_id) for user_id in serializer.validated_data['ids']]
+        profiles = get_profiles(user_ids)
+
+        return build_response('ok', 'Profiles', status.HTTP_200_OK, {
+            'data': {user_id: profiles[user_id]['data'] for user_id in user_ids if user_id in profiles},
+            'missing': [user_id for user_id in user_ids if user_id not in profiles],
+        })
+
+
+class UserLookup(APIView):
+    # Internal: resolves up to USER_LOOKUP_MAX_IDS user ids to names and avatars in one call
+    authentication_classes = [OAuth2Authentication]
+    permission_classes = [IsClientCredentialsToken, TokenHasScope]
+    required_scopes = ['users.lookup']
+
+    def post(self, request, *args, **kwargs):
+        serializer = UserLookupSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user_ids = list(dict.fromkeys(str(user_id) for user_id in serializer.validated_data['ids']))
+        profiles = get_public_profiles(user_ids)
+
+        return StreamingHttpResponse(stream_public_profiles(user_ids, profiles), content_type='application/json')